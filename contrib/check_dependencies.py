@@ -31,9 +31,11 @@ def skip_features_to_skip_modules(skip_features):
     return skip_obj_modules
 
 def import_runtime_dependencies():
-    # we don't have any right now, but in the future if we import a module during runtime (eg inside a function), then we need to place it here:
-    # import foobar
-    pass
+    # modules imported during runtime (eg inside a function, or through
+    # util.LazyModule) need to be placed here:
+    from gi.repository import GLib, GObject, Gio
+    import watchdog.observers
+    import mako.lookup
 
 def import_all_py_in_dir(rel_path, skip_modules=[]):
     selfdir = os.getcwd()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+# Report how long importing osmo-gsm-tester modules takes in a fresh python3,
+# based on python3 -X importtime. Without modules given, measure the ones
+# osmo-gsm-tester.py imports on startup.
+
+import os
+import sys
+import argparse
+
+rootdir = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(rootdir, 'src/'))
+from osmo_gsm_tester.core import import_time
+
+parser = argparse.ArgumentParser(epilog=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+parser.add_argument('modules', nargs='*',
+        help='Modules to import, like osmo_gsm_tester.obj.bsc_osmo')
+parser.add_argument('-n', '--top', dest='top', type=int, default=20,
+        help='How many of the slowest modules to list')
+parser.add_argument('-b', '--budget', dest='budget', type=float,
+        help='Exit with an error if importing takes longer than this many milliseconds')
+parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=1,
+        help='Measure this many times and report the fastest run')
+args = parser.parse_args()
+
+modules = args.modules or import_time.STARTUP_MODULES
+runs = [import_time.measure(modules) for i in range(max(args.repeat, 1))]
+import_times = min(runs, key=import_time.total_us)
+print('\n'.join(import_time.report(import_times, args.top)))
+
+if args.budget is not None and import_time.total_us(import_times) > args.budget * 1000:
+    print('Over budget of %.1f ms' % args.budget)
+    exit(1)
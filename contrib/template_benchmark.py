@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# Measure how long the templates of osmo-gsm-tester take to compile, to load
+# from the cache of compiled templates, and to render.
+#
+# Templates are rendered with placeholder values accepting any attribute,
+# item or iteration. Templates doing more with their values than that can't
+# be rendered this way, their render time is shown as "-".
+
+import io
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+rootdir = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(rootdir, 'src/'))
+from osmo_gsm_tester.core import template
+from mako import runtime as mako_runtime
+from mako import lookup as mako_lookup
+
+class Anything:
+    'Placeholder for any value a template may ask for'
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self
+    def __getitem__(self, key):
+        return self
+    def __iter__(self):
+        return iter((self,))
+    def __len__(self):
+        return 1
+    def __contains__(self, item):
+        return True
+    def __call__(self, *args, **kwargs):
+        return self
+    def __int__(self):
+        return 1
+    def __index__(self):
+        return 1
+    def __float__(self):
+        return 1.0
+    def __str__(self):
+        return '1'
+    def __eq__(self, other):
+        return False
+    def __hash__(self):
+        return 1
+
+class Values(dict):
+    'Template context data, with an Anything for all names not set'
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return Anything()
+
+def render_anything(tmpl):
+    buf = io.StringIO()
+    context = mako_runtime.Context(buf)
+    context._data = Values(context._data)
+    tmpl.render_context(context)
+    return buf.getvalue()
+
+def timed(func, repeat):
+    '''Return the fastest of repeat runs of func in milliseconds, or None if
+    it fails.'''
+    best = None
+    for i in range(repeat):
+        t = time.perf_counter()
+        try:
+            func()
+        except Exception:
+            return None
+        elapsed = (time.perf_counter() - t) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def fmt(ms):
+    return '%8.2f' % ms if ms is not None else '%8s' % '-'
+
+parser = argparse.ArgumentParser(epilog=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+parser.add_argument('names', nargs='*',
+        help='Templates to measure, like osmo-bsc.cfg, all if none given')
+parser.add_argument('-d', '--templates-dir', dest='templates_dirs', action='append',
+        help='Templates dir, overlaying the default one, can be passed several times')
+parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=5,
+        help='Measure this many times and report the fastest run')
+args = parser.parse_args()
+
+templates_dirs = list(args.templates_dirs or []) + [template.default_templates_dir()]
+names = args.names
+if not names:
+    names = sorted(set(f[:-len('.tmpl')] for d in templates_dirs for f in os.listdir(d) if f.endswith('.tmpl')))
+
+template.cache_dir = tempfile.mkdtemp()
+try:
+    print('%-32s %8s %8s %8s  (ms)' % ('template', 'compile', 'cached', 'render'))
+    for name in names:
+        def compile():
+            # without cache, as mako does by itself
+            mako_lookup.TemplateLookup(directories=templates_dirs).get_template(name + '.tmpl')
+        def load_cached():
+            template.set_templates_dir(*templates_dirs)
+            template._lookup.get_template(name + '.tmpl')
+        def render():
+            render_anything(template._lookup.get_template(name + '.tmpl'))
+        compile_ms = timed(compile, args.repeat)
+        cached_ms = timed(load_cached, args.repeat)
+        render_ms = timed(render, args.repeat)
+        print('%-32s %s %s %s' % (name, fmt(compile_ms), fmt(cached_ms), fmt(render_ms)))
+finally:
+    shutil.rmtree(template.cache_dir, ignore_errors=True)
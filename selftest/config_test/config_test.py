@@ -7,8 +7,12 @@ import os
 import io
 import pprint
 import copy
+import shutil
+import tempfile
+import pickle
+import time
 
-from osmo_gsm_tester.core import config, log, schema
+from osmo_gsm_tester.core import config, log, schema, util
 
 example_config_file = 'test.cfg'
 example_config = os.path.join(_prep.script_dir, example_config_file)
@@ -213,4 +217,81 @@ res = {'times': '1', 'label': 'foo', 'trx': [], 'type': 'osmo-bts-trx'}
 schema.combine(a, b)
 assert a == res
 
+print('- Cached reads:')
+tmpdir = tempfile.mkdtemp()
+try:
+    cached_path = os.path.join(tmpdir, 'cached.cfg')
+    with open(cached_path, 'w') as f:
+        f.write('a_dict:\n  foo: 1\n')
+    first = config.read(cached_path, test_schema)
+    first['a_dict']['foo'] = 'modified'
+    print(config.read(cached_path, test_schema))
+    # a changed file is read again:
+    with open(cached_path, 'w') as f:
+        f.write('a_dict:\n  foo: 22\n')
+    os.utime(cached_path, ns=(0, 0))
+    print(config.read(cached_path, test_schema))
+    # so is a file read with another schema, even if it passed before:
+    try:
+        config.read(cached_path, {'a_dict.bar': schema.INT})
+    except ValueError as e:
+        print('ValueError:', e)
+    print('- Cache dir:')
+    config.cache_dir = os.path.join(tmpdir, 'cache')
+    config._cache.clear()
+    print(config.read(cached_path, test_schema))
+    print(len(os.listdir(config.cache_dir)))
+    config._cache.clear()
+    orig_load = config.yaml.load
+    config.yaml.load = None # must not be needed
+    print(config.read(cached_path, test_schema))
+    config.yaml.load = orig_load
+    config.cache_dir = None
+finally:
+    shutil.rmtree(tmpdir)
+
+print('- Copy-on-write views:')
+config.DEFAULTS_CONF = util.freeze({'bts': {'type': 'osmo-bts-trx', 'trx': [{'band': 'GSM-1800'}]}})
+defaults = config.get_defaults('bts')
+# unmodified parts are shared with the defaults:
+print(dict.__getitem__(defaults, 'trx') is config.DEFAULTS_CONF['bts']['trx'])
+defaults['trx'][0]['band'] = 'GSM-900'
+defaults['trx'].append({'band': 'GSM-1900'})
+print(defaults)
+print(config.get_defaults('bts'))
+values = dict(bts=config.get_defaults('bts'))
+config.overlay(values, {'bts': {'type': 'osmo-bts-sysmo', 'trx': [{'arfcn': '868'}]}})
+print(values)
+print(config.get_defaults('bts'))
+try:
+    config.DEFAULTS_CONF['bts']['trx'][0]['band'] = 'GSM-900'
+except TypeError as e:
+    print('TypeError:', e)
+print(config.overlay(config.DEFAULTS_CONF['bts'], {'type': 'osmo-bts-octphy'}))
+try:
+    config.overlay(values, {'bts': {'trx': ['not a dict']}})
+except ValueError:
+    log.log_exn()
+want = {'bts': [{'times': '2', 'trx': [{}]}], 'modem': [{'times': '1'}, {}]}
+replicated = config.replicate_times(want)
+replicated['bts'][0]['trx'][0]['band'] = 'GSM-900'
+print(replicated)
+print(want)
+print(type(copy.deepcopy(values['bts'])).__name__, copy.deepcopy(values) == values)
+print(pickle.loads(pickle.dumps(config.DEFAULTS_CONF)) == config.DEFAULTS_CONF,
+      pickle.loads(pickle.dumps(values)) == values)
+print(config.tostr(values))
+
+config.DEFAULTS_CONF = util.freeze(config.read(os.path.join(_prep.script_dir, '..', '..', 'sysmocom', 'defaults.conf')))
+t = time.time()
+for i in range(1000):
+    values = dict(enb=config.get_defaults('enb'))
+    config.overlay(values, dict(enb=config.get_defaults('srsenb')))
+    config.overlay(values, dict(enb={'addr': '10.42.42.1', 'num_prb': '50'}))
+    values['enb']['cell_list'][0]['dl_earfcn'] = '2850'
+elapsed = time.time() - t
+if elapsed > 2:
+    print('configuring 1000 enb values too slow: %.1fs' % elapsed)
+config.DEFAULTS_CONF = None
+
 # vim: expandtab tabstop=4 shiftwidth=4
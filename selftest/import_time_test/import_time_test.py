@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+import sys
+import _prep
+from osmo_gsm_tester.core import util
+from osmo_gsm_tester.core import import_time
+
+# Milliseconds importing the modules osmo-gsm-tester.py starts with may take:
+STARTUP_BUDGET = 750
+
+def measure(label, module_names, budget=None):
+    # the fastest of a few runs, to not fail on a busy machine
+    runs = [import_time.measure(module_names) for i in range(3)]
+    import_times = min(runs, key=import_time.total_us)
+    elapsed = import_time.total_us(import_times) / 1000000.0
+    over = budget is not None and elapsed * 1000 > budget
+    print('%s (%.3f sec)%s' % (label, elapsed, ' over budget of %d ms' % budget if over else ''))
+    print('heavy modules imported:', import_time.imported_heavy_modules(import_times))
+    return import_times
+
+print('- lazily imported module')
+colorsys = util.LazyModule('colorsys')
+print(colorsys)
+print('colorsys imported before use:', 'colorsys' in sys.modules)
+print(colorsys.rgb_to_hsv(1.0, 0.0, 0.0))
+print(colorsys)
+
+print('- startup of osmo-gsm-tester.py')
+import_times = measure('core modules', import_time.STARTUP_MODULES, STARTUP_BUDGET)
+print('all startup modules imported:',
+      set(import_time.STARTUP_MODULES).issubset(set(it.module_name for it in import_times)))
+
+print('- other entry points')
+measure('osmo_ms_driver', ['osmo_ms_driver.starter', 'osmo_ms_driver.location_update_test'])
+measure('object modules', ['osmo_gsm_tester.obj.esme', 'osmo_gsm_tester.obj.ms_ofono',
+                           'osmo_gsm_tester.obj.ms_srs', 'osmo_gsm_tester.obj.epc_open5gs'])
+
+# vim: expandtab tabstop=4 shiftwidth=4
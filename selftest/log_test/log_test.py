@@ -23,6 +23,9 @@ import _prep
 
 import sys
 import os
+import time
+import shutil
+import tempfile
 
 from osmo_gsm_tester.core import log
 
@@ -148,4 +151,107 @@ except log.OriginLoopError:
     print('disallowed successfully')
     pass
 
+print('- Testing level-gated logging')
+class Composed:
+    'counts how often a log message gets composed'
+    count = 0
+    def __str__(self):
+        Composed.count += 1
+        return 'composed %d' % Composed.count
+
+log.style(time=False, src=False, origin_width=0)
+log.set_level(log.C_TST, log.L_LOG)
+log.set_level(log.C_DEFAULT, log.L_LOG)
+print(log.lowest_level(), log.lowest_level(log.C_TST))
+t = LogTest('gated')
+t.dbg(Composed())
+log.dbg(Composed(), _category=log.C_TST)
+print(Composed.count)
+second = log.TestsTarget().set_level(log.C_TST, log.L_DBG)
+print(log.lowest_level(), log.lowest_level(log.C_TST), log.lowest_level(log.C_RUN))
+t.dbg(Composed())
+t.log(Composed())
+print(Composed.count)
+second.remove()
+print(log.lowest_level(), log.lowest_level(log.C_TST))
+t.dbg(Composed())
+print(Composed.count)
+
+print('- Testing buffered FileLogTarget')
+stdout_target = log.LogTarget.all_targets[0]
+stdout_target.set_all_levels(log.L_ERR)
+tmpdir = tempfile.mkdtemp()
+
+def file_targets(name, **kwargs):
+    'detailed and brief log like a Trial or Test has'
+    return [log.FileLogTarget(os.path.join(tmpdir, name + '.log'), **kwargs).set_all_levels(log.L_DBG).style_change(time=False, trace=True),
+            log.FileLogTarget(os.path.join(tmpdir, name + '.brief'), **kwargs).style_change(time=False, src=False)]
+
+def file_content(target):
+    with open(target.log_file_path()) as f:
+        return f.read()
+
+try:
+    detailed, brief = file_targets('consistency', background_flush=False)
+    detailed.FLUSH_INTERVAL = 3600
+    mark = detailed.get_mark()
+    t.dbg('buffered line')
+    print('written before reading back:', 'buffered line' in file_content(detailed))
+    print('get_output():', repr(detailed.get_output(mark)))
+    mark = detailed.get_mark()
+    t.dbg('another buffered line')
+    t.err('an error')
+    print('written on error:', repr(file_content(detailed)[mark:]))
+    detailed.remove()
+    brief.remove()
+
+    detailed, brief = file_targets('background')
+    t.log('flushed in the background')
+    deadline = time.time() + 5
+    while 'flushed in the background' not in file_content(brief) and time.time() < deadline:
+        time.sleep(0.1)
+    print('written in the background:', repr(file_content(brief)))
+    detailed.remove()
+    brief.remove()
+
+    def log_lines(targets, count):
+        start = time.time()
+        for i in range(count):
+            t.dbg('throughput', i, cmd='show subscriber imsi 901700000000001')
+        t.log('logged', count, 'lines')
+        for target in targets:
+            target.remove()
+        return time.time() - start
+
+    def write_lines(targets, count):
+        line = 'tst                            gated: DBG: throughput 1 {cmd=\'show subscriber imsi 901700000000001\'}\n'
+        start = time.time()
+        for i in range(count):
+            for target in targets:
+                target.log_write_func(line)
+        for target in targets:
+            target.remove()
+        return time.time() - start
+
+    count = 20000
+    results = {}
+    for name, run in (('log', log_lines), ('write', write_lines)):
+        for buffered in (False, True):
+            targets = file_targets('%s_%s' % (name, 'buffered' if buffered else 'unbuffered'),
+                                   background_flush=buffered)
+            if not buffered:
+                for target in targets:
+                    target.log_write_func = target.write_to_log_and_flush
+            results[(name, buffered)] = run(targets, count)
+    for name in sorted(os.listdir(tmpdir)):
+        with open(os.path.join(tmpdir, name)) as f:
+            print(name, 'lines:', len(f.readlines()))
+    if results[('log', True)] > 10:
+        print('logging %d lines too slow: %.1fs' % (count, results[('log', True)]))
+    if results[('write', True)] > results[('write', False)]:
+        print('buffered writes slower than unbuffered: %.2fs > %.2fs' % (results[('write', True)], results[('write', False)]))
+finally:
+    shutil.rmtree(tmpdir)
+    stdout_target.set_all_levels(None)
+
 # vim: expandtab tabstop=4 shiftwidth=4
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+import os
+import sys
+import _prep
+from osmo_gsm_tester.core import log
+from osmo_gsm_tester.core import config
+from osmo_gsm_tester.core import suite
+from osmo_gsm_tester.core import resource
+from osmo_gsm_tester.core import planner
+from osmo_gsm_tester.core.schema import generate_schemas
+
+workdir = os.path.join(os.path.dirname(sys.argv[0]))
+config.override_conf = os.path.join(workdir, 'paths.conf')
+
+# Generate supported schemas dynamically from objects:
+generate_schemas()
+
+log.set_all_levels(log.L_ERR)
+
+print('- durations from earlier JUnit reports')
+durations = planner.SuiteDurations()
+durations.read(os.path.join(workdir, 'history'))
+print(config.tostr(durations.durations))
+for name in ('long:sysmo', 'short', 'big:trx', 'big:sysmo', 'solo', 'never'):
+    print(name, durations.estimate(name))
+
+combination_strs = ['short', 'solo', 'long:sysmo', 'big:trx', 'long:trx']
+suite_scenarios = [suite.load_suite_scenario_str(s) for s in combination_strs]
+pool = resource.ResourcesPool()
+
+print('- plan without limit of jobs')
+plan = planner.plan_suite_scenarios(pool, suite_scenarios, durations)
+print(config.tostr(plan.to_conf()))
+
+print('- plan running only one suite at a time')
+plan = planner.plan_suite_scenarios(pool, suite_scenarios, durations, jobs=1)
+print(config.tostr(plan.to_conf()))
+
+print('- plan running two suites at a time')
+plan = planner.plan_suite_scenarios(pool, suite_scenarios, durations, jobs=2)
+print(config.tostr(plan.to_conf()))
+
+print('- read back a written plan')
+plan_path = os.path.join('test_work', 'plan.conf')
+os.makedirs('test_work', exist_ok=True)
+plan.write(plan_path)
+print(planner.Plan.read(plan_path))
+
+print('- suite that can never run')
+try:
+    planner.plan_suite_scenarios(pool, [suite.load_suite_scenario_str('solo:three_bts')], durations)
+except resource.NoResourceExn as e:
+    print('NoResourceExn:', e)
+
+# vim: expandtab tabstop=4 shiftwidth=4
@@ -3,6 +3,7 @@
 import _prep
 import time
 import os
+import re
 
 from osmo_gsm_tester.core import process, util, log
 
@@ -22,6 +23,9 @@ print('stdout:')
 print(p.get_stdout())
 print('stderr:')
 print(p.get_stderr())
+print('stdout "stdout" lines: %d' % p.get_counter_stdout('stdout'))
+mark = p.get_output_mark('stdout')
+print('stdout mark at line %d' % mark.line_nr)
 
 assert not p.terminated()
 p.terminate()
@@ -32,6 +36,56 @@ print('stdout:')
 print(p.get_stdout())
 print('stderr:')
 print(p.get_stderr())
+print('stdout "stdout" lines: %d' % p.get_counter_stdout('stdout'))
+print('last stdout "Exiting" line: %r' % p.get_last_line_stdout('Exiting'))
+print('grep stdout: %r' % p.grep_output('stdout', 'Exiting|SIGINT', line_nrs=True))
+print('grep stdout since mark: %r' % p.grep_output('stdout', 'Exiting|SIGINT', since_mark=mark, line_nrs=True))
+print('- OutputTailer follows appended output')
+tailed_path = tmpdir.new_child('tailed_output')
+tailed_file = open(tailed_path, 'w')
+tailer = process.OutputTailer(tailed_path)
+def rach_seen(line_nr, line):
+    print('callback: line %d %r' % (line_nr, line))
+rach_watch = tailer.watch('RACH', rach_seen)
+tailed_file.write('RACH 1\nfoo\nRA')
+tailed_file.flush()
+print('new lines: %d, offset: %d' % (tailer.update(), tailer.offset))
+tailed_file.write('CH 2\n')
+tailed_file.flush()
+print('new lines: %d, offset: %d' % (tailer.update(), tailer.offset))
+print('new lines: %d, offset: %d' % (tailer.update(), tailer.offset))
+late_watch = tailer.watch(re.compile('RACH [0-9]'))
+print('late watch: count %d, last line %d %r' % (late_watch.count, late_watch.last_line_nr, late_watch.last_line))
+print('same watch without callback:', tailer.watch(late_watch.matcher) is late_watch)
+tailed_file.write('bar\nRACH 3')
+tailed_file.flush()
+print('new lines: %d' % tailer.update())
+tailed_file.close()
+tailer.close()
+print('after close: %d lines, watch counts %d and %d, last line %r'
+      % (tailer.lines, rach_watch.count, late_watch.count, late_watch.last_line))
+
+print('- grep non-ASCII and long output')
+tailer_path = tmpdir.new_child('long_output')
+with open(tailer_path, 'w', encoding='utf-8') as f:
+    f.write('foo bar 1\n')
+    f.write('baz äbc 2\n')
+    f.write('naïve 3\r\n')
+    f.write('ÄRGER 4\n')
+    for i in range(5, 3001):
+        f.write('line %d\n' % i)
+tailer = process.OutputTailer(tailer_path)
+for regex in (r'baz \w', r'na.ve', r'\A3', r'^na', r'[^a]bc', r'(?i)ärger', r've 3$',
+              r'\bve\b', r'line 10(24|25)$', r'line 2999\Z'):
+    print('grep %r: %r' % (regex, tailer.grep(regex)))
+mark = tailer.mark(2)
+print('mark(2) at line %d' % mark.line_nr)
+print('grep since mark(2): %r' % tailer.grep(r'[0-9]$', since_mark=mark)[:3])
+mark = tailer.mark(2500)
+print('mark(2500) at line %d' % mark.line_nr)
+print('grep since mark(2500): %r' % tailer.grep(r'line 250[0-2]|ä', since_mark=mark))
+print('grep since end: %r' % tailer.grep(r'line', since_mark=tailer.mark()))
+
 print('done.')
 
 test_ssh = True
@@ -4,12 +4,13 @@ import tempfile
 import os
 import sys
 import pprint
+import socket
 import shutil
 import atexit
 import time
 import threading
 import _prep
-from osmo_gsm_tester.core import config, log, util, resource
+from osmo_gsm_tester.core import config, log, util, resource, reservation_broker
 from osmo_gsm_tester.core.schema import generate_schemas
 
 workdir = util.get_tempdir()
@@ -49,6 +50,29 @@ try:
 except resource.NotSolvable as e:
     print(e)
 
+print('- solve on synthetic 1000-resource pools:')
+def bench_solve(label, all_matches):
+    t = time.time()
+    try:
+        solution = resource.solve(all_matches)
+        assert len(set(solution)) == len(all_matches)
+        assert all([solution[i] in all_matches[i] for i in range(len(all_matches))])
+        result = 'solved, first picks %r' % solution[:4]
+    except resource.NotSolvable:
+        result = 'not solvable'
+    elapsed = time.time() - t
+    print('%s: %s%s' % (label, result, '' if elapsed < 5 else ' (too slow: %.1fs)' % elapsed))
+
+pool = list(range(1000))
+gprs = [i for i in pool if i % 3 == 0]
+sim = [i for i in pool if i % 10 == 0]
+bench_solve('1000 of 1000 unconstrained', [pool] * 1000)
+bench_solve('200 of 1000, constrained first', [gprs] * 50 + [pool] * 150)
+bench_solve('200 of 1000, constrained last', [pool] * 150 + [gprs] * 50)
+bench_solve('600 of 1000, constrained last', [pool] * 300 + [gprs] * 300)
+bench_solve('601 of 1000, 101 of 100 constrained', [pool] * 500 + [sim] * 101)
+bench_solve('1001 of 1000', [pool] * 1001)
+
 print('- test removing a Resources list from itself')
 try:
     r = resource.Resources({ 'k': [ {'a': 1, 'b': 2}, {'a': 3, 'b': 4}, ],
@@ -129,11 +153,20 @@ subset =  { 'unordered_list_set': [4] }
 if not resource.item_matches(superset, subset):
     print('4th subset should not match, pass')
 
+print('- index candidates:')
+index = pool.all_resources.index()
+print(index.candidates('bts', {'type': 'osmo-bts-trx'}))
+print(index.candidates('bts', {'type': 'osmo-bts-trx', 'osmo_trx': {'launch_trx': 'False'}}))
+print(index.candidates('bts', {'type': 'osmo-bts-octphy'}))
+print(index.candidates('modem', {'ciphers': ['a5_1']}))
+print(index.candidates('modem', {'ciphers': []}))
+print(index.candidates('modem', {}))
+
 print('*** concurrent allocation:')
 origin1 = log.Origin(None, 'testowner1')
 origin2 = log.Origin(None, 'testowner2')
-# We disable dbg() for second thread since FileWatch output result is
-# non-deterministic, since sometimes 1 Modiffied event is triggered, sometimes 2.
+# We disable dbg() for both instances since their output would interleave
+# non-deterministically.
 origin1.dbg = origin2.dbg = lambda obj, *messages, _src=3, **named_items: None
 resources2 = None
 def second_ogt_instance():
@@ -151,4 +184,147 @@ resources.free()
 th.join()
 print('*** end: concurrent allocation')
 
+print('*** reservation broker:')
+# Serve the broker from this thread, so that output is deterministic.
+log.set_all_levels(log.L_LOG)
+broker = reservation_broker.Broker(pool)
+broker.start()
+def serve():
+    for i in range(5):
+        broker.serve_once(0)
+def broker_request(origin_id, want, priority=0):
+    conn = reservation_broker.connect(broker.path)
+    conn.send(op='reserve', origin_id=origin_id, want=want, priority=priority)
+    serve()
+    return conn
+def granted_items(conn):
+    msg = conn.recv(1)
+    print(msg.get('op'), sorted((kind, len(items)) for kind, items in msg.get('reserved', {}).items()))
+    return msg.get('reserved')
+
+print('- impossible request is rejected')
+c = broker_request('brokertest0', {'modem': [{}] * 5})
+print(c.recv(1))
+
+print('- A gets three of four modems')
+a = broker_request('brokertestA', {'modem': [{}] * 3})
+a_reserved = granted_items(a)
+
+print('- B waits for all four modems')
+b = broker_request('brokertestB', {'modem': [{}] * 4})
+print(b.recv(1))
+
+print('- C would fit, but may not overtake B')
+c = broker_request('brokertestC', {'modem': [{}]})
+print(c.recv(1))
+
+print('- D wants no modem, so it goes ahead')
+d = broker_request('brokertestD', {'ip_address': [{}]})
+d_reserved = granted_items(d)
+pool.release(d_reserved)
+serve()
+
+print('- A frees, B gets its modems')
+pool.release(a_reserved)
+serve()
+b_reserved = granted_items(b)
+print('depth', broker.stats()['depth'])
+
+print('- E has a higher priority than C')
+e = broker_request('brokertestE', {'modem': [{}]}, priority=5)
+print(e.recv(1))
+
+print('- F gives up waiting')
+f = broker_request('brokertestF', {'modem': [{}]})
+print(f.recv(1))
+f.close()
+serve()
+print('depth', broker.stats()['depth'])
+
+print('- G hangs up before being told it is queued')
+g = reservation_broker.connect(broker.path)
+g.send(op='reserve', origin_id='brokertestG', want={'modem': [{}]})
+g.close()
+serve()
+print('depth', broker.stats()['depth'])
+
+print('- B frees, E and C get modems')
+pool.release(b_reserved)
+serve()
+e_reserved = granted_items(e)
+c_reserved = granted_items(c)
+pool.release(e_reserved)
+pool.release(c_reserved)
+serve()
+
+stats = broker.stats()
+print(dict((k, stats[k]) for k in ('depth', 'requests', 'granted', 'rejected', 'abandoned')))
+broker.cleanup()
+log.set_all_levels(log.L_DBG)
+print('*** end: reservation broker')
+
+print('*** persistent values:')
+msisdn_path = state_dir.child('last_used_msisdn.state')
+if os.path.exists(msisdn_path):
+    os.remove(msisdn_path)
+def last_used_msisdn():
+    with open(msisdn_path, 'r') as f:
+        return f.read()
+resource.ResourcesPool.PERSISTENT_VALUE_BLOCK = 4
+print(pool.next_msisdn(origin), pool.next_msisdn(origin))
+print('state dir:', last_used_msisdn())
+print(pool.next_msisdns(origin, 3))
+print('state dir:', last_used_msisdn())
+print('- unused values are returned')
+resource.ResourcesPool.return_unused_persistent_values()
+print('state dir:', last_used_msisdn())
+print(pool.next_msisdn(origin))
+print('- unless another instance took values meanwhile')
+with open(msisdn_path, 'w') as f:
+    f.write('2000')
+resource.ResourcesPool.return_unused_persistent_values()
+print('state dir:', last_used_msisdn())
+print(pool.next_msisdns(origin, 6))
+print('state dir:', last_used_msisdn())
+print('*** end: persistent values')
+
+print('*** zmq ports:')
+print(config.get_zmq_port_range())
+zmq_origin = log.Origin(None, 'zmqowner')
+zmq_origin.dbg = lambda obj, *messages, _src=3, **named_items: None
+resources = pool.reserve(origin, config.replicate_times({'modem': [{}]}), {})
+print(pool.next_zmq_port_range(zmq_origin, 4), pool.next_zmq_port_range(zmq_origin, 3))
+print('- ports in use on this host are skipped')
+busy_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+busy_sock.bind(('', 52009))
+busy_sock.listen(1)
+print(pool.next_zmq_port_range(zmq_origin, 2))
+print('- no range left')
+try:
+    pool.next_zmq_port_range(zmq_origin, 6)
+except resource.NoResourceExn as e:
+    print('NoResourceExn:', e)
+busy_sock.close()
+print('- ports are released along with the reservation')
+resources.free()
+print(pool.db.leased_ports(*config.get_zmq_port_range()))
+print('- ports are released when the objects of each test are cleaned up')
+resources = pool.reserve(origin, config.replicate_times({'modem': [{}]}), {})
+for test_nr in range(6):
+    enb = log.Origin(None, 'enb')
+    ue = log.Origin(None, 'ue')
+    enb.dbg = ue.dbg = zmq_origin.dbg
+    ports = [pool.next_zmq_port_range(enb, 4), pool.next_zmq_port_range(enb, 2), pool.next_zmq_port_range(ue, 4)]
+    pool.release_ports_leased_by([enb, ue])
+print('test %d got %r' % (test_nr, ports))
+print(pool.db.leased_ports(*config.get_zmq_port_range()))
+resources.free()
+print('- ports leased without reservation are released on exit')
+unreserved_pool = resource.ResourcesPool()
+print(unreserved_pool.next_zmq_port_range(zmq_origin, 2))
+print(pool.db.leased_ports(*config.get_zmq_port_range()))
+unreserved_pool.release_port_leases()
+print(pool.db.leased_ports(*config.get_zmq_port_range()))
+print('*** end: zmq ports')
+
 # vim: expandtab tabstop=4 shiftwidth=4
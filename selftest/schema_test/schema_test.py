@@ -7,8 +7,9 @@ import os
 import io
 import pprint
 import copy
+import time
 
-from osmo_gsm_tester.core import config, log, schema
+from osmo_gsm_tester.core import config, log, schema, util
 
 def val(which, test_schema):
     try:
@@ -53,8 +54,52 @@ for f in get_case_list(_prep.script_dir):
             i += 1
     print('----------------------')
 
+print('==== Validating a 500 resources resources.conf ====')
+schema.generate_schemas()
+resources_schema = schema.get_resources_schema()
+resources_conf = config.read(os.path.join(_prep.script_dir, '..', 'resource_test', 'conf', 'resources.conf'))
+kinds = sorted(resources_conf.keys())
+resources = {}
+for i in range(500):
+    kind = kinds[i % len(kinds)]
+    items = resources.setdefault(kind, [])
+    items.append(copy.deepcopy(resources_conf[kind][len(items) % len(resources_conf[kind])]))
+print('resources:', sum(len(items) for items in resources.values()))
 
+val(resources, resources_schema)
+t = time.time()
+for i in range(100):
+    schema.validate(resources, resources_schema)
+elapsed = time.time() - t
+if elapsed > 5:
+    print('validating 100 times too slow: %.1fs' % elapsed)
 
+resources['modem'][-1]['imsi'] = 'not-an-imsi'
+val(resources, resources_schema)
+resources['modem'][-1]['imsi'] = '901700000009031'
+resources['bts'][-1]['no_such_key'] = '1'
+val(resources, resources_schema)
+del resources['bts'][-1]['no_such_key']
+resources['bts'][-1]['osmo_trx'] = ['a', 'b']
+val(resources, resources_schema)
 
+print('==== Lazy schema types of a module registering several ====')
+lazy_mod_dir = util.get_tempdir()
+with open(os.path.join(lazy_mod_dir, 'lazy_types_mod.py'), 'w') as f:
+    f.write('''from osmo_gsm_tester.core import schema
+def fruit(val):
+    print('fruit validated:', val)
+def veggie(val):
+    print('veggie validated:', val)
+def on_register_schemas():
+    print('lazy_types_mod imported')
+    schema.register_schema_types({'fruit': fruit, 'veggie': veggie})
+''')
+sys.path.insert(0, lazy_mod_dir)
+schema.replay_schemas('lazy_types_mod', [('types', ['fruit', 'veggie'])])
+schema.SCHEMA_TYPES['veggie']('leek')
+schema.SCHEMA_TYPES['fruit']('banana')
+schema.SCHEMA_TYPES['veggie']('kale')
+sys.path.remove(lazy_mod_dir)
 
 # vim: expandtab tabstop=4 shiftwidth=4
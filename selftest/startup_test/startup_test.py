@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import shutil
+import subprocess
+import _prep
+from osmo_gsm_tester.core import log
+from osmo_gsm_tester.core import schema
+
+workdir = os.path.dirname(os.path.abspath(sys.argv[0]))
+osmo_gsm_tester_py = os.path.join(_prep.src_dir, 'osmo-gsm-tester.py')
+cache_dir = os.path.join('test_work', 'startup_cache')
+
+# Seconds osmo-gsm-tester.py may take to start up:
+COLD_START_BUDGET = 10
+WARM_START_BUDGET = 5
+
+def start(label, budget):
+    t = time.time()
+    p = subprocess.run([sys.executable, osmo_gsm_tester_py,
+                        '-c', os.path.join(workdir, 'paths.conf'),
+                        '--config-cache', cache_dir,
+                        '--make-plan', '-',
+                        '-s', 'nitb_sms'],
+                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    elapsed = time.time() - t
+    print('%s (%.2f sec)%s' % (label, elapsed, '' if elapsed < budget else ' too slow'))
+    if p.returncode:
+        print(p.stdout.decode('utf-8'))
+    return p.stdout.decode('utf-8')
+
+def obj_modules():
+    return sorted(name for name in sys.modules if name.startswith('osmo_gsm_tester.obj.'))
+
+print('- startup of osmo-gsm-tester.py -s nitb_sms')
+shutil.rmtree(cache_dir, ignore_errors=True)
+print(start('cold start', COLD_START_BUDGET))
+start('warm start', WARM_START_BUDGET)
+print('schema manifest written:', os.path.isfile(os.path.join(cache_dir, schema.SCHEMA_MANIFEST_FILE)))
+
+print('- schemas from the manifest')
+schema.generate_schemas(cache_dir)
+print('object modules imported:', obj_modules())
+all_schema = schema.get_all_schema()
+print('bts[].osmo_trx.clock_reference:', all_schema['resources.bts[].osmo_trx.clock_reference'])
+print('iperf3cli.protocol:', all_schema['config.iperf3cli.protocol'])
+
+print('- lazily registered schema type')
+try:
+    schema.validate({'config': {'iperf3cli': {'protocol': 'foo'}}}, all_schema)
+except ValueError as e:
+    print('ValueError:', e)
+schema.validate({'config': {'iperf3cli': {'protocol': 'tcp'}}}, all_schema)
+print('iperf3 imported:', 'osmo_gsm_tester.obj.iperf3' in obj_modules())
+
+# vim: expandtab tabstop=4 shiftwidth=4
@@ -10,6 +10,7 @@ from osmo_gsm_tester.core import util
 from osmo_gsm_tester.core import report
 from osmo_gsm_tester.core import scenario
 from osmo_gsm_tester.core import suite
+from osmo_gsm_tester.core import trial as trial_module
 from osmo_gsm_tester.core.schema import generate_schemas, get_all_schema
 
 import xml.etree.ElementTree as et
@@ -23,6 +24,8 @@ class FakeTrial(log.Origin):
         super().__init__(log.C_TST, 'trial')
         self.dir = util.Dir(example_trial_dir)
         self._run_dir = None
+        self.suites = []
+        self.log_targets = None
 
     def get_run_dir(self):
         if self._run_dir is not None:
@@ -124,6 +127,62 @@ s = suite.SuiteRun(trial, 'suiteC', s_def)
 results = s.run_tests('test_template_overlay.py')
 print(report.suite_to_text(s))
 
+print('- run suites in worker processes')
+trial = FakeTrial()
+s_def = suite.load('test_suite')
+# both need the same resources, so they have to run one after the other:
+trial.suites = [suite.SuiteRun(trial, 'test_suite_%d' % i, s_def) for i in range(2)]
+log.set_all_levels(log.L_ERR)
+trial_module.SuiteRunScheduler(trial, 2).run(['hello_world.py'])
+log.set_all_levels(log.L_DBG)
+for s in trial.suites:
+    print(report.suite_to_text(s))
+    print(sorted(os.listdir(s.get_run_dir().path)))
+
+print('- run suites on disjoint resources in parallel')
+trial = FakeTrial()
+s_def = suite.load('suiteD')
+# only needing one modem each, both run at the same time:
+trial.suites = [suite.SuiteRun(trial, 'suiteD_%d' % i, s_def) for i in range(2)]
+# keep the output of concurrent workers out of the expected output:
+trial.log_targets = list(log.LogTarget.all_targets)
+log.set_all_levels(log.L_ERR)
+trial_module.SuiteRunScheduler(trial, 2).run(['test_sleep.py'])
+log.set_all_levels(log.L_DBG)
+s0, s1 = trial.suites
+print('statuses:', s0.status, s1.status)
+print('suites overlapped:', s0.start_timestamp < s1.start_timestamp + s1.duration
+                            and s1.start_timestamp < s0.start_timestamp + s0.duration)
+
+print('- resources of a killed worker are freed')
+trial = FakeTrial()
+trial.suites = [suite.SuiteRun(trial, 'suiteD_killed', s_def)]
+trial.log_targets = list(log.LogTarget.all_targets)
+log.set_all_levels(log.L_ERR)
+trial_module.SuiteRunScheduler(trial, 2).run(['test_killed.py'])
+log.set_all_levels(log.L_DBG)
+print('status:', trial.suites[0].status)
+print('reserved:', trial.suites[0].resources_pool.db.reserved())
+
+print('- workers are stopped when the scheduler is aborted')
+class AbortingScheduler(trial_module.SuiteRunScheduler):
+    def start_worker(self, suite_run, names):
+        super().start_worker(suite_run, names)
+        if len(self.running) == 2:
+            raise KeyboardInterrupt()
+trial = FakeTrial()
+trial.suites = [suite.SuiteRun(trial, 'suiteD_aborted_%d' % i, s_def) for i in range(2)]
+trial.log_targets = list(log.LogTarget.all_targets)
+scheduler = AbortingScheduler(trial, 2)
+log.set_all_levels(log.L_ERR)
+try:
+    scheduler.run(['test_sleep.py'])
+except KeyboardInterrupt:
+    print('aborted')
+log.set_all_levels(log.L_DBG)
+print('running:', scheduler.running)
+print('reserved:', trial.suites[0].resources_pool.db.reserved())
+
 print('\n- graceful exit.')
 #deleting generated tmp trial dir:
 shutil.rmtree(example_trial_dir, ignore_errors=True)
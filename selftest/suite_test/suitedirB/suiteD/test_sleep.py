@@ -0,0 +1,4 @@
+#!/usr/bin/env python3
+from osmo_gsm_tester.testenv import *
+
+sleep(1)
@@ -4,6 +4,7 @@ import _prep
 
 import sys
 import os
+import shutil
 
 from osmo_gsm_tester.core import template, log
 
@@ -101,4 +102,25 @@ print(template.render('osmo-bsc.cfg', dict(foo=dict(bar=dict(works='yes')))))
 print('- Testing: template directory overlay (present only on overlay dir)')
 print(template.render('mytemplate.cfg', dict(one=dict(two=dict(works='yes')))))
 
+print('- Testing: compiled templates are cached')
+template.cache_dir = os.path.join('test_work', 'template_cache')
+shutil.rmtree(template.cache_dir, ignore_errors=True)
+def cached_templates():
+    return sorted(f.split('.tmpl.')[0] for f in os.listdir(template.cache_dir) if f.endswith('.py'))
+template.set_templates_dir(template.default_templates_dir())
+rendered = template.render('osmo-nitb.cfg', vals)
+print(cached_templates())
+template.set_templates_dir(template.default_templates_dir())
+print('same result from cached template:', template.render('osmo-nitb.cfg', vals) == rendered)
+print('loaded from cache dir:', template._lookup.get_template('osmo-nitb.cfg.tmpl').module.__file__.startswith(os.path.abspath(template.cache_dir)))
+print(cached_templates())
+template.set_templates_dir(mytemplatedir, template.default_templates_dir())
+template.render('osmo-nitb.cfg', vals)
+print('separately cached with overlay dir:', cached_templates())
+
+print('- Testing: inline templates are compiled once')
+template.render_strbuf_inline('${a.b}', dict(a=dict(b='first')))
+print(template.render_strbuf_inline('${a.b}', dict(a=dict(b='second'))))
+print(len(template._inline_templates))
+
 # vim: expandtab tabstop=4 shiftwidth=4
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+import _prep
+import time
+import threading
+
+from osmo_gsm_tester.core import log
+from osmo_gsm_tester.testenv import ObjectsCleanup, TestEnv
+
+class FakeRunNode:
+    def __init__(self, addr):
+        self.addr = addr
+    def is_local(self):
+        return self.addr is None
+    def ssh_addr(self):
+        return self.addr
+    def adb_serial_id(self):
+        return None
+
+events = []
+events_lock = threading.Lock()
+
+class FakeObject:
+    def __init__(self, name, addr=None, after=()):
+        self.name = name
+        self.after = after
+        if addr is not None:
+            self.run_node = lambda: FakeRunNode(addr)
+    def cleanup(self):
+        with events_lock:
+            events.append(('start', self.name))
+        if hasattr(self, 'run_node'):
+            time.sleep(0.2)
+        with events_lock:
+            events.append(('end', self.name))
+    def cleanup_after(self):
+        return self.after
+
+def cleanup(objs):
+    del events[:]
+    c = ObjectsCleanup(objs)
+    print('steps:', ' | '.join([' + '.join([','.join([o.name for o in group]) for group in groups])
+                                for groups in c.steps]))
+    c.run()
+    return [name for ev, name in events if ev == 'end']
+
+def overlapping(a, b):
+    # b started before a ended, and the other way round
+    return (events.index(('start', b)) < events.index(('end', a))
+            and events.index(('start', a)) < events.index(('end', b)))
+
+print('- local objects are barriers between remote ones')
+# cleanup order of objects registered as epc, enb, ue1, ue2, iperf3 srv, iperf3 cli
+iperf_srv = FakeObject('iperf3-srv')
+iperf_cli = FakeObject('iperf3-cli')
+ue1 = FakeObject('ue1', '10.0.0.1')
+ue2 = FakeObject('ue2', '10.0.0.2')
+enb = FakeObject('enb', '10.0.0.3')
+epc = FakeObject('epc')
+order = cleanup([iperf_cli, iperf_srv, ue2, ue1, enb, epc])
+assert order.index('iperf3-srv') < order.index('ue1')
+assert order.index('iperf3-srv') < order.index('ue2')
+assert order.index('epc') == 5
+print('ue1, ue2, enb in parallel:', overlapping('ue1', 'ue2') and overlapping('ue2', 'enb'))
+
+print('- objects on the same node stay sequential')
+ue1b = FakeObject('ue1b', '10.0.0.1')
+order = cleanup([ue1, ue2, ue1b])
+print('ue1, ue1b in parallel:', overlapping('ue1', 'ue1b'))
+assert order.index('ue1') < order.index('ue1b')
+
+print('- cleanup_after() dependencies')
+enb = FakeObject('enb', '10.0.0.3')
+ue1 = FakeObject('ue1', '10.0.0.1', after=(enb,))
+order = cleanup([ue1, ue2, enb])
+print('ue1, enb in parallel:', overlapping('ue1', 'enb'))
+assert order.index('enb') < order.index('ue1')
+broker = FakeObject('broker')
+enb = FakeObject('enb', '10.0.0.3', after=(broker,))
+order = cleanup([enb, broker])
+assert order == ['broker', 'enb']
+
+print('- ZMQ ports of cleaned up objects are released')
+class FakePool:
+    def release_ports_leased_by(self, origins):
+        print('release ports leased by', [o.name() for o in origins])
+class FakeSuiteRun:
+    def resource_pool(self):
+        return FakePool()
+class FakeTest:
+    timeout = None
+    def name(self):
+        return 'fake_test'
+class FakeOriginObject(log.Origin):
+    def __init__(self, name):
+        super().__init__(log.C_TST, name)
+    def cleanup(self):
+        pass
+tenv = TestEnv(FakeSuiteRun(), FakeTest())
+tenv.register_for_cleanup(FakeOriginObject('enb'), FakeOriginObject('ue'), FakeObject('broker'))
+tenv.objects_cleanup()
+
+# vim: expandtab tabstop=4 shiftwidth=4
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# osmo-gsm-tester-broker.py: queue resource reservations of local instances
+#
+# Copyright (C) 2026 sysmocom - s.f.m.c. GmbH <info@sysmocom.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''osmo-gsm-tester-broker.py: serve resource reservations in fair order
+
+Examples:
+
+./osmo-gsm-tester-broker.py -c doc/examples/2g_osmocom/main.conf
+./osmo-gsm-tester-broker.py -c doc/examples/2g_osmocom/main.conf --stats
+
+Without a broker, osmo-gsm-tester instances sharing a state_dir each poll the
+reserved resources until the ones they want are available, and whichever
+instance looks first after a release wins.
+
+While a broker is running, it listens on 'broker.sock' in the state_dir and
+osmo-gsm-tester instances queue their reservations there instead. Requests are
+granted in order of their priority (see osmo-gsm-tester.py --priority) and
+arrival, a waiting request gaining priority the longer it waits. The broker
+reserves the resources on behalf of the waiting instance and notifies it right
+away.
+
+With --stats, print the current queue and wait time statistics of the running
+broker instead.
+'''
+
+import sys
+import pprint
+import argparse
+from signal import *
+from osmo_gsm_tester import __version__
+from osmo_gsm_tester.core import log
+from osmo_gsm_tester.core import config
+from osmo_gsm_tester.core import resource
+from osmo_gsm_tester.core import reservation_broker
+from osmo_gsm_tester.core.schema import generate_schemas
+
+def sig_handler_cleanup(signum, frame):
+    print("killed by signal %d" % signum)
+    sys.exit(1)
+
+def main():
+
+    for sig in (SIGINT, SIGTERM, SIGQUIT, SIGPIPE, SIGHUP):
+        signal(sig, sig_handler_cleanup)
+
+    parser = argparse.ArgumentParser(epilog=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-V', '--version', action='store_true',
+            help='Show version')
+    parser.add_argument('-c', '--conf-path', dest='conf_path',
+            help='''Specify main configuration file path''')
+    parser.add_argument('--stats', action='store_true',
+            help='''Print statistics of the running broker and exit''')
+    parser.add_argument('-l', '--log-level', dest='log_level', choices=log.LEVEL_STRS.keys(),
+            default=None,
+            help='Set logging level for all categories (on stdout)')
+    parser.add_argument('-T', '--traceback', dest='trace', action='store_true',
+            help='Enable stdout logging of tracebacks')
+    args = parser.parse_args()
+
+    if args.version:
+        print(__version__)
+        exit(0)
+
+    # create a default log to stdout
+    log.LogTarget().style(all_origins_on_levels=(log.L_ERR, log.L_TRACEBACK), src=False)
+
+    if args.log_level:
+        log.set_all_levels(log.LEVEL_STRS.get(args.log_level))
+    if args.trace:
+        log.style_change(trace=True)
+    if args.conf_path:
+        config.override_conf = args.conf_path
+
+    if args.stats:
+        pprint.pprint(reservation_broker.query_stats(reservation_broker.socket_path(config.get_state_dir())))
+        return 0
+
+    # Generate supported schemas dynamically from objects:
+    generate_schemas()
+
+    broker = reservation_broker.Broker(resource.ResourcesPool())
+    broker.serve_forever()
+    return 0
+
+if __name__ == '__main__':
+    rc = 2
+    try:
+        rc = main()
+    except:
+        log.log_exn()
+        raise
+    exit(rc)
+
+# vim: expandtab tabstop=4 shiftwidth=4
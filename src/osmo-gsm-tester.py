@@ -27,6 +27,8 @@ Examples:
 ./osmo-gsm-tester.py -c doc/examples/2g_osmocom/main.conf ~/my_trial_dir/ -s osmo_trx
 ./osmo-gsm-tester.py -c doc/examples/2g_osmocom/main.conf ~/my_trial_dir/ -s sms_tests:dyn_ts+eu_band+bts_sysmo
 ./osmo-gsm-tester.py -c sysmocom/main.conf ~/my_trial_dir/ -s sms_tests/mo_mt_sms:bts_trx
+./osmo-gsm-tester.py -c sysmocom/main.conf --make-plan plan.conf -H ~/old_trials/ -j 4
+./osmo-gsm-tester.py -c sysmocom/main.conf ~/my_trial_dir/ -p plan.conf
 
 (The names for test suites and scenarios used in these examples must be defined
 by the osmo-gsm-tester configuration.)
@@ -66,6 +68,7 @@ package's directory: Upon launch, a '$trial_dir/run.<date>' directory will be
 created, which will collect logs and reports.
 '''
 
+import os
 import sys
 import argparse
 from signal import *
@@ -74,6 +77,9 @@ from osmo_gsm_tester.core import log
 from osmo_gsm_tester.core import trial
 from osmo_gsm_tester.core import suite
 from osmo_gsm_tester.core import config
+from osmo_gsm_tester.core import resource
+from osmo_gsm_tester.core import planner
+from osmo_gsm_tester.core import template
 from osmo_gsm_tester.core.schema import generate_schemas
 
 def sig_handler_cleanup(signum, frame):
@@ -120,6 +126,35 @@ Any test name that contains the given string is run.
 To get an exact match, prepend a "=" like
 "-t =my_exact_name". The ".py" suffix is always
 optional.''')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=None,
+            help='''Run up to this many suites at the same time,
+each in a separate process, as far as resources
+allow. By default, suites are run one after the
+other.''')
+    parser.add_argument('-p', '--plan', dest='plan',
+            help='''Run the suites of a plan written by --make-plan,
+in the planned order. Unless -j is passed, run as
+many at a time as planned.''')
+    parser.add_argument('--make-plan', dest='make_plan',
+            help='''Don't run anything, but plan in which order to
+run the suites to finish soonest with the resources
+in resources.conf, and write the plan to this path
+("-" for stdout). Suite durations are taken from
+the JUnit reports passed with --history. With -j,
+plan to run only that many suites at a time.''')
+    parser.add_argument('-H', '--history', dest='history', action='append',
+            default=[],
+            help='''JUnit report of an earlier trial run, or a
+directory to search for them, e.g. a trial dir.''')
+    parser.add_argument('-P', '--priority', dest='priority', type=int, default=0,
+            help='''Priority of resource reservations queued at a
+reservation broker (osmo-gsm-tester-broker.py), if
+one is running. Higher is served first.''')
+    parser.add_argument('--config-cache', dest='config_cache',
+            help='''Keep parsed configuration files, the
+schemas registered by object modules and compiled templates in this
+directory, to start and configure faster next time. Without it, all
+object modules are imported at startup.''')
     parser.add_argument('-l', '--log-level', dest='log_level', choices=log.LEVEL_STRS.keys(),
             default=None,
             help='Set logging level for all categories (on stdout)')
@@ -148,13 +183,20 @@ optional.''')
         log.style_change(src=True)
     if args.conf_path:
         config.override_conf = args.conf_path
-
-    if args.trial_dir is not None:
-        trial_dir = args.trial_dir
-    else:
-        trial_dir = config.get_main_config_value(config.CFG_TRIAL_DIR)
+    if args.config_cache:
+        config.cache_dir = args.config_cache
+        template.cache_dir = os.path.join(args.config_cache, 'templates')
+    resource.ResourcesPool.RESERVATION_PRIORITY = args.priority
 
     combination_strs = list(args.suite_scenario or [])
+    jobs = args.jobs
+
+    if args.plan:
+        plan_jobs, from_plan = planner.Plan.read(args.plan)
+        print(('Running suites planned in %r:\n  ' % args.plan) + ('\n  '.join(from_plan)))
+        combination_strs.extend(from_plan)
+        if jobs is None:
+            jobs = plan_jobs or len(from_plan)
 
     for suites_file in args.suites_file:
         suites_file = config.main_config_path_to_abspath(suites_file)
@@ -175,13 +217,25 @@ optional.''')
         raise RuntimeError('Need at least one suite:scenario to run')
 
     # Generate supported schemas dynamically from objects:
-    generate_schemas()
+    generate_schemas(config.cache_dir)
 
     # make sure all suite:scenarios exist
     suite_scenarios = []
     for combination_str in combination_strs:
         suite_scenarios.append(suite.load_suite_scenario_str(combination_str))
 
+    if args.make_plan:
+        durations = planner.SuiteDurations()
+        for path in args.history:
+            durations.read(path)
+        plan = planner.plan_suite_scenarios(resource.ResourcesPool(), suite_scenarios, durations, jobs)
+        if args.make_plan == '-':
+            print(config.tostr(plan.to_conf()))
+        else:
+            plan.write(args.make_plan)
+            print('Plan taking %ds written to %r' % (plan.duration(), args.make_plan))
+        return 0
+
     # pick tests and make sure they exist
     test_names = []
     for test_name in (args.test or []):
@@ -203,11 +257,16 @@ optional.''')
         test_names = sorted(set(test_names))
         print(repr(test_names))
 
+    if args.trial_dir is not None:
+        trial_dir = args.trial_dir
+    else:
+        trial_dir = config.get_main_config_value(config.CFG_TRIAL_DIR)
+
     with trial.Trial(trial_dir) as current_trial:
         current_trial.verify()
         for suite_scenario_str, suite_def, scenarios in suite_scenarios:
             current_trial.add_suite_run(suite_scenario_str, suite_def, scenarios)
-        current_trial.run_suites(test_names)
+        current_trial.run_suites(test_names, jobs=jobs or 1)
 
         if current_trial.status != trial.Trial.PASS:
             return 1
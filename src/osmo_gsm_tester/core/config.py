@@ -54,7 +54,9 @@
 import yaml
 import os
 import copy
+import pickle
 import pprint
+import hashlib
 
 from . import log, util, template
 from . import schema
@@ -62,6 +64,12 @@ from .util import is_dict, is_list, Dir, get_tempdir
 
 override_conf = None
 
+# Directory to keep parsed config files in across runs, if set:
+cache_dir = None
+
+# The C implementation of the YAML parser is much faster, if available:
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 CFG_STATE_DIR = 'state_dir'
 CFG_SUITES_DIR = 'suites_dir'
 CFG_SCENARIOS_DIR = 'scenarios_dir'
@@ -69,6 +77,7 @@ CFG_TRIAL_DIR = 'trial_dir'
 CFG_DEFAULT_SUITES_CONF = 'default_suites_conf_path'
 CFG_DEFAULTS_CONF = 'defaults_conf_path'
 CFG_RESOURCES_CONF = 'resource_conf_path'
+CFG_ZMQ_PORT_RANGE = 'zmq_port_range'
 MAIN_CONFIG_SCHEMA = {
         CFG_STATE_DIR: schema.STR,
         CFG_SUITES_DIR + '[]': schema.STR,
@@ -77,8 +86,13 @@ MAIN_CONFIG_SCHEMA = {
         CFG_DEFAULT_SUITES_CONF: schema.STR,
         CFG_DEFAULTS_CONF: schema.STR,
         CFG_RESOURCES_CONF: schema.STR,
+        CFG_ZMQ_PORT_RANGE + '.first': schema.UINT,
+        CFG_ZMQ_PORT_RANGE + '.last': schema.UINT,
     }
 
+# Main config values that are no paths:
+MAIN_CONFIG_NON_PATHS = (CFG_ZMQ_PORT_RANGE,)
+
 DF_CFG_STATE_DIR = '/var/tmp/osmo-gsm-tester/state/'
 DF_CFG_SUITES_DIR = ['./suites']
 DF_CFG_SCENARIOS_DIR = ['./scenarios']
@@ -86,6 +100,7 @@ DF_CFG_TRIAL_DIR = './trial'
 DF_CFG_DEFAULT_SUITES_CONF = './default-suites.conf'
 DF_CFG_DEFAULTS_CONF = './defaults.conf'
 DF_CFG_RESOURCES_CONF = './resources.conf'
+DF_CFG_ZMQ_PORT_RANGE = {'first': '2000', 'last': '2199'}
 
 DEFAULT_CONFIG_FILENAME = 'main.conf'
 
@@ -147,9 +162,12 @@ def _get_main_config():
             CFG_DEFAULT_SUITES_CONF: DF_CFG_DEFAULT_SUITES_CONF,
             CFG_DEFAULTS_CONF: DF_CFG_DEFAULTS_CONF,
             CFG_RESOURCES_CONF: DF_CFG_RESOURCES_CONF,
+            CFG_ZMQ_PORT_RANGE: copy.deepcopy(DF_CFG_ZMQ_PORT_RANGE),
             }
         overlay(MAIN_CONFIG, cfg)
         for key, path in sorted(MAIN_CONFIG.items()):
+             if key in MAIN_CONFIG_NON_PATHS:
+                 continue
              MAIN_CONFIG[key] = main_config_path_to_abspath(path)
         log.dbg('MAIN CONFIG:\n' + pprint.pformat(MAIN_CONFIG), _category=log.C_CNF)
     return MAIN_CONFIG
@@ -182,24 +200,33 @@ def get_suites_dirs():
 def get_scenarios_dirs():
     return [Dir(d) for d in get_main_config_value(CFG_SCENARIOS_DIR)]
 
+def get_zmq_port_range():
+    'Return (first, last) port to use for ZMQ'
+    port_range = get_main_config_value(CFG_ZMQ_PORT_RANGE)
+    return int(port_range['first']), int(port_range['last'])
+
 DEFAULTS_CONF = None
 def get_defaults(for_kind):
+    '''Return the defaults.conf settings for for_kind, as a writable view
+    sharing the unmodified parts with all other callers, see util.cow_view()'''
     global DEFAULTS_CONF
     if DEFAULTS_CONF is None:
-        DEFAULTS_CONF = read_config_file(CFG_DEFAULTS_CONF, if_missing_return={})
-    defaults = DEFAULTS_CONF.get(for_kind, {})
-    return copy.deepcopy(defaults)
+        DEFAULTS_CONF = util.freeze(read_config_file(CFG_DEFAULTS_CONF, if_missing_return={}))
+    return util.cow_view(DEFAULTS_CONF.get(for_kind, util.FrozenDict()))
 
 def read(path, validation_schema=None, if_missing_return=False):
     log.ctx(path)
     if not os.path.isfile(path) and if_missing_return is not False:
         return if_missing_return
-    with open(path, 'r') as f:
-        config = yaml.safe_load(f)
-    config = _standardize(config)
-    if config and validation_schema:
-        schema.validate(config, validation_schema)
-    return config
+    st = os.stat(path)
+    def load():
+        with open(path, 'r') as f:
+            config = _standardize(yaml.load(f, Loader=YamlLoader))
+        if config and validation_schema:
+            schema.validate(config, validation_schema)
+        return config
+    return _cached(('read', os.path.abspath(path), st.st_mtime_ns, st.st_size, _schema_digest(validation_schema)),
+                   load)
 
 def write(path, config):
     log.ctx(path)
@@ -207,12 +234,66 @@ def write(path, config):
         f.write(tostr(config))
 
 def fromstr(config_str, validation_schema=None):
-    config = yaml.safe_load(config_str)
-    config = _standardize(config)
-    if validation_schema is not None:
-        schema.validate(config, validation_schema)
+    def load():
+        config = _standardize(yaml.load(config_str, Loader=YamlLoader))
+        if validation_schema is not None:
+            schema.validate(config, validation_schema)
+        return config
+    return _cached(('fromstr', hashlib.sha1(config_str.encode('utf-8')).hexdigest(), _schema_digest(validation_schema)),
+                   load)
+
+_NOT_CACHED = object()
+_cache = {}
+# configs read again after being modified, or built from ever changing strings,
+# add new entries; start over once that many are cached:
+_CACHE_MAX = 256
+
+def _cached(key, load):
+    '''Return a writable view of the config cached for key, a tuple
+    identifying the content and the validation schema. Call load() to parse
+    and validate it if it isn't cached in memory or in cache_dir yet.'''
+    config = _cache.get(key, _NOT_CACHED)
+    if config is _NOT_CACHED:
+        cache_path = None
+        if cache_dir:
+            cache_path = os.path.join(cache_dir, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.pickle')
+            config = _cache_dir_read(cache_path, key)
+        if config is _NOT_CACHED:
+            config = load()
+            if cache_path:
+                _cache_dir_write(cache_path, key, config)
+        config = util.freeze(config)
+        if len(_cache) >= _CACHE_MAX:
+            _cache.clear()
+        _cache[key] = config
+    return util.cow_view(config)
+
+def _cache_dir_read(cache_path, key):
+    try:
+        with open(cache_path, 'rb') as f:
+            cached_key, config = pickle.load(f)
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        return _NOT_CACHED
+    if cached_key != key:
+        return _NOT_CACHED
     return config
 
+def _cache_dir_write(cache_path, key, config):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((key, config), f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # the cache is only an optimization
+        pass
+
+def _schema_digest(validation_schema):
+    if not validation_schema:
+        return None
+    return hashlib.sha1(repr(sorted(validation_schema.items())).encode('utf-8')).hexdigest()
+
 def tostr(config):
     return _tostr(_standardize(config))
 
@@ -229,30 +310,41 @@ def _standardize_item(item):
     return str(item)
 
 def _standardize(config):
-    config = yaml.safe_load(_tostr(_standardize_item(config)))
-    return config
+    return _standardize_item(config)
 
 def overlay(dest, src):
+    '''Merge src into dest and return the result, which is dest modified in
+    place, or a writable view of dest if it is frozen. Only the parts of a
+    frozen dest that src changes get copied, and frozen parts of src end up
+    in dest as views, see util.cow_view().'''
+    dest = util.cow_view(dest)
     if is_dict(dest):
         if not is_dict(src):
             raise ValueError('cannot combine dict with a value of type: %r' % type(src))
 
-        for key, val in src.items():
-            log.ctx(key=key)
-            dest_val = dest.get(key)
-            dest[key] = overlay(dest_val, val)
+        # read src as it is, without copying its frozen parts:
+        for key, val in dict.items(src):
+            try:
+                dest[key] = overlay(dest.get(key), val)
+            except Exception:
+                log.ctx(key=key)
+                raise
         return dest
     if is_list(dest):
         if not is_list(src):
             raise ValueError('cannot combine list with a value of type: %r' % type(src))
+        src = list.copy(src) if isinstance(src, list) else list(src)
         copy_len = min(len(src),len(dest))
         for i in range(copy_len):
-            log.ctx(idx=i)
-            dest[i] = overlay(dest[i], src[i])
+            try:
+                dest[i] = overlay(dest[i], src[i])
+            except Exception:
+                log.ctx(idx=i)
+                raise
         for i in range(copy_len, len(src)):
-            dest.append(src[i])
+            dest.append(util.cow_view(src[i]))
         return dest
-    return src
+    return util.cow_view(src)
 
 def replicate_times(d):
     '''
@@ -261,16 +353,19 @@ def replicate_times(d):
     'd' is a dict matching WANT_SCHEMA, which is the same as
     the RESOURCES_SCHEMA, except each entity that can be reserved has a 'times'
     field added, to indicate how many of those should be reserved.
+
+    The replicated items are writable views sharing one frozen copy of the
+    original item, see util.cow_view().
     '''
-    d = copy.deepcopy(d)
+    replicated = {}
     for key, item_list in d.items():
-        idx = 0
-        while idx < len(item_list):
-            item = item_list[idx]
-            times = int(item.pop('times', 1))
-            for j in range(1, times):
-                item_list.insert(idx + j, copy.deepcopy(item))
-            idx += times
-    return d
+        replicated[key] = []
+        for item in item_list:
+            item = util.freeze(item)
+            for j in range(max(int(item.get('times', 1)), 1)):
+                view = util.cow_view(item)
+                view.pop('times', None)
+                replicated[key].append(view)
+    return replicated
 
 # vim: expandtab tabstop=4 shiftwidth=4
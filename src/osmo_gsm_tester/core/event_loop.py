@@ -17,10 +17,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import time
-from gi.repository import GLib, GObject
-
+import threading
 from . import log
+from .util import LazyModule
+
+# Only imported once an event loop is actually used:
+GLib = LazyModule('gi.repository.GLib')
+GObject = LazyModule('gi.repository.GObject')
+Gio = LazyModule('gi.repository.Gio')
 
 class DeferredHandling:
 
@@ -37,7 +43,7 @@ class DeferredHandling:
 
 class WaitRequest:
 
-    def __init__(self, condition, condition_args, condition_kwargs, timeout, timestep):
+    def __init__(self, condition, condition_args, condition_kwargs, timeout, timestep, wakeup_seq=0):
         self.timeout_ack = False
         self.condition_ack = False
         self.timeout_started = time.time()
@@ -45,6 +51,8 @@ class WaitRequest:
         self.condition = condition
         self.condition_args = condition_args
         self.condition_kwargs = condition_kwargs
+        # last EventLoop wakeup sequence number this request has evaluated:
+        self.wakeup_seq = wakeup_seq
 
     def condition_check(self):
         #print("_wait_condition_check")
@@ -58,9 +66,22 @@ class EventLoop:
 
     def __init__(self):
         self.poll_funcs = []
-        self.gloop = GLib.MainLoop()
-        self.gctx = self.gloop.get_context()
+        self.fd_watches = []
+        self.file_watches = {}
+        # created on first use, see main_context():
+        self.gloop = None
+        self.gctx = None
         self.deferred_handling = DeferredHandling()
+        self.wakeup_seq = 0
+        self.wakeup_cond = threading.Condition()
+        # Only the thread creating the loop iterates it, see wait_no_raise()
+        self.owner_thread = threading.current_thread()
+
+    def main_context(self):
+        if self.gctx is None:
+            self.gloop = GLib.MainLoop()
+            self.gctx = self.gloop.get_context()
+        return self.gctx
 
     def _trigger_cb_func(self, user_data):
             self.defer(user_data)
@@ -81,21 +102,137 @@ class EventLoop:
                 self.poll_funcs.remove(pair)
                 return
 
+    def wakeup(self):
+        '''Announce that something a wait() condition may depend on has
+        happened (data arrived on an fd, a child exited, a watched log line
+        was written, ...). All ongoing wait() calls re-evaluate their
+        condition immediately instead of at their next timestep. Can be called
+        from any thread.'''
+        with self.wakeup_cond:
+            self.wakeup_seq += 1
+            self.wakeup_cond.notify_all()
+        self.main_context().wakeup()
+
+    def _fd_watch_cb(self, fd, condition, func):
+        keep = func(fd, condition)
+        self.wakeup()
+        return keep is not False
+
+    def register_fd_watch(self, fd, func):
+        '''Call func(fd, condition) from the event loop whenever fd becomes
+        readable or is hung up, and wake up waiters afterwards. The watch is
+        kept until func returns False or unregister_fd_watch() is called.'''
+        id = GLib.io_add_watch(fd, GLib.PRIORITY_DEFAULT,
+                               GLib.IO_IN | GLib.IO_PRI | GLib.IO_HUP | GLib.IO_ERR,
+                               self._fd_watch_cb, func)
+        self.fd_watches.append((fd, func, id))
+        return id
+
+    def unregister_fd_watch(self, fd, func=None):
+        for watch in self.fd_watches:
+            f, fn, id = watch
+            if f == fd and (func is None or fn == func):
+                GObject.source_remove(id)
+                self.fd_watches.remove(watch)
+                return
+
+    def _file_watch_cb(self, monitor, file, other_file, event_type, func):
+        if event_type in (Gio.FileMonitorEvent.CHANGED, Gio.FileMonitorEvent.CREATED):
+            func(file.get_path())
+            self.wakeup()
+
+    def register_file_watch(self, path, func, rate_limit_ms=50):
+        '''Call func(path) from the event loop whenever the file at path is
+        written to (at most once every rate_limit_ms), and wake up waiters
+        afterwards. Used to follow process output files.'''
+        self.unregister_file_watch(path)
+        monitor = Gio.File.new_for_path(path).monitor_file(Gio.FileMonitorFlags.NONE, None)
+        monitor.set_rate_limit(rate_limit_ms)
+        monitor.connect('changed', self._file_watch_cb, func)
+        self.file_watches[path] = monitor
+
+    def unregister_file_watch(self, path):
+        monitor = self.file_watches.pop(path, None)
+        if monitor is not None:
+            monitor.cancel()
+
+    def _child_watch_pidfd_cb(self, fd, condition, pid, func):
+        os.close(fd)
+        func(pid, None)
+        self.wakeup()
+        return False # one-shot
+
+    def _child_watch_cb(self, pid, status, func):
+        if os.WIFSIGNALED(status):
+            exitcode = -os.WTERMSIG(status)
+        else:
+            exitcode = os.WEXITSTATUS(status)
+        func(pid, exitcode)
+        self.wakeup()
+
+    def register_child_watch(self, pid, func):
+        '''Call func(pid, exitcode) from the event loop as soon as child
+        process pid exits, and wake up waiters afterwards. If a pidfd can be
+        obtained, the child is left for the caller to reap and exitcode is
+        None. Otherwise a GLib child watch (SIGCHLD based) reaps the child and
+        exitcode holds the value subprocess.Popen.poll() would have returned.
+        func is called from within the GLib dispatch and must not raise, use
+        defer() for anything that may fail.'''
+        if hasattr(os, 'pidfd_open'):
+            try:
+                fd = os.pidfd_open(pid)
+            except ProcessLookupError:
+                # already gone and reaped by someone else
+                func(pid, None)
+                return
+            except OSError:
+                fd = None
+            if fd is not None:
+                GLib.io_add_watch(fd, GLib.PRIORITY_DEFAULT, GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+                                  self._child_watch_pidfd_cb, pid, func)
+                return
+        GLib.child_watch_add(GLib.PRIORITY_DEFAULT, pid, self._child_watch_cb, func)
+
+    def is_owner_thread(self):
+        return threading.current_thread() is self.owner_thread
+
     def poll(self, may_block=False):
-        self.gctx.iteration(may_block)
+        if not self.is_owner_thread():
+            return # served by the owner thread
+        self.main_context().iteration(may_block)
         self.deferred_handling.handle_queue()
 
+    def _wait_no_raise_thread(self, wait_req, timestep):
+        '''wait() from a helper thread: the owner thread keeps serving the event
+        loop (and thus event sources and deferred handlers), here we only
+        re-evaluate the condition on each wakeup() or timestep.'''
+        while True:
+            with self.wakeup_cond:
+                if wait_req.wakeup_seq == self.wakeup_seq:
+                    self.wakeup_cond.wait(timestep)
+                wait_req.wakeup_seq = self.wakeup_seq
+            wait_req.condition_check()
+            if wait_req.condition_ack or wait_req.timeout_ack:
+                return wait_req.condition_ack
+
     def wait_no_raise(self, condition, condition_args, condition_kwargs, timeout, timestep):
         if not timeout or timeout < 0:
             raise log.Error('wait() *must* time out at some point.', timeout=timeout)
         if timestep < 0.1:
             timestep = 0.1
 
-        wait_req = WaitRequest(condition, condition_args, condition_kwargs, timeout, timestep)
+        wait_req = WaitRequest(condition, condition_args, condition_kwargs, timeout, timestep, self.wakeup_seq)
+        if not self.is_owner_thread():
+            return self._wait_no_raise_thread(wait_req, timestep)
+        # Timestep polling is only a fallback for conditions nobody announces
+        # through wakeup(); event sources re-trigger the check right away.
         wait_id = GObject.timeout_add(timestep*1000, self._trigger_cb_func, wait_req.condition_check)
         while True:
             try:
                 self.poll(may_block=True)
+                if wait_req.wakeup_seq != self.wakeup_seq and not (wait_req.condition_ack or wait_req.timeout_ack):
+                    wait_req.wakeup_seq = self.wakeup_seq
+                    wait_req.condition_check()
             except Exception: # cleanup of temporary resources in the wait scope
                 GObject.source_remove(wait_id)
                 raise
@@ -0,0 +1,98 @@
+# osmo_gsm_tester: measure the time it takes to import modules
+#
+# Copyright (C) 2026 by sysmocom - s.f.m.c. GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import sys
+import subprocess
+
+from . import log
+
+# Modules imported by osmo-gsm-tester.py before it starts running suites:
+STARTUP_MODULES = (
+    'osmo_gsm_tester.core.log',
+    'osmo_gsm_tester.core.trial',
+    'osmo_gsm_tester.core.suite',
+    'osmo_gsm_tester.core.config',
+    'osmo_gsm_tester.core.resource',
+    'osmo_gsm_tester.core.planner',
+    'osmo_gsm_tester.core.schema',
+    )
+
+# Optional dependencies that are expensive to import, and are to be imported
+# only once they are actually used, see util.LazyModule:
+HEAVY_MODULES = ('gi', 'watchdog', 'mako', 'numpy', 'smpplib', 'pymongo', 'websocket', 'pydbus', 'dbus')
+
+# Lines written to stderr by python3 -X importtime, like
+# "import time:       562 |       2194 |   os"
+IMPORT_TIME_RE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)')
+
+class ImportTime:
+    '''Time in microseconds it took to import module_name, by itself and
+    including the modules it imported (cumulative). depth is 0 for modules
+    imported directly.'''
+
+    def __init__(self, module_name, self_us, cumulative_us, depth):
+        self.module_name = module_name
+        self.self_us = self_us
+        self.cumulative_us = cumulative_us
+        self.depth = depth
+
+    def __repr__(self):
+        return '%s: %d us (%d us cumulative)' % (self.module_name, self.self_us, self.cumulative_us)
+
+def measure(module_names, python=None):
+    '''Import module_names in a new python interpreter, return a list of
+    ImportTime of all modules it imported, in the order of completion.'''
+    src_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([src_dir] + [p for p in [env.get('PYTHONPATH')] if p])
+    code = ''.join('import %s\n' % module_name for module_name in module_names)
+    proc = subprocess.run([python or sys.executable, '-X', 'importtime', '-c', code],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env)
+    stderr = proc.stderr.decode('utf-8', errors='replace')
+    if proc.returncode != 0:
+        raise log.Error('Failed to import %r: %s' % (list(module_names), stderr.strip().splitlines()[-1:]))
+    import_times = []
+    for line in stderr.splitlines():
+        m = IMPORT_TIME_RE.fullmatch(line)
+        if m:
+            import_times.append(ImportTime(m.group(4), int(m.group(1)), int(m.group(2)), len(m.group(3)) // 2))
+    return import_times
+
+def total_us(import_times):
+    'Time it took to import everything, in microseconds'
+    return sum(it.cumulative_us for it in import_times if it.depth == 0)
+
+def imported_heavy_modules(import_times):
+    'Return the names of the HEAVY_MODULES packages imported'
+    return sorted(set(it.module_name.split('.')[0] for it in import_times
+                      if it.module_name.split('.')[0] in HEAVY_MODULES))
+
+def report(import_times, top=20):
+    '''Return lines describing import_times: total time, the modules taking
+    longest by themselves and the heavy modules imported.'''
+    lines = ['Importing %d modules took %.1f ms' % (len(import_times), total_us(import_times) / 1000.0)]
+    lines.append('Slowest %d by themselves:' % top)
+    slowest = sorted(import_times, key=lambda it: -it.self_us)[:top]
+    for it in slowest:
+        lines.append('  %8.1f ms %8.1f ms cumulative  %s' % (it.self_us / 1000.0, it.cumulative_us / 1000.0, it.module_name))
+    heavy = imported_heavy_modules(import_times)
+    lines.append('Heavy optional modules imported: %s' % (', '.join(heavy) if heavy else 'none'))
+    return lines
+
+# vim: expandtab tabstop=4 shiftwidth=4
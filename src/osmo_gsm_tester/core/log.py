@@ -23,6 +23,7 @@ import time
 import traceback
 import atexit
 import re
+import threading
 from datetime import datetime # we need this for strftime as the one from time doesn't carry microsecond info
 from inspect import getframeinfo, stack
 
@@ -71,17 +72,42 @@ def err(*messages, _origin=None, _category=None, _src=None, **named_items):
     _log(messages, named_items, origin=_origin, category=_category, level=L_ERR, src=_src)
 
 def _log(messages=[], named_items={}, origin=None, category=None, level=L_LOG, src=None):
+    # Most dbg() calls are logged by no target at all: skip looking up the
+    # origin, the source and composing the message for those.
+    if not is_enabled(None, level):
+        return
     if origin is None:
         origin = Origin.find_on_stack()
     if category is None and isinstance(origin, Origin):
         category = origin._log_category
+    if not is_enabled(category or C_DEFAULT, level):
+        return
     if src is None:
         # two levels up
         src = 2
     if isinstance(src, int):
         src = get_src_from_caller(src + 1)
+    message = compose_message(messages, named_items)
     for target in LogTarget.all_targets:
-        target.log(origin, category, level, src, messages, named_items)
+        target.log(origin, category, level, src, messages, named_items, message=message)
+
+def is_enabled(category, level):
+    '''Return whether any LogTarget logs level for category, or for any
+    category if None, to check before doing the costly parts of logging.'''
+    if level == L_TRACEBACK:
+        return any(target.do_log_traceback for target in LogTarget.all_targets)
+    return level >= lowest_level(category)
+
+def lowest_level(category=None):
+    '''Return the lowest level any LogTarget logs for category, or for any
+    category if None, cached until targets or their levels change.'''
+    level = LogTarget.lowest_levels.get(category)
+    if level is None:
+        levels = [target.lowest_level(category) for target in LogTarget.all_targets]
+        # without targets, nothing at all is logged:
+        level = min(levels) if levels else L_ERR + 1
+        LogTarget.lowest_levels[category] = level
+    return level
 
 
 LONG_DATEFMT = '%Y-%m-%d_%H:%M:%S.%f'
@@ -106,6 +132,9 @@ class Error(Exception):
 class LogTarget:
     all_targets = []
 
+    # cache of lowest_level() by category, see levels_changed()
+    lowest_levels = {}
+
     do_log_time = None
     do_log_category = None
     do_log_level = None
@@ -132,9 +161,15 @@ class LogTarget:
         self.category_levels = {}
         self.style()
         LogTarget.all_targets.append(self)
+        LogTarget.levels_changed()
 
     def remove(self):
         LogTarget.all_targets.remove(self)
+        LogTarget.levels_changed()
+
+    @staticmethod
+    def levels_changed():
+        LogTarget.lowest_levels = {}
 
     def style(self, time=True, time_fmt=DATEFMT, category=True, level=True, origin=True, origin_width=32, src=True, trace=False, all_origins_on_levels=(L_ERR, L_LOG, L_DBG, L_TRACEBACK)):
         '''
@@ -181,12 +216,25 @@ class LogTarget:
     def set_level(self, category, level):
         'set global logging log.L_* level for a given log.C_* category'
         self.category_levels[category] = level
+        LogTarget.levels_changed()
         return self
 
     def set_all_levels(self, level):
         self.all_levels = level
+        LogTarget.levels_changed()
         return self
 
+    def lowest_level(self, category=None):
+        'the lowest level logged for category, or for any category if None'
+        if self.all_levels is not None:
+            return self.all_levels
+        if category is None:
+            return min([L_LOG] + [level for level in self.category_levels.values() if level is not None])
+        level = self.category_levels.get(category)
+        if level is None:
+            return L_LOG
+        return level
+
     def is_enabled(self, category, level):
         if level == L_TRACEBACK:
             return self.do_log_traceback
@@ -200,7 +248,9 @@ class LogTarget:
             return False
         return True
 
-    def log(self, origin, category, level, src, messages, named_items):
+    def log(self, origin, category, level, src, messages, named_items, message=None):
+        '''Write a log line, unless level is disabled for category. message is
+        messages and named_items composed already, if passed.'''
         if category and len(category) != 3:
             self.log_write_func('WARNING: INVALID LOGGING CATEGORY %r\n' % category)
             self.log_write_func('origin=%r category=%r level=%r\n' % (origin, category, level));
@@ -237,7 +287,9 @@ class LogTarget:
         else:
             loglevel = ''
 
-        log_line = [compose_message(messages, named_items)]
+        if message is None:
+            message = compose_message(messages, named_items)
+        log_line = [message]
 
         if deeper_origins and (level in self.do_log_all_origins_on_levels):
             log_line.append(' [%s]' % deeper_origins)
@@ -265,6 +317,10 @@ class LogTarget:
             lines.insert(0, '')
         self.log_write_func('\n'.join(lines))
 
+    def flush(self):
+        # implemented in FileLogTarget
+        pass
+
     def get_mark(self):
         # implemented in FileLogTarget
         return 0
@@ -283,14 +339,6 @@ def level_str(level):
         return 'LOG'
     return 'ERR'
 
-def _log_all_targets(origin, category, level, src, messages, named_items=None):
-    if origin is None:
-        origin = Origin.find_on_stack()
-    if isinstance(src, int):
-        src = get_src_from_caller(src + 1)
-    for target in LogTarget.all_targets:
-        target.log(origin, category, level, src, messages, named_items)
-
 def large_separator(*msgs, sublevel=1, space_above=True):
     for target in LogTarget.all_targets:
         target.large_separator(*msgs, sublevel=sublevel, space_above=space_above)
@@ -501,13 +549,16 @@ class Origin:
 
     def dbg(self, *messages, _src=3, **named_items):
         '''same as log.dbg() but passes this object to skip looking up an origin'''
-        dbg(*messages, _origin=self, _src=_src, **named_items)
+        if is_enabled(self._log_category or C_DEFAULT, L_DBG):
+            dbg(*messages, _origin=self, _src=_src, **named_items)
 
     def err(self, *messages, _src=3, **named_items):
         '''same as log.err() but passes this object to skip looking up an origin'''
         err(*messages, _origin=self, _src=_src, **named_items)
 
 def trace(exc_info=None, origin=None):
+    if not is_enabled(None, L_TRACEBACK):
+        return
     if exc_info is None:
         exc_info = sys.exc_info()
     if origin is None:
@@ -553,27 +604,79 @@ class TestsTarget(LogTarget):
         self.style(time=False, src=False, origin_width=0)
 
 class FileLogTarget(LogTarget):
-    'LogTarget to log to a file system path'
+    '''LogTarget to log to a file system path. Log lines are buffered and
+    written once FLUSH_SIZE characters are buffered or the oldest of them is
+    FLUSH_INTERVAL seconds old. That is checked on each log line and, with
+    background_flush, also by a thread, so that the file lags behind by no
+    more than FLUSH_INTERVAL. Errors and tracebacks are written right away,
+    as is everything before reading the file back or exiting.'''
+    FLUSH_SIZE = 64 * 1024
+    FLUSH_INTERVAL = 0.5
+
     log_file = None
 
-    def __init__(self, log_path):
+    def __init__(self, log_path, background_flush=True):
         atexit.register(self.at_exit)
         self.path = log_path
         self.log_file = open(log_path, 'a')
-        super().__init__(self.write_to_log_and_flush)
+        self.lock = threading.Lock()
+        self.buffered = []
+        self.buffered_len = 0
+        self.buffered_since = None
+        self.background_flush = background_flush
+        super().__init__(self.write_to_log_buffered)
+        if background_flush:
+            _start_flush_thread()
 
     def remove(self):
         super().remove()
-        self.log_file.close()
-        self.log_file = None
+        with self.lock:
+            self._flush()
+            self.log_file.close()
+            self.log_file = None
+
+    def log(self, origin, category, level, src, messages, named_items, message=None):
+        super().log(origin, category, level, src, messages, named_items, message=message)
+        if level in (L_ERR, L_TRACEBACK):
+            self.flush()
+
+    def write_to_log_buffered(self, msg):
+        with self.lock:
+            now = time.monotonic()
+            if self.buffered_since is None:
+                self.buffered_since = now
+            self.buffered.append(msg)
+            self.buffered_len += len(msg)
+            if self.buffered_len >= self.FLUSH_SIZE or now - self.buffered_since >= self.FLUSH_INTERVAL:
+                self._flush()
 
     def write_to_log_and_flush(self, msg):
-        self.log_file.write(msg)
+        with self.lock:
+            self.buffered.append(msg)
+            self._flush()
+
+    def _flush(self):
+        # with self.lock held
+        if not self.buffered or self.log_file is None:
+            return
+        self.log_file.write(''.join(self.buffered))
         self.log_file.flush()
+        self.buffered = []
+        self.buffered_len = 0
+        self.buffered_since = None
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def flush_if_due(self, now):
+        with self.lock:
+            if self.buffered_since is not None and now - self.buffered_since >= self.FLUSH_INTERVAL:
+                self._flush()
 
     def at_exit(self):
         if self.log_file is not None:
-            self.log_file.flush()
+            self.flush()
             self.log_file.close()
 
     def log_file_path(self):
@@ -582,6 +685,7 @@ class FileLogTarget(LogTarget):
     def get_mark(self):
         if self.path is None:
             return 0
+        self.flush()
         # return current file length
         with open(self.path, 'r') as logfile:
             return logfile.seek(0, 2)
@@ -589,11 +693,46 @@ class FileLogTarget(LogTarget):
     def get_output(self, since_mark=0):
         if self.path is None:
             return ''
+        self.flush()
         with open(self.path, 'r') as logfile:
             if since_mark:
                 logfile.seek(since_mark)
             return logfile.read()
 
+def flush():
+    '''Write out what the LogTargets buffer, e.g. before exiting without
+    running atexit handlers'''
+    for target in LogTarget.all_targets:
+        target.flush()
+
+_flush_thread = None
+
+def _start_flush_thread():
+    global _flush_thread
+    if _flush_thread is None:
+        _flush_thread = threading.Thread(target=_run_flush_thread, name='log flush', daemon=True)
+        _flush_thread.start()
+
+def _run_flush_thread():
+    while True:
+        time.sleep(FileLogTarget.FLUSH_INTERVAL)
+        now = time.monotonic()
+        for target in list(LogTarget.all_targets):
+            if isinstance(target, FileLogTarget) and target.background_flush:
+                target.flush_if_due(now)
+
+def _reset_after_fork():
+    # The child would write what the parent buffered once more, so that is
+    # flushed before forking. Neither the flush thread nor a lock it may
+    # hold survive in the child.
+    global _flush_thread
+    _flush_thread = None
+    for target in LogTarget.all_targets:
+        if isinstance(target, FileLogTarget):
+            target.lock = threading.Lock()
+
+os.register_at_fork(before=flush, after_in_child=_reset_after_fork)
+
 def run_logging_exceptions(func, *func_args, return_on_failure=None, **func_kwargs):
     try:
         return func(*func_args, **func_kwargs)
@@ -0,0 +1,184 @@
+# osmo_gsm_tester: plan the order of suite runs from earlier durations
+#
+# Copyright (C) 2026 by sysmocom - s.f.m.c. GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import statistics
+import xml.etree.ElementTree as et
+
+from . import log
+from . import config
+from . import suite
+from .resource import HASH_KEY, NoResourceExn
+
+# Assumed duration in seconds of suites that never ran before:
+DEFAULT_DURATION = 600
+
+class SuiteDurations:
+    '''Durations of earlier suite runs, as found in the JUnit reports written
+    by Trial.run_suites().'''
+
+    def __init__(self):
+        self.durations = {}
+
+    def add(self, suite_scenario_str, duration):
+        self.durations.setdefault(suite_scenario_str, []).append(duration)
+
+    def read_junit(self, path):
+        root = et.parse(path).getroot()
+        if root.tag != 'testsuites':
+            return
+        for testsuite in root.iter('testsuite'):
+            name = testsuite.get('name')
+            duration = testsuite.get('time')
+            # suites that never started have no time
+            if name and duration is not None:
+                self.add(name, float(duration))
+
+    def read(self, path):
+        '''Read the JUnit report at path, or all found below path if it is a
+        directory, like a trial dir or a directory of trial dirs.'''
+        if not os.path.isdir(path):
+            self.read_junit(path)
+            return
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith('.xml'):
+                    try:
+                        self.read_junit(os.path.join(dirpath, filename))
+                    except et.ParseError:
+                        # not all xml files are JUnit reports
+                        continue
+
+    def estimate(self, suite_scenario_str):
+        '''Return the median earlier duration of suite_scenario_str, or else
+        of the same suite on any scenarios, or else DEFAULT_DURATION.'''
+        durations = self.durations.get(suite_scenario_str)
+        if not durations:
+            suite_name, scenario_names = suite.parse_suite_scenario_str(suite_scenario_str)
+            durations = [d for name, name_durations in self.durations.items()
+                         if suite.parse_suite_scenario_str(name)[0] == suite_name
+                         for d in name_durations]
+        if not durations:
+            return DEFAULT_DURATION
+        return statistics.median(durations)
+
+class PlannedSuite:
+
+    def __init__(self, suite_scenario_str, want, duration):
+        self.suite_scenario_str = suite_scenario_str
+        self.want = want
+        self.duration = duration
+        self.start = None
+        self.hashes = None
+
+    def end(self):
+        return self.start + self.duration
+
+class Plan(log.Origin):
+    '''Suites in the order to run them in, with their expected start time
+    and duration, when running up to jobs of them at a time (unlimited if
+    None).'''
+
+    def __init__(self, jobs, planned_suites):
+        super().__init__(log.C_CNF, 'plan')
+        self.jobs = jobs
+        self.planned_suites = planned_suites
+
+    def duration(self):
+        return max([ps.end() for ps in self.planned_suites] or [0])
+
+    def suite_scenario_strs(self):
+        return [ps.suite_scenario_str for ps in self.planned_suites]
+
+    def to_conf(self):
+        return dict(jobs=self.jobs,
+                    duration=round(self.duration()),
+                    suites=[dict(suite=ps.suite_scenario_str,
+                                 start=round(ps.start),
+                                 duration=round(ps.duration))
+                            for ps in self.planned_suites])
+
+    def write(self, path):
+        config.write(path, self.to_conf())
+
+    @staticmethod
+    def read(path):
+        '''Return (jobs, [suite_scenario_str, ...]) from a plan written by
+        Plan.write(), jobs being None if unlimited.'''
+        conf = config.read(path)
+        jobs = conf.get('jobs')
+        return (int(jobs) if jobs is not None else None,
+                [entry['suite'] for entry in conf.get('suites') or []])
+
+def plan(all_resources, wanted, durations, jobs=None):
+    '''Plan the suites in wanted, a list of (suite_scenario_str, want), to
+    take as little time as possible on all_resources, a Resources of all
+    available resources, with SuiteDurations durations.
+
+    Finding the shortest schedule is NP-hard, so this simulates what
+    SuiteRunScheduler does with the suites handed over longest first: as
+    soon as resources or jobs become available, the first remaining suite
+    that fits is started. Running in the planned order thus reproduces the
+    plan as far as the durations hold.'''
+    origin = log.Origin(log.C_CNF, 'planner')
+    pending = []
+    for suite_scenario_str, want in wanted:
+        # Make sure each suite can run at all, raises NoResourceExn if not:
+        all_resources.find(origin, want, None, False, True, 'Verifying')
+        pending.append(PlannedSuite(suite_scenario_str, want, durations.estimate(suite_scenario_str)))
+    # longest first, otherwise in the order given:
+    pending.sort(key=lambda ps: -ps.duration)
+
+    planned = []
+    running = []
+    used = {}
+    now = 0
+    while pending:
+        for ps in list(pending):
+            if jobs and len(running) >= jobs:
+                break
+            try:
+                found = all_resources.find(origin, ps.want, do_copy=False, log_label=None, skip_hashes=used)
+            except NoResourceExn:
+                continue
+            ps.start = now
+            ps.hashes = dict((kind, set(item[HASH_KEY] for item in items)) for kind, items in found.items())
+            for kind, hashes in ps.hashes.items():
+                used.setdefault(kind, set()).update(hashes)
+            pending.remove(ps)
+            running.append(ps)
+            planned.append(ps)
+        # Nothing can be pending without anything running, since each suite
+        # fits into all resources on its own.
+        now = min(ps.end() for ps in running)
+        for ps in [ps for ps in running if ps.end() <= now]:
+            running.remove(ps)
+            for kind, hashes in ps.hashes.items():
+                used[kind] -= hashes
+    return Plan(jobs, planned)
+
+def plan_suite_scenarios(resources_pool, suite_scenarios, durations, jobs=None):
+    '''Like plan(), for suite_scenarios as returned by
+    suite.load_suite_scenario_str().'''
+    wanted = []
+    for suite_scenario_str, suite_def, scenarios in suite_scenarios:
+        suite_run = suite.SuiteRun(None, suite_scenario_str, suite_def, scenarios)
+        wanted.append((suite_scenario_str, suite_run.resource_requirements()))
+    return plan(resources_pool.all_resources, wanted, durations, jobs)
+
+# vim: expandtab tabstop=4 shiftwidth=4
@@ -18,9 +18,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-import time
+import mmap
+import bisect
 import subprocess
 import signal
+import threading
 from abc import ABCMeta, abstractmethod
 from datetime import datetime
 import re
@@ -53,56 +55,16 @@ class ParallelTerminationStrategy(TerminationStrategy):
         # Remove all processes that terminated!
         self._processes = list(filter(lambda proc: proc.is_running(poll_first), self._processes))
 
-    def _build_process_map(self):
-        """Builds a mapping from pid to process."""
-        self._process_map = {}
-        for process in self._processes:
-            pid = process.pid()
-            if pid is None:
-                continue
-            self._process_map[pid] = process
-
-    def _poll_once(self):
-        """Polls for to be collected children once."""
-        pid, result = os.waitpid(0, os.WNOHANG)
-        # Did some other process die?
-        if pid == 0:
-            return False
-        proc = self._process_map.get(pid)
-        if proc is None:
-            self.dbg("Unknown process with pid(%d) died." % pid)
-            return False
-        # Update the process state and forget about it
-        self.log("PID %d died..." % pid)
-        proc.result = result
-        proc.cleanup()
-        self._processes.remove(proc)
-        del self._process_map[pid]
-        return True
+    def _all_terminated(self):
+        self._prune_dead_processes(True)
+        return len(self._processes) == 0
 
     def _poll_for_termination(self, time_to_wait_for_term=5):
         """Waits for the termination of processes until timeout|all ended."""
-
-        wait_step = 0.001
-        waited_time = 0
-        while len(self._processes) > 0:
-            # Collect processes until there are none to be collected.
-            while True:
-                try:
-                    if not self._poll_once():
-                        break
-                except ChildProcessError:
-                    break
-
-            # All processes died and we can return before sleeping
-            if len(self._processes) == 0:
-                break
-            waited_time += wait_step
-            # make wait_step approach 1.0
-            wait_step = (1. + 5. * wait_step) / 6.
-            if waited_time >= time_to_wait_for_term:
-                break
-            time.sleep(wait_step)
+        # Child exit watches wake us up as soon as any of them dies. Don't reap
+        # with waitpid() here, that would steal the exit status from Popen.
+        MainLoop.wait_no_raise(self._all_terminated, [], {},
+                               timeout=time_to_wait_for_term, timestep=1)
 
     def terminate_all(self):
         num_processes = len(self._processes)
@@ -110,7 +72,6 @@ class ParallelTerminationStrategy(TerminationStrategy):
         if num_processes == 0:
             return
         self._prune_dead_processes(True)
-        self._build_process_map()
 
         # Iterate through all signals.
         for sig in [signal.SIGTERM, signal.SIGINT, signal.SIGKILL]:
@@ -124,6 +85,275 @@ class ParallelTerminationStrategy(TerminationStrategy):
                 return
 
 
+class LineWatch:
+    '''Running match state of a matcher against the lines of an OutputTailer.
+    matcher can be a substring, a compiled regex or a callable(line) returning
+    True on match. If given, callback(line_nr, line) is called for each
+    matching line.'''
+
+    def __init__(self, matcher, callback=None):
+        self.matcher = matcher
+        self.callback = callback
+        self.count = 0
+        self.last_line = None
+        self.last_line_nr = None
+        if isinstance(matcher, str):
+            self._match = lambda line: matcher in line
+        elif hasattr(matcher, 'search'):
+            self._match = matcher.search
+        else:
+            self._match = matcher
+
+    def feed(self, line_nr, line):
+        if not self._match(line):
+            return
+        self.count += 1
+        self.last_line = line
+        self.last_line_nr = line_nr
+        if self.callback is not None:
+            self.callback(line_nr, line)
+
+
+class OutputMark(int):
+    '''Position in a process output. It is the byte offset into the output
+    file (and can be used wherever an int offset is expected), and also knows
+    the amount of lines preceding it in line_nr.'''
+
+    def __new__(cls, offset, line_nr):
+        mark = super().__new__(cls, offset)
+        mark.line_nr = line_nr
+        return mark
+
+
+class OutputTailer:
+    '''Follows an output file of a process incrementally: each update() only
+    reads the bytes appended since the previous one and feeds the new complete
+    lines to all registered LineWatch objects.'''
+
+    CHUNK_SIZE = 1024 * 1024
+    INDEX_STEP = 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0 # bytes consumed so far, always at a line boundary
+        self.lines = 0 # number of lines consumed so far
+        # sparse line index: line_index[k] is the byte offset where line number
+        # k * INDEX_STEP + 1 starts.
+        self.line_index = [0]
+        self.watches = []
+        self.closed = False
+        self._update_deferred = False
+        # update() may run on the event loop thread while a cleanup thread
+        # (see testenv.ObjectsCleanup) also queries the output
+        self.lock = threading.RLock()
+
+    def _read_lines(self, start, end=None, final=False):
+        '''Yield (line, nbytes) for each complete line between byte offsets
+        start and end (EOF if None). If final, an unterminated last line is
+        yielded as well.'''
+        try:
+            f = open(self.path, 'rb')
+        except OSError:
+            return
+        with f:
+            f.seek(start)
+            pos = start
+            rest = b''
+            while end is None or pos < end:
+                size = OutputTailer.CHUNK_SIZE
+                if end is not None:
+                    size = min(size, end - pos)
+                data = f.read(size)
+                if not data:
+                    break
+                pos += len(data)
+                lines = (rest + data).split(b'\n')
+                rest = lines.pop()
+                for line in lines:
+                    yield line, len(line) + 1
+            if final and rest:
+                yield rest, len(rest)
+
+    @staticmethod
+    def _decode(line):
+        return line.decode('utf-8', errors='replace').rstrip('\r')
+
+    def update(self):
+        '''Consume output appended since last call. Returns the amount of new
+        lines.'''
+        with self.lock:
+            self._update_deferred = False
+            new_lines = 0
+            for line, nbytes in self._read_lines(self.offset, final=self.closed):
+                self.offset += nbytes
+                self.lines += 1
+                new_lines += 1
+                if self.lines % OutputTailer.INDEX_STEP == 0:
+                    self.line_index.append(self.offset)
+                if self.watches:
+                    line = self._decode(line)
+                    for watch in self.watches:
+                        watch.feed(self.lines, line)
+            return new_lines
+
+    def _file_changed(self, path):
+        if not self._update_deferred:
+            self._update_deferred = True
+            MainLoop.defer(self.update)
+
+    def watch(self, matcher, callback=None):
+        '''Return a LineWatch for matcher, fed with all lines already
+        consumed and all lines to come. Watches without callback are shared
+        among callers using the same matcher.'''
+        with self.lock:
+            if callback is None:
+                for watch in self.watches:
+                    if watch.callback is None and watch.matcher == matcher:
+                        return watch
+            watch = LineWatch(matcher, callback)
+            line_nr = 0
+            for line, nbytes in self._read_lines(0, self.offset, final=True):
+                line_nr += 1
+                watch.feed(line_nr, self._decode(line))
+            if not self.watches and not self.closed:
+                MainLoop.register_file_watch(self.path, self._file_changed)
+            self.watches.append(watch)
+            return watch
+
+    def _lines_before(self, mm, offset):
+        '''Amount of newlines in the file before byte offset, only scanning
+        from the closest line index entry on.'''
+        k = bisect.bisect_right(self.line_index, offset) - 1
+        base = self.line_index[k]
+        return k * OutputTailer.INDEX_STEP + mm[base:offset].count(b'\n')
+
+    def _line_start(self, mm, line_nr):
+        '''Byte offset where line line_nr (1-based) starts, or None if the
+        file doesn't have that many lines.'''
+        k = min((line_nr - 1) // OutputTailer.INDEX_STEP, len(self.line_index) - 1)
+        pos = self.line_index[k]
+        for i in range(line_nr - 1 - k * OutputTailer.INDEX_STEP):
+            pos = mm.find(b'\n', pos)
+            if pos == -1:
+                return None
+            pos += 1
+        return pos
+
+    def _mmap(self):
+        '''Return (file, mmap) of the output file, or None if it is missing
+        or empty.'''
+        try:
+            f = open(self.path, 'rb')
+        except OSError:
+            return None
+        if os.fstat(f.fileno()).st_size == 0:
+            f.close()
+            return None
+        return f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def mark(self, line_nr=None):
+        '''Return an OutputMark at the current end of output, or right after
+        line line_nr if given.'''
+        with self.lock:
+            self.update()
+            mapped = self._mmap()
+            if mapped is None:
+                return OutputMark(0, 0)
+            f, mm = mapped
+            with f, mm:
+                if line_nr is None:
+                    return OutputMark(len(mm), self._lines_before(mm, len(mm)))
+                offset = self._line_start(mm, line_nr + 1)
+                if offset is None:
+                    offset = len(mm)
+                    line_nr = self._lines_before(mm, offset)
+                return OutputMark(offset, line_nr)
+
+    # escapes meaning the same for str and ASCII bytes patterns, besides
+    # escaped punctuation
+    BYTES_SAFE_ESCAPES = 'ntrfv'
+
+    @staticmethod
+    def _bytes_regex(r):
+        '''Byte pattern used to find candidate lines for str regex r without
+        decoding the output, or None if it might miss lines r matches, so
+        that all lines are decoded and searched instead: '$' would not match
+        before a '\\r\\n' line ending, \\w, \\d, \\s, \\b, '.' and negated
+        character sets treat a multibyte UTF-8 character as several bytes,
+        \\A and \\Z mean the start and end of a line only in the line scan,
+        and IGNORECASE would not fold non-ASCII characters.'''
+        if not isinstance(r.pattern, str) or not r.pattern.isascii() or r.flags & re.IGNORECASE:
+            return None
+        pattern = r.pattern
+        i = 0
+        while i < len(pattern):
+            c = pattern[i]
+            if c == '\\':
+                escaped = pattern[i + 1:i + 2]
+                if escaped.isalnum() and escaped not in OutputTailer.BYTES_SAFE_ESCAPES:
+                    return None
+                i += 2
+                continue
+            if c in '.$' or pattern.startswith('[^', i):
+                return None
+            i += 1
+        try:
+            return re.compile(pattern.encode('ascii'), re.MULTILINE)
+        except re.error:
+            return None
+
+    def grep(self, regex, since_mark=0):
+        '''Return list of (line_nr, line) for lines matching regex, starting
+        at since_mark (byte offset or OutputMark). The file is searched through
+        mmap, only matching lines are decoded. Returns None if there is no
+        output after since_mark.'''
+        with self.lock:
+            self.update()
+            mapped = self._mmap()
+            if mapped is None:
+                return None
+            f, mm = mapped
+            with f, mm:
+                size = len(mm)
+                pos = since_mark
+                if pos >= size:
+                    return None
+                r = re.compile(regex)
+                finder = self._bytes_regex(r)
+                if isinstance(since_mark, OutputMark):
+                    line_nr = since_mark.line_nr + 1
+                else:
+                    line_nr = self._lines_before(mm, pos) + 1
+                matches = []
+                while pos < size:
+                    if finder is not None:
+                        m = finder.search(mm, pos)
+                        if m is None:
+                            break
+                        line_start = max(mm.rfind(b'\n', pos, m.start()) + 1, pos)
+                        if line_start != pos:
+                            line_nr = self._lines_before(mm, line_start) + 1
+                    else:
+                        line_start = pos
+                    line_end = mm.find(b'\n', line_start)
+                    if line_end == -1:
+                        line_end = size
+                    line = self._decode(mm[line_start:line_end])
+                    if r.search(line):
+                        matches.append((line_nr, line))
+                    pos = line_end + 1
+                    line_nr += 1
+                return matches
+
+    def close(self):
+        '''The writer is done, consume any unterminated last line too.'''
+        with self.lock:
+            self.closed = True
+            MainLoop.unregister_file_watch(self.path)
+            if self.watches:
+                self.update()
+
+
 class Process(log.Origin):
 
     DEFAULT_WAIT_TIMEOUT = 300 # seconds
@@ -139,6 +369,11 @@ class Process(log.Origin):
         self.popen_args = popen_args
         self.popen_kwargs = popen_kwargs
         self.outputs = {}
+        self.tailers = {}
+        self.exit_handlers = []
+        # poll() from the event loop and from cleanup threads must not both
+        # see the exit and clean up twice
+        self.lock = threading.RLock()
         if not isinstance(self.run_dir, Dir):
             self.run_dir = Dir(os.path.abspath(str(self.run_dir)))
 
@@ -162,16 +397,38 @@ class Process(log.Origin):
         f.write('(launched: %s)\n' % datetime.now().strftime(log.LONG_DATEFMT))
         f.flush()
         self.outputs[name] = (path, f)
+        self.tailers[name] = OutputTailer(path)
         return f
 
+    def output_watch(self, which, matcher, callback=None):
+        '''Return an up to date LineWatch (see OutputTailer.watch()) on the
+        given output of the current launch, or None if there's no such output.
+        Querying the same matcher again only costs reading the output written
+        in between. Example:
+
+          # number of lines containing 'RACH:' so far
+          n = proc.output_watch('stdout', 'RACH:').count
+        '''
+        tailer = self.tailers.get(which)
+        if tailer is None:
+            return None
+        watch = tailer.watch(matcher, callback)
+        tailer.update()
+        return watch
+
     def get_counter_stdout(self, keyword):
         # Match stdout against keyword
-        n = 0
-        stdout_lines = (self.get_stdout() or '').splitlines()
-        for l in stdout_lines:
-            if keyword in l:
-                n += 1
-        return n
+        watch = self.output_watch('stdout', keyword)
+        if watch is None:
+            return 0
+        return watch.count
+
+    def get_last_line_stdout(self, matcher):
+        'Return the most recent stdout line matching matcher, or None'
+        watch = self.output_watch('stdout', matcher)
+        if watch is None:
+            return None
+        return watch.last_line
 
     def launch(self):
         preexec_fn = None
@@ -200,6 +457,29 @@ class Process(log.Origin):
             **self.popen_kwargs)
         self.set_name(self.name_str, pid=self.process_obj.pid)
         self.log('Launched')
+        MainLoop.register_child_watch(self.process_obj.pid, self._child_exited)
+
+    def _child_exited(self, pid, exitcode):
+        'Called from the event loop as soon as the child process dies.'
+        if self.process_obj is None or self.process_obj.pid != pid:
+            return # stale watch of a previous (respawned) run
+        if exitcode is not None and self.process_obj.returncode is None:
+            # already reaped by the event loop, let Popen know
+            self.process_obj.returncode = exitcode
+        self.poll()
+        for handler in self.exit_handlers:
+            MainLoop.defer(handler, self)
+
+    def add_exit_handler(self, handler):
+        '''Call handler(process) from the event loop as soon as the process
+        exits. The handler may raise, the exception is then propagated out of
+        the ongoing MainLoop.wait().'''
+        if handler not in self.exit_handlers:
+            self.exit_handlers.append(handler)
+
+    def remove_exit_handler(self, handler):
+        if handler in self.exit_handlers:
+            self.exit_handlers.remove(handler)
 
     def launch_sync(self, raise_nonsuccess=True):
         '''
@@ -231,20 +511,9 @@ class Process(log.Origin):
         return self.launch_sync(raise_nonsuccess)
 
     def _poll_termination(self, time_to_wait_for_term=5):
-        wait_step = 0.001
-        waited_time = 0
-        while True:
-            # poll returns None if proc is still running
-            self.result = self.process_obj.poll()
-            if self.result is not None:
-                return True
-            waited_time += wait_step
-            # make wait_step approach 1.0
-            wait_step = (1. + 5. * wait_step) / 6.
-            if waited_time >= time_to_wait_for_term:
-                break
-            time.sleep(wait_step)
-        return False
+        # The child exit watch wakes us up right when the process dies:
+        return MainLoop.wait_no_raise(self.terminated, [], {},
+                                      timeout=time_to_wait_for_term, timestep=1)
 
     def send_signal(self, sig):
         os.kill(self.process_obj.pid, sig)
@@ -279,11 +548,10 @@ class Process(log.Origin):
 
             # out of patience
             self.kill(signal.SIGKILL)
+            self.process_obj.wait()
+            self.poll()
             break;
 
-        self.process_obj.wait()
-        self.cleanup()
-
     def cleanup(self):
         self.dbg('Cleanup')
         self.close_output_logs()
@@ -314,16 +582,18 @@ class Process(log.Origin):
             if f:
                 f.flush()
                 f.close()
+                self.tailers[k].close()
             self.outputs[k] = (path, None)
 
     def poll(self):
-        if self.process_obj is None:
-            return
-        if self.result is not None:
-            return
-        self.result = self.process_obj.poll()
-        if self.result is not None:
-            self.cleanup()
+        with self.lock:
+            if self.process_obj is None:
+                return
+            if self.result is not None:
+                return
+            self.result = self.process_obj.poll()
+            if self.result is not None:
+                self.cleanup()
 
     def is_running(self, poll_first=True):
         if poll_first:
@@ -365,7 +635,7 @@ class Process(log.Origin):
         tail = min(len(out), tail)
         return prefix + self.end_ansi_colors(('\n' + prefix).join(out[-tail:]))
 
-    def get_output_mark(self, which):
+    def get_output_mark(self, which, line_nr=None):
         '''Usage:
              # remember a start marker
              my_mark = my_process.get_output_mark('stderr')
@@ -374,29 +644,29 @@ class Process(log.Origin):
 
              my_log = my_process.get_output('stderr', since_mark=my_mark)
              # my_log contains the stderr of that process since the start marker.
+
+           The returned OutputMark is a byte offset which also knows its line
+           number (my_mark.line_nr); pass line_nr to get a mark right after
+           that line instead of at the end of output.
         '''
-        path = self.get_output_file(which)
-        if path is None:
+        tailer = self.tailers.get(which)
+        if tailer is None:
             return None
-        with open(path, 'r') as f:
-            return f.seek(0, 2)
+        return tailer.mark(line_nr)
 
     def grep_output(self, which, regex, since_mark=0, line_nrs=False):
-        lines = self.get_output(which, since_mark=since_mark).splitlines()
-        if not lines:
+        '''Return lines of output matching regex, optionally as (line_nr,
+        line) tuples. since_mark is a byte offset or a mark from
+        get_output_mark().'''
+        tailer = self.tailers.get(which)
+        if tailer is None:
             return None
-        matches = []
-        r = re.compile(regex)
-        line_nr = since_mark
-        for line in lines:
-            line_nr += 1
-            if r.search(line):
-                line = self.end_ansi_colors(line)
-                if line_nrs:
-                    matches.append((line_nr, line))
-                else:
-                    matches.append(line)
-        return matches
+        found = tailer.grep(regex, since_mark)
+        if found is None:
+            return None
+        if line_nrs:
+            return [(line_nr, self.end_ansi_colors(line)) for line_nr, line in found]
+        return [self.end_ansi_colors(line) for line_nr, line in found]
 
     def get_stdout(self, since_mark=0):
         return self.get_output('stdout', since_mark=since_mark)
@@ -436,7 +706,7 @@ class Process(log.Origin):
 class RemoteProcess(Process):
 
     def __init__(self, name, run_dir, remote_user, remote_host, remote_cwd, popen_args,
-                 remote_env={}, remote_port=None, **popen_kwargs):
+                 remote_env={}, remote_port=None, ssh_opts=(), **popen_kwargs):
         super().__init__(name, run_dir, popen_args, **popen_kwargs)
         self.remote_user = remote_user
         self.remote_host = remote_host
@@ -454,7 +724,7 @@ class RemoteProcess(Process):
         # We need double -t to force tty and be able to forward signals to
         # processes (SIGHUP) when we close ssh on the local side. As a result,
         # stderr seems to be merged into stdout in ssh client.
-        self.popen_args = ['ssh', '-t', '-t', self.remote_user+'@'+self.remote_host,
+        self.popen_args = ['ssh'] + list(ssh_opts) + ['-t', '-t', self.remote_user+'@'+self.remote_host,
                            '%s %s %s' % (cd,
                                          ' '.join(['%s=%r'%(k,v) for k,v in self.remote_env.items()]),
                                          ' '.join(self.popen_args))]
@@ -20,9 +20,307 @@
 import stat
 import os
 import re
+import shlex
 import pprint
+import atexit
+import shutil
+import tarfile
+import tempfile
+import threading
+import subprocess
 
 from . import log, util, config, template, process
+from .event_loop import MainLoop
+
+class SshConnectionPool(log.Origin):
+    '''Keep one ssh ControlMaster connection per (user, host, port) and have
+    all ssh/scp invocations towards that destination multiplex over it, so
+    only the first one pays for a full ssh handshake. Masters are started on
+    demand, before the first ssh call to a destination, as a process of their
+    own detached from the output of any ssh call, and closed by close_all(),
+    which is called at the end of each trial. If a master can't be started,
+    ssh calls to that destination connect directly.'''
+
+    # seconds an idle master lingers, in case close_all() is never reached:
+    CONTROL_PERSIST = 600
+    CHECK_TIMEOUT = 5
+    MASTER_TIMEOUT = 30
+
+    def __init__(self):
+        super().__init__(log.C_RUN, 'ssh-pool')
+        self.enabled = True
+        self.control_dir = None
+        self.control_paths = {}
+        # destinations whose master was started, or couldn't be started:
+        self.masters = set()
+        self.masters_failed = set()
+        self.atexit_registered = False
+
+    def control_path(self, user, host, port=None):
+        key = (user, host, port)
+        path = self.control_paths.get(key)
+        if path is None:
+            if self.control_dir is None:
+                # unix socket paths are limited to ~100 chars, stay short:
+                self.control_dir = tempfile.mkdtemp(prefix='ogt-ssh-')
+                if not self.atexit_registered:
+                    atexit.register(self.close_all)
+                    self.atexit_registered = True
+            path = os.path.join(self.control_dir, util.md5('%s@%s:%s' % key)[:16])
+            self.control_paths[key] = path
+        return path
+
+    def ssh_opts(self, user, host, port=None):
+        '''Return the options to pass to ssh/scp to use the pool'''
+        if not self.enabled or not self.start_master(user, host, port):
+            return []
+        # never let a regular call become the (long lived) master, it would
+        # keep the call's stdout and stderr open:
+        return ['-o', 'ControlMaster=no',
+                '-o', 'ControlPath=%s' % self.control_path(user, host, port)]
+
+    def start_master(self, user, host, port=None):
+        '''Start the master for the given destination unless it is running
+        already, return whether it is.'''
+        key = (user, host, port)
+        path = self.control_path(user, host, port)
+        if key in self.masters and os.path.exists(path):
+            return True
+        if key in self.masters_failed:
+            return False
+        if not self.check(user, host, port):
+            args = ['ssh', '-M', '-N', '-f',
+                    '-o', 'ControlPath=%s' % path,
+                    '-o', 'ControlPersist=%d' % SshConnectionPool.CONTROL_PERSIST]
+            if port:
+                args += ['-p', str(port)]
+            args.append('%s@%s' % (user, host))
+            self.dbg('Starting ssh master', '%s@%s' % (user, host))
+            try:
+                started = subprocess.run(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.DEVNULL,
+                                         timeout=SshConnectionPool.MASTER_TIMEOUT).returncode == 0
+            except (OSError, subprocess.TimeoutExpired):
+                started = False
+            if not started or not os.path.exists(path):
+                self.log('Unable to start ssh master, connecting directly', '%s@%s' % (user, host))
+                self.masters_failed.add(key)
+                return False
+        self.masters.add(key)
+        return True
+
+    def _ctl(self, cmd, user, host, port=None):
+        args = ['ssh', '-O', cmd, '-o', 'ControlPath=%s' % self.control_path(user, host, port)]
+        if port:
+            args += ['-p', str(port)]
+        args.append('%s@%s' % (user, host))
+        try:
+            return subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                  timeout=SshConnectionPool.CHECK_TIMEOUT).returncode == 0
+        except (OSError, subprocess.TimeoutExpired):
+            return False
+
+    def check(self, user, host, port=None):
+        '''Health check of the master for the given destination. A master
+        socket which doesn't answer anymore is removed, so that the next ssh
+        call starts a fresh master instead of bypassing the pool.'''
+        if not self.enabled:
+            return False
+        path = self.control_path(user, host, port)
+        if not os.path.exists(path):
+            return False
+        if self._ctl('check', user, host, port):
+            return True
+        self.dbg('Removing stale ssh master socket', path)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return False
+
+    def close_all(self):
+        for key, path in self.control_paths.items():
+            if os.path.exists(path):
+                self.dbg('Closing ssh master', '%s@%s' % (key[0], key[1]))
+                self._ctl('exit', *key)
+        self.control_paths = {}
+        self.masters = set()
+        self.masters_failed = set()
+        if self.control_dir is not None:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = None
+
+ssh_pool = SshConnectionPool()
+
+class RemoteFetch(log.Origin):
+    '''Retrieve a list of remote files or directories through a single "tar"
+    stream over one ssh channel, extracting each of them in place to its local
+    path. Missing remote files are tolerated. The transfer runs in a helper
+    thread, so several of them (e.g. towards different nodes) can proceed in
+    parallel while the event loop keeps being served.'''
+
+    def __init__(self, name, rem_host, files):
+        super().__init__(log.C_RUN, name)
+        self.rem_host = rem_host
+        # map remote path inside the tar stream -> local path
+        self.files = {}
+        for remote_path, local_path in files:
+            remote_path = str(remote_path)
+            if not remote_path.startswith('/'):
+                raise log.Error('Remote path must be absolute', remote_path=remote_path)
+            self.files[os.path.normpath(remote_path).lstrip('/')] = str(local_path)
+        self.fetched = []
+        self.error = None
+        self.thread = None
+        self.proc = None
+
+    def _local_path(self, member_name):
+        member_name = os.path.normpath(member_name)
+        for remote_path, local_path in self.files.items():
+            if member_name == remote_path:
+                return local_path
+            if member_name.startswith(remote_path + '/'):
+                return os.path.join(local_path, member_name[len(remote_path) + 1:])
+        return None
+
+    def _run(self):
+        try:
+            with tarfile.open(fileobj=self.proc.stdout, mode='r|') as tar:
+                for member in tar:
+                    local_path = self._local_path(member.name)
+                    if local_path is None:
+                        continue
+                    if member.isdir():
+                        util.Dir.ensure_abs_dir_exists(local_path)
+                    elif member.isfile():
+                        util.Dir.ensure_abs_dir_exists(os.path.dirname(local_path))
+                        with tar.extractfile(member) as src, open(local_path, 'wb') as dst:
+                            shutil.copyfileobj(src, dst)
+                        self.fetched.append(member.name)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.proc.stdout.close()
+            self.proc.wait()
+            MainLoop.wakeup()
+
+    def start(self):
+        args = ['ssh'] + self.rem_host.ssh_opts()
+        if self.rem_host.get_remote_port():
+            args += ['-p', str(self.rem_host.get_remote_port())]
+        args += ['%s@%s' % (self.rem_host.user(), self.rem_host.host()),
+                 'tar', '--ignore-failed-read', '-C', '/', '-cf', '-', '--'] + list(self.files.keys())
+        self.dbg(' '.join(args))
+        self.proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL)
+        self.thread = threading.Thread(target=self._run, name=self.name(), daemon=True)
+        self.thread.start()
+        return self
+
+    def done(self):
+        return self.thread is not None and not self.thread.is_alive()
+
+    def wait(self, timeout=300):
+        MainLoop.wait(self.done, timeout=timeout)
+        if self.error is not None:
+            raise log.Error('Fetching files failed: %r' % self.error)
+        if self.proc.returncode != 0:
+            raise log.Error('Fetching files failed: ssh/tar exited with status %d' % self.proc.returncode)
+        missing = ['/' + remote_path for remote_path in self.files.keys()
+                   if not any(f == remote_path or f.startswith(remote_path + '/') for f in self.fetched)]
+        if missing:
+            self.log('Not available on remote host:', ', '.join(missing))
+        return missing
+
+class RemoteInstCache(log.Origin):
+    '''Cache of unpacked binary tarballs (trial inst trees) on a remote host,
+    keyed by the md5 of the tarball and shared by all tests and trials using
+    that host. A cache miss uploads the (compressed) tarball and unpacks it into
+    a temporary dir which is then atomically renamed into place, so concurrent
+    users never see a partial tree. Entries are evicted in least recently used
+    order once the cache exceeds DISK_BUDGET_KB.
+
+    Post-install steps which modify the tree (RPATH, capabilities) are recorded
+    in the entry and applied only once per entry, see apply_once().'''
+
+    CACHE_DIR = '/var/tmp/osmo-gsm-tester/inst-cache'
+    DISK_BUDGET_KB = 8 * 1024 * 1024
+    # entries used this recently are never evicted, they may be in use:
+    EVICT_MIN_AGE_MIN = 60
+    STATE_DIR = '.ogt-state'
+
+    def __init__(self, rem_host, bin_tar, md5):
+        super().__init__(log.C_RUN, 'inst-cache-' + md5[:8])
+        self.rem_host = rem_host
+        self.bin_tar = bin_tar
+        self.md5 = md5
+        self.entry = util.Dir(os.path.join(RemoteInstCache.CACHE_DIR, md5))
+        self.state = None
+
+    def _run(self, name, script):
+        proc = self.rem_host.run_remote_sync(name, ('sh', '-c', shlex.quote(script)))
+        return [l.strip() for l in (proc.get_stdout() or '').splitlines() if l.strip()]
+
+    def _lookup(self):
+        '''Mark the entry as used. Return None if it isn't installed yet,
+        otherwise the list of state keys already applied to it.'''
+        out = self._run('inst-cache-lookup',
+                        'if [ -d {e} ]; then touch {e}; echo hit; mkdir -p {s}; ls -1 {s}; else echo miss; fi'.format(
+                        e=shlex.quote(str(self.entry)), s=shlex.quote(self.entry.child(RemoteInstCache.STATE_DIR))))
+        if not out or out[0] != 'hit':
+            return None
+        return out[1:]
+
+    def _install(self):
+        cache = shlex.quote(RemoteInstCache.CACHE_DIR)
+        remote_tar = os.path.join(RemoteInstCache.CACHE_DIR, '.%s.%s.tgz' % (self.md5, util.md5(self.rem_host.run_dir.path)[:8]))
+        self.rem_host.create_remote_dir(RemoteInstCache.CACHE_DIR)
+        self.rem_host.scp('scp-inst-tar-to-remote', self.bin_tar, remote_tar)
+        self._run('inst-cache-install',
+                  't=$(mktemp -d {c}/.tmp.XXXXXX) && tar -xzf {tar} -C "$t" && rm -f {tar}'
+                  ' && mkdir "$t"/{s} && (mv -T "$t" {e} || rm -rf "$t") && touch {e}'.format(
+                  c=cache, tar=shlex.quote(remote_tar), s=RemoteInstCache.STATE_DIR, e=shlex.quote(str(self.entry))))
+
+    def _evict(self):
+        self._run('inst-cache-evict',
+                  'cd {c} || exit 0;'
+                  ' find . -maxdepth 1 -name ".tmp.*" -mmin +1440 -exec rm -rf {{}} +;'
+                  ' for e in $(ls -1tr); do'
+                  '  [ $(du -sk . | cut -f1) -le {budget} ] && break;'
+                  '  [ "$e" = {md5} ] && continue;'
+                  '  [ -n "$(find "$e" -maxdepth 0 -mmin -{age})" ] && continue;'
+                  '  echo "evicting $e"; rm -rf "$e";'
+                  ' done'.format(c=shlex.quote(RemoteInstCache.CACHE_DIR), budget=RemoteInstCache.DISK_BUDGET_KB,
+                                 md5=self.md5, age=RemoteInstCache.EVICT_MIN_AGE_MIN))
+
+    def install(self, remote_inst):
+        '''Make sure the entry is installed and make remote_inst a symlink
+        to it. Return the entry dir.'''
+        self.state = self._lookup()
+        if self.state is None:
+            self.log('Cache miss, installing', self.bin_tar)
+            self._install()
+            self._evict()
+            self.state = []
+        else:
+            self.dbg('Cache hit')
+        remote_inst = str(remote_inst)
+        self._run('inst-cache-link', 'rm -rf {i} && mkdir -p {d} && ln -sfn {e} {i}'.format(
+                  i=shlex.quote(remote_inst), d=shlex.quote(os.path.dirname(remote_inst)),
+                  e=shlex.quote(str(self.entry))))
+        return self.entry
+
+    def apply_once(self, key, func, *args):
+        '''Call func(*args) unless already done for this entry under the same
+        key, e.g. apply_once('setcap-srsue', rem_host.setcap_netsys_admin, path).
+        Paths passed to func should be inside the entry dir, not the
+        remote_inst symlink, for the result to be valid for all users.'''
+        key = re.sub('[^a-zA-Z0-9_.-]', '_', key)
+        if key in self.state:
+            self.dbg('Already applied:', key)
+            return
+        func(*args)
+        self._run('inst-cache-state', 'touch %s' % shlex.quote(self.entry.child(RemoteInstCache.STATE_DIR, key)))
+        self.state.append(key)
 
 class RemoteHost(log.Origin):
 
@@ -36,6 +334,7 @@ class RemoteHost(log.Origin):
         self.remote_cwd = remote_cwd
         self.remote_env = {}
         self.remote_port = remote_port
+        ssh_pool.check(self.remote_user, self.remote_host, self.remote_port)
 
     def user(self):
         return self.remote_user
@@ -55,10 +354,23 @@ class RemoteHost(log.Origin):
     def get_remote_port(self):
         return self.remote_port
 
+    def ssh_opts(self):
+        return ssh_pool.ssh_opts(self.user(), self.host(), self.get_remote_port())
+
+    def scp_dst(self, remote_path):
+        return '%s@%s:%s' % (self.user(), self.host(), remote_path)
+
+    def scp_args(self, *paths):
+        args = ['scp', '-r'] + self.ssh_opts()
+        if self.get_remote_port():
+            args += ['-P', str(self.get_remote_port())]
+        return tuple(args) + paths
+
     def RemoteProcess(self, name, popen_args, remote_env={}, **popen_kwargs):
         run_dir = self.run_dir.new_dir(name)
         return process.RemoteProcess(name, run_dir, self.user(), self.host(), self.cwd(), popen_args,
-                                     remote_env=remote_env, remote_port=self.get_remote_port(), **popen_kwargs)
+                                     remote_env=remote_env, remote_port=self.get_remote_port(),
+                                     ssh_opts=self.ssh_opts(), **popen_kwargs)
 
     def generate_wrapper_script(self, wait_time_sec):
         wrapper_script = self.run_dir.new_file(RemoteHost.WRAPPER_SCRIPT)
@@ -127,7 +439,8 @@ class RemoteHost(log.Origin):
 
     def RemoteNetNSProcess(self, name, netns, popen_args, **popen_kwargs):
         run_dir = self.run_dir.new_dir(name)
-        return process.RemoteNetNSProcess(name, run_dir, self.user(), self.host(), self.cwd(), netns, popen_args, **popen_kwargs)
+        return process.RemoteNetNSProcess(name, run_dir, self.user(), self.host(), self.cwd(), netns, popen_args,
+                                          ssh_opts=self.ssh_opts(), **popen_kwargs)
 
     def run_remote_sync(self, name, popen_args):
         proc = self.RemoteProcess(name, popen_args, remote_env=self.remote_env)
@@ -153,10 +466,28 @@ class RemoteHost(log.Origin):
         return False
 
     def scp(self, name, local_path, remote_path):
-        process.run_local_sync(self.run_dir, name, ('scp', '-r', local_path, '%s@%s:%s' % (self.user(), self.host(), remote_path)))
+        process.run_local_sync(self.run_dir, name, self.scp_args(local_path, self.scp_dst(remote_path)))
 
     def scpfrom(self, name, remote_path, local_path):
-        process.run_local_sync(self.run_dir, name, ('scp', '-r', '%s@%s:%s' % (self.user(), self.host(), remote_path), local_path))
+        process.run_local_sync(self.run_dir, name, self.scp_args(self.scp_dst(remote_path), local_path))
+
+    def fetch_files_async(self, name, files):
+        '''Start retrieving files, a list of (remote_path, local_path), in one
+        tar stream. Returns the RemoteFetch, call wait() on it.'''
+        return RemoteFetch(name, self, files).start()
+
+    def fetch_files(self, name, files):
+        '''Retrieve files, a list of (remote_path, local_path), in one tar
+        stream and return the list of remote paths which were not available.'''
+        return self.fetch_files_async(name, files).wait()
+
+    def stage_inst(self, bin_tar, md5, remote_inst):
+        '''Provide the inst tree unpacked from bin_tar (see
+        Trial.get_bin_tar_md5()) at remote_inst, from the host's inst cache.
+        Returns the RemoteInstCache, whose entry dir is the actual location.'''
+        inst_cache = RemoteInstCache(self, bin_tar, md5)
+        inst_cache.install(remote_inst)
+        return inst_cache
 
     def setcap_net_admin(self, binary_path):
         '''
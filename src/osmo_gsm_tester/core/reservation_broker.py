@@ -0,0 +1,372 @@
+# osmo_gsm_tester: local broker queuing resource reservations
+#
+# Copyright (C) 2026 by sysmocom - s.f.m.c. GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import math
+import time
+import socket
+import selectors
+
+from . import log
+
+SOCKET_FILE = 'broker.sock'
+
+# How many granted wait times to keep for the statistics:
+WAIT_TIMES_KEPT = 1000
+
+def socket_path(state_dir):
+    return state_dir.child(SOCKET_FILE)
+
+class BrokerConnection:
+    '''One JSON object per line, in both directions.'''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.rx_buf = b''
+        self.rx_msgs = []
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, **msg):
+        self.sock.sendall(json.dumps(msg).encode('utf-8') + b'\n')
+
+    def receive(self):
+        '''Read whatever is available without blocking and parse complete
+        lines into rx_msgs.'''
+        blocking = self.sock.getblocking()
+        self.sock.setblocking(False)
+        try:
+            while not self.closed:
+                try:
+                    data = self.sock.recv(4096)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError:
+                    data = b''
+                if not data:
+                    self.closed = True
+                    break
+                self.rx_buf += data
+        finally:
+            self.sock.setblocking(blocking)
+        while b'\n' in self.rx_buf:
+            line, self.rx_buf = self.rx_buf.split(b'\n', 1)
+            if line.strip():
+                self.rx_msgs.append(json.loads(line.decode('utf-8')))
+
+    def recv_available(self):
+        '''Return the list of messages received so far, without blocking.
+        Return None once the peer closed the connection.'''
+        self.receive()
+        msgs, self.rx_msgs = self.rx_msgs, []
+        if self.closed and not msgs:
+            return None
+        return msgs
+
+    def recv(self, timeout=None):
+        '''Block until a message is received and return it, or None if the
+        peer closed the connection.'''
+        deadline = None if timeout is None else time.time() + timeout
+        with selectors.DefaultSelector() as sel:
+            sel.register(self.sock, selectors.EVENT_READ)
+            while not self.rx_msgs and not self.closed:
+                remaining = None if deadline is None else max(0, deadline - time.time())
+                if not sel.select(remaining):
+                    raise log.Error('Timeout waiting for reservation broker', timeout=timeout)
+                self.receive()
+        if not self.rx_msgs:
+            return None
+        return self.rx_msgs.pop(0)
+
+    def close(self):
+        self.sock.close()
+
+def connect(path):
+    '''Return a BrokerConnection to the broker listening on path, or None if
+    no broker is running.'''
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return BrokerConnection(sock)
+
+def notify_released(path):
+    '''Tell a running broker that resources were freed. Best effort only, the
+    broker also notices changes to the reservation database by itself.'''
+    conn = connect(path)
+    if conn is None:
+        return
+    try:
+        conn.send(op='released')
+    except OSError:
+        pass
+    finally:
+        conn.close()
+
+def query_stats(path, timeout=10):
+    conn = connect(path)
+    if conn is None:
+        raise log.Error('No reservation broker running', socket=path)
+    try:
+        conn.send(op='stats')
+        return conn.recv(timeout)
+    finally:
+        conn.close()
+
+class QueuedRequest:
+
+    def __init__(self, conn, seq, origin_id, want, priority):
+        self.conn = conn
+        self.seq = seq
+        self.origin_id = origin_id
+        self.want = want
+        self.priority = priority
+        self.queued_at = time.time()
+
+    def waited(self, now):
+        return now - self.queued_at
+
+    def effective_priority(self, now):
+        return self.priority + self.waited(now) / Broker.AGING_SECS
+
+class Broker(log.Origin):
+    '''Serve resource reservations of all osmo-gsm-tester instances sharing a
+    state dir on a Unix socket in it, in order of arrival instead of letting
+    them poll the reservation database and whoever happens to look first win.
+
+    A request may have a priority. The longer a request waits, the higher its
+    priority gets (one step every AGING_SECS seconds), so low priority requests
+    are not starved forever. A request is only granted if no request before it
+    in the queue is still waiting for the same kinds of resources, so large
+    requests are not overtaken indefinitely by smaller ones.
+
+    The broker reserves the resources in the reservation database on behalf of
+    the requester and pushes the result to it. Instances not using the broker
+    can still reserve resources in the database directly, the broker notices
+    such changes by polling the database version every TICK seconds.'''
+
+    AGING_SECS = 60
+    TICK = 1
+
+    def __init__(self, resources_pool, path=None):
+        super().__init__(log.C_CNF, 'broker')
+        self.pool = resources_pool
+        self.path = path or socket_path(self.pool.state_dir)
+        self.sel = None
+        self.listen_sock = None
+        self.queue = []
+        self.next_seq = 1
+        self.running = False
+        self.need_schedule = False
+        self.last_db_version = None
+        self.count_requests = 0
+        self.count_granted = 0
+        self.count_rejected = 0
+        self.count_abandoned = 0
+        self.wait_times = []
+        self.wait_max = 0
+
+    def start(self):
+        running = connect(self.path)
+        if running is not None:
+            running.close()
+            raise log.Error('Another reservation broker is already running', socket=self.path)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.listen_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listen_sock.bind(self.path)
+        self.listen_sock.listen(64)
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.listen_sock, selectors.EVENT_READ, None)
+        self.running = True
+        self.log('Listening on', self.path)
+
+    def stop(self):
+        self.running = False
+
+    def cleanup(self):
+        for req in self.queue:
+            req.conn.close()
+        self.queue = []
+        if self.sel is not None:
+            for key in list(self.sel.get_map().values()):
+                if key.fileobj is not self.listen_sock:
+                    key.fileobj.close()
+            self.sel.close()
+            self.sel = None
+        if self.listen_sock is not None:
+            self.listen_sock.close()
+            self.listen_sock = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while self.running:
+                self.serve_once(Broker.TICK)
+        finally:
+            self.cleanup()
+
+    def serve_once(self, timeout):
+        for key, events in self.sel.select(timeout):
+            if key.data is None:
+                sock, addr = self.listen_sock.accept()
+                conn = BrokerConnection(sock)
+                self.sel.register(sock, selectors.EVENT_READ, conn)
+            else:
+                self.handle_readable(key.data)
+        version = self.pool.db.data_version()
+        if version != self.last_db_version:
+            self.last_db_version = version
+            self.need_schedule = True
+        if self.need_schedule:
+            self.need_schedule = False
+            self.schedule()
+
+    def drop_conn(self, conn):
+        if conn.sock.fileno() < 0:
+            return # dropped already, e.g. after granting its request
+        self.sel.unregister(conn.sock)
+        conn.close()
+
+    def abandon(self, conn):
+        '''A client going away gives up its place in the queue.'''
+        for req in list(self.queue):
+            if req.conn is conn:
+                self.dbg('Request abandoned', origin_id=req.origin_id)
+                self.queue.remove(req)
+                self.count_abandoned += 1
+        self.drop_conn(conn)
+
+    def handle_readable(self, conn):
+        msgs = conn.recv_available()
+        if msgs is None:
+            self.abandon(conn)
+            return
+        for msg in msgs:
+            try:
+                self.handle_msg(conn, msg)
+            except OSError:
+                # e.g. gone before being told its request is queued
+                self.abandon(conn)
+                return
+
+    def handle_msg(self, conn, msg):
+        op = msg.get('op')
+        if op == 'reserve':
+            self.enqueue(conn, msg.get('origin_id'), msg.get('want') or {}, msg.get('priority') or 0)
+        elif op == 'released':
+            self.need_schedule = True
+        elif op == 'stats':
+            conn.send(op='stats', **self.stats())
+        else:
+            conn.send(op='error', msg='Unknown request: %r' % op)
+
+    def enqueue(self, conn, origin_id, want, priority):
+        from .resource import NoResourceExn
+        self.count_requests += 1
+        origin = log.Origin(log.C_CNF, origin_id)
+        try:
+            # Never queue what can never be satisfied:
+            self.pool.all_resources.find(origin, want, None, False, True, 'Verifying')
+        except NoResourceExn as e:
+            self.count_rejected += 1
+            conn.send(op='error', msg=str(e))
+            return
+        req = QueuedRequest(conn, self.next_seq, origin_id, want, priority)
+        self.next_seq += 1
+        self.queue.append(req)
+        self.log('Queued request', origin_id=origin_id, priority=priority, depth=len(self.queue))
+        self.schedule()
+        if req in self.queue:
+            conn.send(op='queued', position=self.position(req), depth=len(self.queue))
+
+    def ordered_queue(self, now=None):
+        if now is None:
+            now = time.time()
+        return sorted(self.queue, key=lambda req: (-req.effective_priority(now), req.seq))
+
+    def position(self, req):
+        return self.ordered_queue().index(req) + 1
+
+    def schedule(self):
+        '''Grant queued requests in order as far as resources allow.'''
+        from .resource import NoResourceExn
+        now = time.time()
+        blocked_kinds = set()
+        for req in self.ordered_queue(now):
+            kinds = set(req.want.keys())
+            if kinds & blocked_kinds:
+                # someone before this request is still waiting for these kinds
+                blocked_kinds |= kinds
+                continue
+            origin = log.Origin(log.C_CNF, req.origin_id)
+            try:
+                reserved = self.pool.reserve_now(origin, req.origin_id, req.want)
+            except NoResourceExn:
+                blocked_kinds |= kinds
+                continue
+            self.grant(req, reserved, now)
+
+    def grant(self, req, reserved, now):
+        self.queue.remove(req)
+        try:
+            req.conn.send(op='granted', reserved=reserved)
+        except OSError:
+            # nobody to hand the resources to anymore
+            self.pool.release(reserved)
+            self.count_abandoned += 1
+            self.drop_conn(req.conn)
+            self.need_schedule = True
+            return
+        waited = req.waited(now)
+        self.log('Granted request', origin_id=req.origin_id, waited='%ds' % waited, depth=len(self.queue))
+        self.count_granted += 1
+        self.wait_times.append(waited)
+        del self.wait_times[:-WAIT_TIMES_KEPT]
+        self.wait_max = max(self.wait_max, waited)
+        self.drop_conn(req.conn)
+
+    def stats(self):
+        now = time.time()
+        waiting = [dict(origin_id=req.origin_id, priority=req.priority, waited=round(req.waited(now), 1))
+                   for req in self.ordered_queue(now)]
+        wait_times = sorted(self.wait_times)
+        def percentile(p):
+            if not wait_times:
+                return 0
+            return round(wait_times[max(0, math.ceil(len(wait_times) * p) - 1)], 1)
+        return dict(depth=len(self.queue),
+                    waiting=waiting,
+                    requests=self.count_requests,
+                    granted=self.count_granted,
+                    rejected=self.count_rejected,
+                    abandoned=self.count_abandoned,
+                    wait_avg=round(sum(wait_times) / len(wait_times), 1) if wait_times else 0,
+                    wait_p50=percentile(0.5),
+                    wait_p90=percentile(0.9),
+                    wait_max=round(self.wait_max, 1))
+
+# vim: expandtab tabstop=4 shiftwidth=4
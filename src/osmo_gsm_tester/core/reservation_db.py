@@ -0,0 +1,200 @@
+# osmo_gsm_tester: persistent store of reserved resources
+#
+# Copyright (C) 2026 by sysmocom - s.f.m.c. GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import weakref
+import sqlite3
+import threading
+import contextlib
+
+from . import log
+from . import config
+
+DB_FILE = 'reserved_resources.db'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS reserved (
+    kind TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    reserved_by TEXT NOT NULL,
+    reserved_at REAL NOT NULL,
+    item TEXT NOT NULL,
+    PRIMARY KEY (kind, hash)
+);
+CREATE INDEX IF NOT EXISTS reserved_by_hash ON reserved (hash);
+CREATE INDEX IF NOT EXISTS reserved_by_origin ON reserved (reserved_by);
+CREATE TABLE IF NOT EXISTS zmq_ports (
+    port INTEGER PRIMARY KEY,
+    reserved_by TEXT NOT NULL,
+    leased_by TEXT NOT NULL,
+    reserved_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS zmq_ports_by_origin ON zmq_ports (reserved_by);
+'''
+
+# sqlite3 connections must not be used across fork(), forked children open
+# their own ones. The inherited ones are kept referenced and never closed, so
+# that the child can't interfere with the parent's use of the database.
+_all_dbs = weakref.WeakSet()
+_inherited_connections = []
+
+def _forget_connections_after_fork():
+    for db in _all_dbs:
+        _inherited_connections.append(db.local)
+        db.local = threading.local()
+
+os.register_at_fork(after_in_child=_forget_connections_after_fork)
+
+class ReservationDb(log.Origin):
+    '''Reserved resources shared by all osmo-gsm-tester instances using the
+    same state dir, in an SQLite database in WAL mode. Each reservation or
+    release is one transaction, so no further locking is needed, and finding
+    out which resources are reserved doesn't require reading all of them.
+
+    If export_path is given, the reserved resources are also written there
+    in the format of the former reserved_resources.state YAML file, for
+    humans and scripts to inspect. That file is never read back, the database
+    alone holds the reservations.'''
+
+    # seconds to wait for another instance's transaction to complete:
+    BUSY_TIMEOUT = 60
+
+    def __init__(self, state_dir, hash_key, reserved_key, export_path=None):
+        super().__init__(log.C_CNF, 'reservation-db')
+        self.path = state_dir.mk_parentdir(DB_FILE)
+        self.hash_key = hash_key
+        self.reserved_key = reserved_key
+        self.export_path = export_path
+        # sqlite3 connections can't be shared among threads:
+        self.local = threading.local()
+        _all_dbs.add(self)
+
+    def conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            return conn
+        # autocommit mode, transactions are handled explicitly:
+        conn = sqlite3.connect(self.path, timeout=ReservationDb.BUSY_TIMEOUT, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(SCHEMA)
+        self.local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''Exclusive write transaction, committed when leaving the context
+        without exception, rolled back otherwise.'''
+        conn = self.conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def data_version(self):
+        '''Changes each time another connection committed changes. Cheap way
+        of finding out whether reserved resources need to be looked at again.'''
+        return self.conn().execute('PRAGMA data_version').fetchone()[0]
+
+    def reserved_hashes(self, kinds=None):
+        '''Return {kind: set(hashes)} of the currently reserved resources,
+        of the given kinds only if passed.'''
+        conn = self.conn()
+        if kinds is None:
+            rows = conn.execute('SELECT kind, hash FROM reserved')
+        else:
+            kinds = list(kinds)
+            rows = conn.execute('SELECT kind, hash FROM reserved WHERE kind IN (%s)' % ','.join('?' * len(kinds)),
+                                kinds)
+        hashes = {}
+        for kind, item_hash in rows:
+            hashes.setdefault(kind, set()).add(item_hash)
+        return hashes
+
+    def reserved(self):
+        '''Return {kind: [items]} of the currently reserved resources, in order
+        of reservation.'''
+        reserved = {}
+        for kind, item in self.conn().execute('SELECT kind, item FROM reserved ORDER BY rowid'):
+            reserved.setdefault(kind, []).append(json.loads(item))
+        return reserved
+
+    def add(self, resources):
+        '''Mark the items of resources, {kind: [items]} with hash and reserved
+        by markers set, as reserved. Call within transaction().'''
+        now = time.time()
+        self.conn().executemany('INSERT INTO reserved (kind, hash, reserved_by, reserved_at, item) VALUES (?, ?, ?, ?, ?)',
+                                [(kind, item[self.hash_key], item[self.reserved_key], now, json.dumps(item))
+                                 for kind, item_list in resources.items() for item in item_list])
+
+    def drop(self, resources, fail_if_not_found=True):
+        '''Release the items of resources, {kind: [items]} with hash markers
+        set. Call within transaction().'''
+        conn = self.conn()
+        for kind, item_list in resources.items():
+            for item in item_list:
+                item_hash = item.get(self.hash_key)
+                if not item_hash:
+                    raise RuntimeError('ReservationDb.drop() only works with hashed items')
+                cur = conn.execute('DELETE FROM reserved WHERE kind = ? AND hash = ?', (kind, item_hash))
+                if fail_if_not_found and cur.rowcount == 0:
+                    raise RuntimeError('Asked to drop resource from a pool, but the'
+                                       ' resource was not found: %s = %r' % (kind, item))
+
+    def drop_reserved_by(self, reserved_by):
+        '''Release all items reserved by reserved_by, return how many there
+        were. Call within transaction().'''
+        return self.conn().execute('DELETE FROM reserved WHERE reserved_by = ?', (reserved_by,)).rowcount
+
+    def leased_ports(self, first, last):
+        '''Return the leased ports between first and last, inclusive.'''
+        return [port for (port,) in self.conn().execute('SELECT port FROM zmq_ports WHERE port BETWEEN ? AND ?',
+                                                        (first, last))]
+
+    def add_ports(self, ports, reserved_by, leased_by):
+        '''Lease ports, to be released along with the resources reserved by
+        reserved_by. Call within transaction().'''
+        now = time.time()
+        self.conn().executemany('INSERT INTO zmq_ports (port, reserved_by, leased_by, reserved_at) VALUES (?, ?, ?, ?)',
+                                [(port, reserved_by, leased_by, now) for port in ports])
+
+    def drop_ports_reserved_by(self, reserved_by):
+        '''Release all ports leased for reserved_by, return how many there
+        were. Call within transaction().'''
+        return self.conn().execute('DELETE FROM zmq_ports WHERE reserved_by = ?', (reserved_by,)).rowcount
+
+    def drop_ports_leased_by(self, reserved_by, leased_by):
+        '''Release the ports leased by leased_by for reserved_by, return how
+        many there were. Call within transaction().'''
+        return self.conn().execute('DELETE FROM zmq_ports WHERE reserved_by = ? AND leased_by = ?',
+                                   (reserved_by, leased_by)).rowcount
+
+    def export(self):
+        '''Write the reserved resources to export_path, if set. Call within
+        transaction() to write a consistent state.'''
+        if not self.export_path:
+            return
+        tmp_path = '%s.%d.tmp' % (self.export_path, os.getpid())
+        config.write(tmp_path, self.reserved())
+        os.replace(tmp_path, self.export_path)
+
+# vim: expandtab tabstop=4 shiftwidth=4
@@ -20,12 +20,15 @@
 import os
 import copy
 import atexit
+import socket
 import pprint
 
 from . import log
 from . import config
 from . import util
 from . import schema
+from . import reservation_broker
+from .reservation_db import ReservationDb
 from .event_loop import MainLoop
 
 from .util import is_dict, is_list
@@ -48,22 +51,38 @@ class ResourcesPool(log.Origin):
     _remember_to_free = None
     _registered_exit_handler = False
 
+    # Whether to keep RESERVED_RESOURCES_FILE up to date for inspection:
+    EXPORT_RESERVED_RESOURCES_FILE = True
+
+    # Priority of reservations queued at a reservation broker, if running:
+    RESERVATION_PRIORITY = 0
+
+    # How many values of counters like MSISDNs to take from the state dir at
+    # once, see next_persistent_values():
+    PERSISTENT_VALUE_BLOCK = 32
+    _persistent_value_blocks = {}
+    _registered_persistent_values_exit_handler = False
+
     def __init__(self):
-        self.reserved_modified = False
         self.config_path = config.get_main_config_value(config.CFG_RESOURCES_CONF)
         self.state_dir = config.get_state_dir()
         super().__init__(log.C_CNF, conf=self.config_path, state=self.state_dir.path)
         self.read_conf()
+        export_path = None
+        if ResourcesPool.EXPORT_RESERVED_RESOURCES_FILE:
+            export_path = self.state_dir.child(RESERVED_RESOURCES_FILE)
+        self.db = ReservationDb(self.state_dir, HASH_KEY, RESERVED_KEY, export_path)
+        # origin_id of the last reservation, owning ZMQ ports leased here:
+        self.reserved_by = None
+        # origin_ids owning ZMQ ports leased without any reservation, see
+        # release_port_leases():
+        self.port_lease_owners = set()
+        self._registered_port_leases_exit_handler = False
 
     def read_conf(self):
         self.all_resources = Resources(config.read(self.config_path, schema.get_resources_schema()) or {})
         self.all_resources.set_hashes()
 
-    # Used by FileWatch in reserve() method below
-    def reserve_resources_fw_cb(self, event):
-        if event.event_type == 'modified':
-            self.reserved_modified = True
-
     def reserve(self, origin, want, modifiers):
         '''
         attempt to reserve the resources specified in the dict 'want' for
@@ -100,52 +119,123 @@ class ResourcesPool(log.Origin):
         schema.validate(modifiers, schema.get_resources_schema())
 
         origin_id = origin.origin_id()
+        self.reserved_by = origin_id
 
         # Make sure wanted resources can ever be reserved, even if all
         # resources are unallocated. It will throw an exception if not
         # possible:
         self.all_resources.find(origin, want, None, False, True, 'Verifying')
-        self.reserved_modified = True # go through on first attempt
-        rrfile_path = self.state_dir.mk_parentdir(RESERVED_RESOURCES_FILE)
-        fw = util.FileWatch(origin, rrfile_path, self.reserve_resources_fw_cb)
-        fw.start()
-        while True:
-            # First, figure out if  RESERVED_RESOURCES_FILE was modified since last time we checked:
-            modified = False
+
+        broker = reservation_broker.connect(reservation_broker.socket_path(self.state_dir))
+        if broker is not None:
             try:
-                fw.get_lock().acquire()
-                if self.reserved_modified:
-                    modified = True
-                    self.reserved_modified = False
+                to_be_reserved = self.reserve_from_broker(broker, origin, origin_id, want)
             finally:
-                fw.get_lock().release()
+                broker.close()
+            self.remember_to_free(to_be_reserved)
+            return ReservedResources(self, origin, to_be_reserved, modifiers)
 
-            if modified: # file was modified, attempt to reserve resources
+        last_version = None
+        while True:
+            # Only look again if reservations changed since the last attempt:
+            version = self.db.data_version()
+            if version != last_version:
+                last_version = version
                 # It should be possible at some point to reserve the wanted
                 # resources, so try and wait for some to be released if it's not
                 # possible to allocate them now:
                 try:
-                    with self.state_dir.lock(origin_id):
-                        reserved = Resources(config.read(rrfile_path, if_missing_return={}))
-                        to_be_reserved = self.all_resources.without(reserved).find(origin, want)
-                        to_be_reserved.mark_reserved_by(origin_id)
-                        reserved.add(to_be_reserved)
-                        fw.stop()
-                        config.write(rrfile_path, reserved)
-                        self.remember_to_free(to_be_reserved)
-                        return ReservedResources(self, origin, to_be_reserved, modifiers)
+                    to_be_reserved = self.reserve_now(origin, origin_id, want)
+                    self.remember_to_free(to_be_reserved)
+                    return ReservedResources(self, origin, to_be_reserved, modifiers)
                 except NoResourceExn:
                     origin.log('Unable to reserve resources, too many currently reserved. Waiting until some are available again')
             MainLoop.sleep(1)
 
+    def try_reserve(self, origin, want, modifiers):
+        '''Like reserve(), but return None instead of waiting if the wanted
+        resources are not available right now.'''
+        schema.validate(want, schema.get_resources_schema())
+        schema.validate(modifiers, schema.get_resources_schema())
+        self.all_resources.find(origin, want, None, False, True, 'Verifying')
+        try:
+            to_be_reserved = self.reserve_now(origin, origin.origin_id(), want)
+        except NoResourceExn:
+            return None
+        self.reserved_by = origin.origin_id()
+        self.remember_to_free(to_be_reserved)
+        return ReservedResources(self, origin, to_be_reserved, modifiers)
+
+    def reserve_now(self, origin, origin_id, want):
+        '''Reserve the wanted resources for origin_id if they are available
+        right now, raise NoResourceExn otherwise.'''
+        with self.db.transaction():
+            reserved_hashes = self.db.reserved_hashes(want.keys())
+            to_be_reserved = self.all_resources.find(origin, want, skip_hashes=reserved_hashes)
+            to_be_reserved.mark_reserved_by(origin_id)
+            self.db.add(to_be_reserved)
+            self.db.export()
+        return to_be_reserved
+
+    def reserve_from_broker(self, broker, origin, origin_id, want):
+        '''Queue the reservation at the reservation broker and wait for it to
+        push the reserved resources once it's our turn.'''
+        origin.dbg('Queuing reservation at broker', priority=ResourcesPool.RESERVATION_PRIORITY)
+        broker.send(op='reserve', origin_id=origin_id, want=want,
+                    priority=ResourcesPool.RESERVATION_PRIORITY)
+        # The fd watch only wakes up the wait below as soon as the broker
+        # answers, messages are read in the wait condition:
+        MainLoop.register_fd_watch(broker.fileno(), lambda fd, condition: True)
+        try:
+            while True:
+                msgs = []
+                def received():
+                    available = broker.recv_available()
+                    msgs.extend([None] if available is None else available)
+                    return bool(msgs)
+                MainLoop.wait_no_raise(received, [], {}, timeout=3600, timestep=1)
+                for msg in msgs:
+                    if msg is None:
+                        raise log.Error('Reservation broker closed the connection')
+                    op = msg.get('op')
+                    if op == 'granted':
+                        return Resources(msg.get('reserved'), do_copy=False)
+                    if op == 'error':
+                        raise NoResourceExn(msg.get('msg'))
+                    if op == 'queued':
+                        origin.log('Unable to reserve resources right now, queued by reservation broker:'
+                                   ' position %d of %d' % (msg.get('position'), msg.get('depth')))
+        finally:
+            MainLoop.unregister_fd_watch(broker.fileno())
+
+    def release(self, to_be_freed):
+        with self.db.transaction():
+            self.db.drop(to_be_freed)
+            # ZMQ ports leased for a reservation go along with it:
+            for reserved_by in set(item.get(RESERVED_KEY) for item_list in to_be_freed.values() for item in item_list):
+                if reserved_by:
+                    self.db.drop_ports_reserved_by(reserved_by)
+            self.db.export()
+        reservation_broker.notify_released(reservation_broker.socket_path(self.state_dir))
+
     def free(self, origin, to_be_freed):
         log.ctx(origin)
-        with self.state_dir.lock(origin.origin_id()):
-            rrfile_path = self.state_dir.mk_parentdir(RESERVED_RESOURCES_FILE)
-            reserved = Resources(config.read(rrfile_path, if_missing_return={}))
-            reserved.drop(to_be_freed)
-            config.write(rrfile_path, reserved)
-            self.forget_freed(to_be_freed)
+        self.release(to_be_freed)
+        self.forget_freed(to_be_freed)
+        self.release_port_leases()
+
+    def free_reserved_by(self, origin_id):
+        '''Free whatever is still reserved for origin_id, e.g. by a process
+        that died without freeing its resources. Return how many items were
+        freed.'''
+        with self.db.transaction():
+            count = self.db.drop_reserved_by(origin_id)
+            self.db.drop_ports_reserved_by(origin_id)
+            if count:
+                self.db.export()
+        if count:
+            reservation_broker.notify_released(reservation_broker.socket_path(self.state_dir))
+        return count
 
     def register_exit_handler(self):
         if self._registered_exit_handler:
@@ -179,50 +269,211 @@ class ResourcesPool(log.Origin):
         if not self._remember_to_free:
             self.unregister_exit_handler()
 
-    def next_persistent_value(self, token, first_val, validate_func, inc_func, origin):
-        origin_id = origin.origin_id()
+    def next_persistent_values(self, token, first_val, validate_func, inc_func, origin, count, block_size=1):
+        '''Return a list of the next count values of the counter token kept
+        in the state dir, shared by all instances using it.
+
+        With block_size > 1, at least that many values are taken from the
+        state dir at once, and the ones not returned yet are handed out from
+        memory by later calls, saving a lock and file access for each value.
+        Values are then unique but not in order among instances. Values not
+        handed out are returned on exit, if no other instance took values in
+        the meantime.'''
+        token_path = self.state_dir.child('last_used_%s.state' % token)
+        block = ResourcesPool._persistent_value_blocks.get(token_path)
+        values = []
+        if block is not None:
+            values = block.take(count)
+        if len(values) == count:
+            return values
 
-        with self.state_dir.lock(origin_id):
-            token_path = self.state_dir.child('last_used_%s.state' % token)
+        with self.state_dir.lock(origin.origin_id()):
             log.ctx(token_path)
-            last_value = first_val
-            if os.path.exists(token_path):
-                if not os.path.isfile(token_path):
-                    raise RuntimeError('path should be a file but is not: %r' % token_path)
-                with open(token_path, 'r') as f:
-                    last_value = f.read().strip()
-                validate_func(last_value)
-
-            next_value = inc_func(last_value)
+            last_value = self.read_persistent_value(token_path, first_val, validate_func)
+            new_values = []
+            next_value = last_value
+            for i in range(max(count - len(values), block_size)):
+                next_value = inc_func(next_value)
+                new_values.append(next_value)
             with open(token_path, 'w') as f:
                 f.write(next_value)
-            return next_value
+
+        block = PersistentValueBlock(self.state_dir, token_path, last_value, new_values)
+        values.extend(block.take(count - len(values)))
+        if block.values:
+            ResourcesPool._persistent_value_blocks[token_path] = block
+            if not ResourcesPool._registered_persistent_values_exit_handler:
+                atexit.register(ResourcesPool.return_unused_persistent_values)
+                ResourcesPool._registered_persistent_values_exit_handler = True
+        else:
+            ResourcesPool._persistent_value_blocks.pop(token_path, None)
+        return values
+
+    def next_persistent_value(self, token, first_val, validate_func, inc_func, origin, block_size=1):
+        return self.next_persistent_values(token, first_val, validate_func, inc_func, origin, 1, block_size)[0]
+
+    @staticmethod
+    def read_persistent_value(token_path, first_val, validate_func):
+        if not os.path.exists(token_path):
+            return first_val
+        if not os.path.isfile(token_path):
+            raise RuntimeError('path should be a file but is not: %r' % token_path)
+        with open(token_path, 'r') as f:
+            last_value = f.read().strip()
+        validate_func(last_value)
+        return last_value
+
+    @staticmethod
+    def return_unused_persistent_values():
+        blocks = ResourcesPool._persistent_value_blocks
+        ResourcesPool._persistent_value_blocks = {}
+        for block in blocks.values():
+            block.return_unused()
+
+    def next_msisdns(self, origin, count):
+        return self.next_persistent_values('msisdn', '1000', schema.msisdn, util.msisdn_inc, origin, count,
+                                           ResourcesPool.PERSISTENT_VALUE_BLOCK)
 
     def next_msisdn(self, origin):
-        return self.next_persistent_value('msisdn', '1000', schema.msisdn, util.msisdn_inc, origin)
+        return self.next_msisdns(origin, 1)[0]
 
     def next_lac(self, origin):
         # LAC=0 has special meaning (MS detached), avoid it
-        return self.next_persistent_value('lac', '1', schema.uint16, lambda x: str(((int(x)+1) % pow(2,16)) or 1), origin)
+        return self.next_persistent_value('lac', '1', schema.uint16, lambda x: str(((int(x)+1) % pow(2,16)) or 1), origin,
+                                          ResourcesPool.PERSISTENT_VALUE_BLOCK)
 
     def next_rac(self, origin):
-        return self.next_persistent_value('rac', '1', schema.uint8, lambda x: str((int(x)+1) % pow(2,8) or 1), origin)
+        return self.next_persistent_value('rac', '1', schema.uint8, lambda x: str((int(x)+1) % pow(2,8) or 1), origin,
+                                          ResourcesPool.PERSISTENT_VALUE_BLOCK)
 
     def next_cellid(self, origin):
-        return self.next_persistent_value('cellid', '1', schema.uint16, lambda x: str((int(x)+1) % pow(2,16)), origin)
+        return self.next_persistent_value('cellid', '1', schema.uint16, lambda x: str((int(x)+1) % pow(2,16)), origin,
+                                          ResourcesPool.PERSISTENT_VALUE_BLOCK)
 
     def next_bvci(self, origin):
         # BVCI=0 and =1 are reserved, avoid them.
-        return self.next_persistent_value('bvci', '2', schema.uint16, lambda x: str(int(x)+1) if int(x) < pow(2,16) - 1 else '2', origin)
+        return self.next_persistent_value('bvci', '2', schema.uint16, lambda x: str(int(x)+1) if int(x) < pow(2,16) - 1 else '2', origin,
+                                          ResourcesPool.PERSISTENT_VALUE_BLOCK)
 
     def next_zmq_port_range(self, origin, num_ports):
-        # Allocate continuous num_ports port between 2000 and 2200. returns base port.
-        # Assumption: base port is always an odd number.
+        '''Lease num_ports consecutive ports in the zmq_port_range of the main
+        config, return the first one. The ports are released once origin is
+        cleaned up (see release_ports_leased_by()), or else along with the
+        resources reserved through this pool or, if none were, on the next
+        free() or at exit (see release_port_leases()).
+
+        Leases of all instances sharing the state dir are kept in the
+        reservation database. Ports found in use on this host anyway are
+        skipped.'''
+        # keep base ports aligned on even numbers:
         num_ports = num_ports if num_ports % 2 == 0 else num_ports + 1
-        base_port = self.next_persistent_value('zmq_port', '2000', schema.uint16,
-                                               lambda x: str(int(x)+num_ports) if int(x) < 2200 - num_ports else '2000', origin)
-        return int(base_port)
-
+        first, last = config.get_zmq_port_range()
+        reserved_by = self.reserved_by
+        if reserved_by is None:
+            reserved_by = origin.origin_id()
+            self.port_lease_owners.add(reserved_by)
+            if not self._registered_port_leases_exit_handler:
+                atexit.register(self.release_port_leases)
+                self._registered_port_leases_exit_handler = True
+        with self.db.transaction():
+            used = 0
+            for port in self.db.leased_ports(first, last):
+                used |= 1 << (port - first)
+            base_port = find_free_port_range(first, last, num_ports, used)
+            if base_port is None:
+                raise NoResourceExn('No %d consecutive ZMQ ports available between %d and %d'
+                                    % (num_ports, first, last))
+            self.db.add_ports(range(base_port, base_port + num_ports), reserved_by, origin.origin_id())
+        origin.dbg('Leased ZMQ ports %d-%d' % (base_port, base_port + num_ports - 1))
+        return base_port
+
+    def release_ports_leased_by(self, origins):
+        '''Release the ZMQ ports leased by origins, e.g. by the objects of a
+        test once they are cleaned up, so that a suite running many tests
+        doesn't keep all of its tests' ports until the end.'''
+        with self.db.transaction():
+            for origin in origins:
+                leased_by = origin.origin_id()
+                self.db.drop_ports_leased_by(self.reserved_by or leased_by, leased_by)
+
+    def release_port_leases(self):
+        '''Release the ZMQ ports leased without a reservation. Called when
+        freeing resources and at exit.'''
+        if not self.port_lease_owners:
+            return
+        with self.db.transaction():
+            for owner in self.port_lease_owners:
+                self.db.drop_ports_reserved_by(owner)
+        self.port_lease_owners = set()
+
+
+def port_is_free(port):
+    '''Whether port can be bound on this host, the way ZMQ binds it.'''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', port))
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+def find_free_port_range(first, last, num_ports, used):
+    '''Return the first port of num_ports consecutive ports between first
+    and last that are neither set in the bitmap used (bit 0 being first)
+    nor in use on this host, starting at an even offset from first. Return
+    None if there are none.'''
+    want = (1 << num_ports) - 1
+    for base_port in range(first, last - num_ports + 2, 2):
+        offset = base_port - first
+        if (used >> offset) & want:
+            continue
+        busy = [port for port in range(base_port, base_port + num_ports) if not port_is_free(port)]
+        if busy:
+            for port in busy:
+                used |= 1 << (port - first)
+            continue
+        return base_port
+    return None
+
+class PersistentValueBlock:
+    '''Values of a counter in the state dir taken by this process, of which
+    the ones not handed out yet can be returned if the counter still is where
+    this process left it.'''
+
+    def __init__(self, state_dir, token_path, last_value, values):
+        self.state_dir = state_dir
+        self.token_path = token_path
+        self.last_value = last_value
+        self.values = values
+        self.end_value = values[-1] if values else last_value
+
+    def take(self, count):
+        taken, self.values = self.values[:count], self.values[count:]
+        if taken:
+            self.last_value = taken[-1]
+        return taken
+
+    def return_unused(self):
+        if not self.values:
+            return
+        with self.state_dir.lock('atexit.return_unused_persistent_values()'):
+            if not os.path.isfile(self.token_path):
+                return
+            with open(self.token_path, 'r') as f:
+                if f.read().strip() != self.end_value:
+                    # someone else took values after ours, can't return them
+                    return
+            with open(self.token_path, 'w') as f:
+                f.write(self.last_value)
+        self.values = []
+
+def _forget_persistent_values_after_fork():
+    # the parent hands out these values, and may return them
+    ResourcesPool._persistent_value_blocks = {}
+
+os.register_at_fork(after_in_child=_forget_persistent_values_after_fork)
 
 class NoResourceExn(log.Error):
     pass
@@ -231,7 +482,7 @@ class Resources(dict):
 
     def __init__(self, all_resources={}, do_copy=True):
         if do_copy:
-            all_resources = copy.deepcopy(all_resources)
+            all_resources = util.thaw(all_resources)
         self.update(all_resources)
 
     def drop(self, reserved, fail_if_not_found=True):
@@ -276,7 +527,38 @@ class Resources(dict):
     def without(self, reserved):
         return Resources(self).drop(reserved)
 
-    def find(self, for_origin, want, skip_if_marked=None, do_copy=True, raise_if_missing=True, log_label='Reserving'):
+    def index(self):
+        '''Return the ResourcesIndex of the items, built on first use and
+        again when lists of items were replaced or changed in length. Changes
+        to the attributes of items need a reindex(), except for the markers
+        changed through set_marker().'''
+        index = getattr(self, '_index', None)
+        if index is None or not index.is_current(self):
+            index = ResourcesIndex(self)
+            self._index = index
+        return index
+
+    def reindex(self):
+        self._index = None
+
+    def set_marker(self, key, item, marker, value=True):
+        '''Set (or with a false value, remove) marker in item of the list
+        self[key], keeping the index up to date.'''
+        if value:
+            item[marker] = value
+        else:
+            item.pop(marker, None)
+        index = getattr(self, '_index', None)
+        if index is not None and index.is_current(self):
+            index.set_marked(key, index.position(key, item), marker, value)
+
+    def __deepcopy__(self, memo):
+        # the copy builds its own index when needed
+        return Resources(dict((key, copy.deepcopy(item_list, memo)) for key, item_list in self.items()),
+                         do_copy=False)
+
+    def find(self, for_origin, want, skip_if_marked=None, do_copy=True, raise_if_missing=True, log_label='Reserving',
+             skip_hashes=None):
         '''
         Pass a dict of resource requirements, e.g.:
           want = {
@@ -295,6 +577,9 @@ class Resources(dict):
         then this may be skipped by passing skip_if_marked='_used'
         (or rather skip_if_marked=USED_KEY).
 
+        If skip_hashes is passed, a dict of {kind: set(hashes)}, resources with
+        those hashes are skipped, e.g. those currently reserved.
+
         If do_copy is True, the returned dict is a deep copy and does not share
         lists with any other Resources dict.
 
@@ -305,6 +590,7 @@ class Resources(dict):
         been replicated based on its the 'times' attributes. See
         config.replicate_times() for more details.
         '''
+        index = self.index()
         matches = {}
         for key, want_list in sorted(want.items()): # sorted for deterministic test results
             # here we have a resource of a given type, e.g. 'bts', with a list
@@ -312,8 +598,11 @@ class Resources(dict):
             # list item contains specifics for the particular BTS.
             my_list = self.get(key, [])
 
+            skipped = index.with_hashes(key, (skip_hashes or {}).get(key))
             if log_label:
-                for_origin.log(log_label, len(want_list), 'x', key, '(candidates: %d)'%len(my_list))
+                for_origin.log(log_label, len(want_list), 'x', key, '(candidates: %d)'%(len(my_list) - len(skipped)))
+            if skip_if_marked:
+                skipped = skipped | index.marked(key, skip_if_marked)
 
             # Try to avoid a less constrained item snatching away a resource
             # from a more detailed constrained requirement.
@@ -323,13 +612,9 @@ class Resources(dict):
             # appear for multiple requested items. Store matching indexes.
             all_matches = []
             for want_item in want_list:
-                item_match_list = []
-                for i in range(len(my_list)):
-                    my_item = my_list[i]
-                    if skip_if_marked and my_item.get(skip_if_marked):
-                        continue
-                    if item_matches(my_item, want_item):
-                        item_match_list.append(i)
+                candidates, exact = index.candidates(key, want_item)
+                item_match_list = [i for i in candidates
+                                   if i not in skipped and (exact or item_matches(my_list[i], want_item))]
                 if not item_match_list:
                     if raise_if_missing:
                         raise NoResourceExn('No matching resource available for %s = %r'
@@ -366,21 +651,292 @@ class Resources(dict):
         for key, item_list in self.items():
             for item in item_list:
                 item[HASH_KEY] = util.hash_obj(item, HASH_KEY, RESERVED_KEY, USED_KEY)
+        self.reindex()
 
     def add(self, more):
         if more is self:
             raise RuntimeError('adding a list of resources to itself?')
-        schema.add(self, copy.deepcopy(more))
+        schema.add(self, util.thaw(more))
+        self.reindex()
 
     def mark_reserved_by(self, origin_id):
         for key, item_list in self.items():
             for item in item_list:
-                item[RESERVED_KEY] = origin_id
+                self.set_marker(key, item, RESERVED_KEY, origin_id)
+
+
+# Keys of items that change while the item is in use:
+MARKER_KEYS = (RESERVED_KEY, USED_KEY)
+
+class ResourcesIndex:
+    '''Inverted index of the items of a Resources dict, for Resources.find()
+    to narrow down the candidates for a wanted item by set intersections
+    instead of running item_matches() on each item.
+
+    For each kind of resource, each scalar attribute value is mapped to the
+    set of positions of the items having it, keyed by the attribute's path,
+    e.g. ('osmo_trx', 'launch_trx'). Scalars in lists, like modem features,
+    are mapped as list members. Lists of dicts are positional in
+    item_matches(), so their dicts' attributes have the list position in
+    their path.
+
+    The markers set on items while they are reserved or used are kept in
+    sets of positions updated along with the markers, see
+    Resources.set_marker().'''
+
+    EQ = '='
+    IN = 'in'
+
+    def __init__(self, resources):
+        self.lists = {}
+        self.postings = {}
+        self.positions = {}
+        self.hashes = {}
+        self.markers = {}
+        for key, item_list in resources.items():
+            self.lists[key] = (item_list, len(item_list))
+            self.positions[key] = list(range(len(item_list)))
+            hashes = self.hashes[key] = {}
+            for i, item in enumerate(item_list):
+                self._add_postings(key, (), item, i)
+                if item.get(HASH_KEY):
+                    hashes[item.get(HASH_KEY)] = i
+                for marker in MARKER_KEYS:
+                    if item.get(marker):
+                        self.set_marked(key, i, marker, item.get(marker))
+
+    def is_current(self, resources):
+        if len(resources) != len(self.lists):
+            return False
+        for key, item_list in resources.items():
+            indexed = self.lists.get(key)
+            if indexed is None or indexed[0] is not item_list or indexed[1] != len(item_list):
+                return False
+        return True
+
+    def _add_postings(self, key, path, val, i):
+        if is_dict(val):
+            for attr, attr_val in val.items():
+                if not path and (attr in MARKER_KEYS or attr == HASH_KEY):
+                    continue
+                self._add_postings(key, path + (attr,), attr_val, i)
+        elif is_list(val):
+            for pos, elem in enumerate(val):
+                if is_dict(elem):
+                    self._add_postings(key, path + (pos,), elem, i)
+                elif not is_list(elem):
+                    self.postings.setdefault((key, path, ResourcesIndex.IN, elem), set()).add(i)
+        else:
+            self.postings.setdefault((key, path, ResourcesIndex.EQ, val), set()).add(i)
+
+    def _want_postings(self, path, wanted, keys):
+        '''Append to keys the postings keys that all items matching wanted
+        are in. Return True if being in all of them is also sufficient for
+        item_matches() to succeed, i.e. there is no need to run it.'''
+        if is_dict(wanted):
+            exact = True
+            found = len(keys)
+            for attr, wanted_val in wanted.items():
+                exact = self._want_postings(path + (attr,), wanted_val, keys) and exact
+            # a nested dict must exist, which a postings key below it implies:
+            return exact and (not path or len(keys) > found)
+        if is_list(wanted):
+            if not wanted:
+                return False
+            if all(is_dict(elem) for elem in wanted):
+                exact = True
+                found = len(keys)
+                for pos, elem in enumerate(wanted):
+                    if elem:
+                        exact = self._want_postings(path + (pos,), elem, keys) and exact
+                return exact and len(keys) > found
+            if any(is_dict(elem) or is_list(elem) for elem in wanted):
+                return False
+            for elem in wanted:
+                keys.append((ResourcesIndex.IN, path, elem))
+            return True
+        if wanted is None:
+            # also matches a missing attribute
+            return False
+        keys.append((ResourcesIndex.EQ, path, wanted))
+        return True
+
+    def candidates(self, key, want_item):
+        '''Return the positions of items of kind key that may match
+        want_item, in order, and whether all of them do match.'''
+        keys = []
+        exact = self._want_postings((), want_item, keys)
+        if not keys:
+            return self.positions.get(key, []), exact
+        sets = sorted((self.postings.get((key, path, op, val), set()) for op, path, val in keys), key=len)
+        return sorted(set.intersection(*sets)), exact
+
+    def with_hashes(self, key, hashes):
+        if not hashes:
+            return set()
+        key_hashes = self.hashes.get(key, {})
+        return set(key_hashes[h] for h in hashes if h in key_hashes)
+
+    def position(self, key, item):
+        i = self.hashes.get(key, {}).get(item.get(HASH_KEY))
+        if i is not None and self.lists[key][0][i] is item:
+            return i
+        for i, my_item in enumerate(self.lists[key][0]):
+            if my_item is item:
+                return i
+        raise RuntimeError('Item is not in the indexed resources: %s = %r' % (key, item))
+
+    def marked(self, key, marker):
+        return self.markers.get((key, marker), set())
+
+    def set_marked(self, key, i, marker, value=True):
+        if value:
+            self.markers.setdefault((key, marker), set()).add(i)
+        else:
+            self.markers.get((key, marker), set()).discard(i)
 
 
 class NotSolvable(Exception):
     pass
 
+def _alternating_path(start, all_matches, match_idx, may_visit):
+    '''Depth-first search for an alternating path from item start, through
+    indexes matched to items for which may_visit(item, from_item) is True
+    (which is responsible for marking items as visited), up to a free index.
+    Return the path as a list of (item, idx) pairs to be matched, or None.'''
+    # iterative, paths may be longer than the recursion limit:
+    stack = [[start, iter(all_matches[start]), None]]
+    while stack:
+        entry = stack[-1]
+        for idx in entry[1]:
+            if idx not in match_idx:
+                entry[2] = idx
+                return [(item, item_idx) for item, _, item_idx in stack]
+            item = match_idx[idx]
+            if may_visit(item, entry[0]):
+                entry[2] = idx
+                stack.append([item, iter(all_matches[item]), None])
+                break
+        else:
+            stack.pop()
+    return None
+
+def _apply_path(path, match_item, match_idx):
+    for item, idx in path:
+        match_item[item] = idx
+        match_idx[idx] = item
+
+def _max_matching(all_matches):
+    '''Hopcroft-Karp maximum bipartite matching of items to indexes. Return
+    the list of indexes matched to each item, None for unmatched items.'''
+    match_item = [None] * len(all_matches)
+    match_idx = {}
+    # greedy start in order of preference, usually most of the final result:
+    for item, candidates in enumerate(all_matches):
+        for idx in candidates:
+            if idx not in match_idx:
+                match_item[item] = idx
+                match_idx[idx] = item
+                break
+
+    while True:
+        # breadth-first: layer items by their distance to free items
+        free = [item for item in range(len(all_matches)) if match_item[item] is None]
+        dist = dict([(item, 0) for item in free])
+        queue = list(free)
+        found = False
+        for item in queue:
+            for idx in all_matches[item]:
+                other = match_idx.get(idx)
+                if other is None:
+                    found = True
+                elif other not in dist:
+                    dist[other] = dist[item] + 1
+                    queue.append(other)
+        if not found:
+            return match_item
+
+        # depth-first: augment along vertex-disjoint shortest paths
+        visited = set(free)
+        def may_visit(item, from_item):
+            if item in visited or dist.get(item) != dist[from_item] + 1:
+                return False
+            visited.add(item)
+            return True
+        for start in free:
+            path = _alternating_path(start, all_matches, match_idx, may_visit)
+            if path:
+                _apply_path(path, match_item, match_idx)
+
+def _rematch_path(start, all_matches, match_idx, blocked, item_kind, explored_kinds):
+    '''Breadth-first search for an alternating path from the unmatched item
+    start to a free index, not passing through blocked items. Items of the
+    same kind have the same candidates, so only the first one reached of each
+    kind is explored; kinds already in explored_kinds are not explored again.
+    Return the path as a list of (item, idx) pairs to be matched, or None.'''
+    reached_from = {start: None}
+    queue = [start]
+    for item in queue:
+        kind = item_kind[item]
+        if kind in explored_kinds:
+            continue
+        explored_kinds.add(kind)
+        for idx in all_matches[item]:
+            other = match_idx.get(idx)
+            if other is None:
+                path = [(item, idx)]
+                while reached_from[item] is not None:
+                    item, idx = reached_from[item]
+                    path.append((item, idx))
+                return path
+            if other in reached_from or other in blocked:
+                continue
+            reached_from[other] = (item, idx)
+            queue.append(other)
+    return None
+
+def _first_matching(all_matches, match_item):
+    '''Turn the complete matching match_item into the first one in the order
+    of the items and their candidate lists, the preference expressed by the
+    caller: for each item in turn, move it to its earliest candidate for which
+    the items after it can still be rematched.'''
+    match_idx = dict([(idx, item) for item, idx in enumerate(match_item)])
+    kinds = {}
+    item_kind = [kinds.setdefault(tuple(candidates), len(kinds)) for candidates in all_matches]
+    fixed = set()
+    for item, candidates in enumerate(all_matches):
+        fixed.add(item)
+        # The matching is restored after each failed attempt, so kinds found
+        # unable to be rematched stay so until an attempt succeeds:
+        dead_kinds = set()
+        for idx in candidates:
+            current = match_item[item]
+            if idx == current:
+                break
+            other = match_idx.get(idx)
+            if other in fixed or (other is not None and item_kind[other] in dead_kinds):
+                continue
+            # take idx, releasing the current one, and look for a way to
+            # rematch the item idx is taken from:
+            del match_idx[current]
+            match_item[item] = idx
+            match_idx[idx] = item
+            if other is None:
+                break
+            match_item[other] = None
+            explored_kinds = set()
+            path = _rematch_path(other, all_matches, match_idx, fixed, item_kind, explored_kinds)
+            if path:
+                _apply_path(path, match_item, match_idx)
+                break
+            dead_kinds.update(explored_kinds)
+            # undo
+            match_item[other] = idx
+            match_idx[idx] = other
+            match_item[item] = current
+            match_idx[current] = item
+    return match_item
+
 def solve(all_matches):
     '''
     all_matches shall be a list of index-lists.
@@ -389,39 +945,19 @@ def solve(all_matches):
     solve([ [0, 1, 2],
             [0],
             [0, 2] ]) == [1, 0, 2]
-    '''
-
-    def all_differ(l):
-        return len(set(l)) == len(l)
-
-    def search_in_permutations(fixed=[]):
-        idx = len(fixed)
-        for i in range(len(all_matches[idx])):
-            val = all_matches[idx][i]
-            # don't add a val that's already in the list
-            if val in fixed:
-                continue
-            l = list(fixed)
-            l.append(val)
-            if len(l) == len(all_matches):
-                # found a solution
-                return l
-            # not at the end yet, add next digit
-            r = search_in_permutations(l)
-            if r:
-                # nested search_in_permutations() call found a solution
-                return r
-        # this entire branch yielded no solution
-        return None
 
+    The solution is the first one in order of the items and of their index
+    lists, so callers express preferences by ordering. It is found through
+    maximum bipartite matching in polynomial time, also when there is none.
+    '''
     if not all_matches:
         raise RuntimeError('Cannot solve: no candidates')
 
-    solution = search_in_permutations()
-    if not solution:
+    solution = _max_matching(all_matches)
+    if None in solution:
         raise NotSolvable('The requested resource requirements are not solvable %r'
                           % all_matches)
-    return solution
+    return _first_matching(all_matches, solution)
 
 
 def contains_hash(list_of_dicts, a_hash):
@@ -479,7 +1015,12 @@ class ReservedResources(log.Origin):
         self.resources_pool = resources_pool
         self.origin = origin
         self.reserved_original = reserved
-        self.reserved = copy.deepcopy(self.reserved_original)
+        # Only the items are plain dicts, to set markers on. Their attributes
+        # are frozen and shared with the items get() returns, which copy only
+        # what gets modified, see util.cow_view().
+        self.reserved = Resources(dict((key, [dict(util.freeze(item)) for item in item_list])
+                                       for key, item_list in reserved.items()),
+                                  do_copy=False)
         config.overlay(self.reserved, modifiers)
 
     def __repr__(self):
@@ -526,8 +1067,8 @@ class ReservedResources(log.Origin):
         pick = available[0]
         self.dbg(using=pick)
         assert not pick.get(USED_KEY)
-        pick[USED_KEY] = True
-        return copy.deepcopy(pick)
+        self.reserved.set_marker(kind, pick, USED_KEY)
+        return util.cow_view(util.freeze(pick))
 
     def put(self, item):
         if not item.get(USED_KEY):
@@ -536,17 +1077,16 @@ class ReservedResources(log.Origin):
         if not hash_to_put:
             raise RuntimeError('Can only put() a resource that has a hash marker: %r' % item)
         for key, item_list in self.reserved.items():
-            my_list = self.get(key)
-            for my_item in my_list:
+            for my_item in item_list:
                 if hash_to_put == my_item.get(HASH_KEY):
-                    my_item.pop(USED_KEY)
+                    self.reserved.set_marker(key, my_item, USED_KEY, False)
 
     def put_all(self):
         if not self.reserved:
             return
         for key, item_list in self.reserved.items():
             for item in item_list:
-                item.pop(USED_KEY, None)
+                self.reserved.set_marker(key, item, USED_KEY, False)
 
     def free(self):
         if self.reserved_original:
@@ -19,9 +19,11 @@
 
 import re
 import os
+import pickle
 
 from . import log
 from . import util
+from .. import __version__
 
 KEY_RE = re.compile('[a-zA-Z0-9][a-zA-Z0-9_]*')
 IPV4_RE = re.compile('([0-9]{1,3}.){3}[0-9]{1,3}')
@@ -284,17 +286,20 @@ def replicate_times(d):
     'd' is a dict matching WANT_SCHEMA, which is the same as
     the RESOURCES_SCHEMA, except each entity that can be reserved has a 'times'
     field added, to indicate how many of those should be reserved.
+
+    The replicated items are writable views sharing one frozen copy of the
+    original item, see util.cow_view().
     '''
-    d = copy.deepcopy(d)
+    replicated = {}
     for key, item_list in d.items():
-        idx = 0
-        while idx < len(item_list):
-            item = item_list[idx]
-            times = int(item.pop('times', 1))
-            for j in range(1, times):
-                item_list.insert(idx + j, copy.deepcopy(item))
-            idx += times
-    return d
+        replicated[key] = []
+        for item in item_list:
+            item = util.freeze(item)
+            for j in range(max(int(item.get('times', 1)), 1)):
+                view = util.cow_view(item)
+                view.pop('times', None)
+                replicated[key].append(view)
+    return replicated
 
 def validate(config, schema):
     '''Make sure the given config dict adheres to the schema.
@@ -307,57 +312,123 @@ def validate(config, schema):
                    'b.b2[]': int } )
 
        Raise a ValueError in case the schema is violated.
-    '''
 
-    def validate_item(path, value, schema):
-        want_type = schema.get(path)
-
-        if util.is_list(value):
+       The schema is compiled on first use, see CompiledSchema.
+    '''
+    compiled(schema).validate(config)
+
+# {id(schema): CompiledSchema}
+_compiled_schemas = {}
+_COMPILED_SCHEMAS_MAX = 64
+
+def compiled(schema):
+    '''Return the CompiledSchema of schema, compiled again if entries were
+    added to the schema since the last time.'''
+    c = _compiled_schemas.get(id(schema))
+    if c is None or c.schema is not schema or c.schema_len != len(schema):
+        if len(_compiled_schemas) >= _COMPILED_SCHEMAS_MAX:
+            _compiled_schemas.clear()
+        c = CompiledSchema(schema)
+        _compiled_schemas[id(schema)] = c
+    return c
+
+class CompiledSchema:
+    '''A schema turned into a tree of validator closures, one per path of the
+    schema, deciding at compile time what is expected where. Validating a
+    config then only walks the config, without building path strings and
+    looking them up in the schema for each item.
+
+    Validates exactly like walking the config against the schema would,
+    including the order in which problems are found and their error
+    messages.'''
+
+    def __init__(self, schema):
+        # kept referenced, so its id isn't reused while cached:
+        self.schema = schema
+        self.schema_len = len(schema)
+        # {path: set of keys of dicts found at path}
+        self.child_keys = {}
+        for key in schema.keys():
+            parent = ''
+            for token in key.split('.'):
+                self.child_keys.setdefault(parent, set()).add(token.split('[', 1)[0])
+                parent = parent + '.' + token if parent else token
+        self.root = self.dict_validator('', self.child_keys.get('', ()))
+
+    def validate(self, config):
+        self.root(config)
+
+    def dict_validator(self, path, keys):
+        prefix = path + '.' if path else ''
+        children = {}
+        for key in keys:
+            if not KEY_RE.fullmatch(key):
+                # fail like any other invalid key
+                continue
+            children[key] = self.item_validator(prefix + key)
+        item_validator = self.item_validator
+
+        def validate_dict(config):
+            for k, v in config.items():
+                child = children.get(k)
+                if child is None:
+                    if not KEY_RE.fullmatch(k):
+                        raise ValueError('invalid config key: %r' % k)
+                    child = item_validator(prefix + k)
+                child(v)
+        return validate_dict
+
+    def item_validator(self, path):
+        want_type = self.schema.get(path)
+        list_path = path + '[]'
+        list_want_type = self.schema.get(list_path)
+        list_item_validator = None
+
+        def validate_list(value):
+            nonlocal list_item_validator
             if want_type:
                 raise ValueError('config item is a list, should be %r: %r' % (want_type, path))
-            path = path + '[]'
-            want_type = schema.get(path)
+            if list_want_type and list_want_type not in SCHEMA_TYPES:
+                raise ValueError('unknown type %r at %r' % (list_want_type, list_path))
+            if list_item_validator is None:
+                # compiled on first use, lists of lists of ... may nest
+                # without end
+                list_item_validator = self.item_validator(list_path)
+            for list_v in value:
+                list_item_validator(list_v)
 
         if not want_type:
-            if util.is_dict(value):
-                nest(path, value, schema)
-                return
-            if util.is_list(value):
-                for list_v in value:
-                    validate_item(path, list_v, schema)
-                return
-            raise ValueError('config item not known: %r' % path)
-
-        if want_type not in SCHEMA_TYPES:
-            raise ValueError('unknown type %r at %r' % (want_type, path))
+            validate_dict = self.dict_validator(path, self.child_keys.get(path, ()))
+            def validate_item(value):
+                if isinstance(value, (list, tuple)):
+                    validate_list(value)
+                elif isinstance(value, dict):
+                    validate_dict(value)
+                else:
+                    raise ValueError('config item not known: %r' % path)
+            return validate_item
 
-        if util.is_dict(value):
-            raise ValueError('config item is dict but should be a leaf node of type %r: %r'
-                             % (want_type, path))
-
-        if util.is_list(value):
-            for list_v in value:
-                validate_item(path, list_v, schema)
-            return
-
-        log.ctx(path)
         type_validator = SCHEMA_TYPES.get(want_type)
-        valid = type_validator(value)
-        if not valid:
-            raise ValueError('Invalid value %r for schema type \'%s\' (validator: %s)' % (value, want_type, type_validator.__name__))
-
-    def nest(parent_path, config, schema):
-        if parent_path:
-            parent_path = parent_path + '.'
-        else:
-            parent_path = ''
-        for k,v in config.items():
-            if not KEY_RE.fullmatch(k):
-                raise ValueError('invalid config key: %r' % k)
-            path = parent_path + k
-            validate_item(path, v, schema)
-
-    nest(None, config, schema)
+        def validate_leaf(value):
+            if isinstance(value, (list, tuple)):
+                validate_list(value)
+                return
+            if type_validator is None:
+                raise ValueError('unknown type %r at %r' % (want_type, path))
+            if isinstance(value, dict):
+                raise ValueError('config item is dict but should be a leaf node of type %r: %r'
+                                 % (want_type, path))
+            try:
+                valid = type_validator(value)
+            except Exception:
+                log.ctx(path)
+                raise
+            if not valid:
+                log.ctx(path)
+                # the type may have been registered lazily, name the actual validator:
+                validator_name = SCHEMA_TYPES.get(want_type, type_validator).__name__
+                raise ValueError('Invalid value %r for schema type \'%s\' (validator: %s)' % (value, want_type, validator_name))
+        return validate_leaf
 
 def config_to_schema_def(src, key_prefix):
     'Converts a yaml parsed config into a schema dictionary used by validate()'
@@ -380,15 +451,96 @@ def config_to_schema_def(src, key_prefix):
     return {key_prefix: str(src)}
 
 
-def generate_schemas():
-    "Generate supported schemas dynamically from objects"
+# What the object modules register, see generate_schemas():
+SCHEMA_MANIFEST_FILE = 'schema_manifest.pickle'
+
+def generate_schemas(cache_dir=None):
+    '''Generate supported schemas dynamically from objects. Each object module
+    registers its schemas in its on_register_schemas(), so all of them need
+    to be imported.
+
+    If cache_dir is passed, what the object modules register is kept there
+    in a manifest, valid as long as the object modules and the version of
+    osmo-gsm-tester remain the same. As long as it is, object modules aren't
+    imported here at all, but only once a test uses them. Without cache_dir,
+    all object modules are imported right away.'''
     obj_dir = '%s/../obj/' % os.path.dirname(os.path.abspath(__file__))
-    for filename in os.listdir(obj_dir):
-        if not filename.endswith(".py"):
-            continue
+    filenames = sorted(filename for filename in os.listdir(obj_dir) if filename.endswith('.py'))
+    key = (__version__, [(filename, os.stat(obj_dir + filename).st_mtime_ns) for filename in filenames])
+    manifest_path = os.path.join(cache_dir, SCHEMA_MANIFEST_FILE) if cache_dir else None
+    manifest = read_schema_manifest(manifest_path, key) if manifest_path else None
+    if manifest is not None:
+        for module_name, registered in manifest:
+            replay_schemas(module_name, registered)
+        return
+    manifest = []
+    for filename in filenames:
         module_name = 'osmo_gsm_tester.obj.%s' % filename[:-3]
+        manifest.append((module_name, record_schemas(module_name)))
+    if manifest_path:
+        write_schema_manifest(manifest_path, key, manifest)
+
+def read_schema_manifest(manifest_path, key):
+    try:
+        with open(manifest_path, 'rb') as f:
+            manifest_key, manifest = pickle.load(f)
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        return None
+    if manifest_key != key:
+        return None
+    return manifest
+
+def write_schema_manifest(manifest_path, key, manifest):
+    try:
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (manifest_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((key, manifest), f)
+        os.replace(tmp_path, manifest_path)
+    except OSError:
+        # the manifest is only an optimization
+        pass
+
+# Calls to the register_*() functions below, while recording:
+_registered = None
+
+def record_schemas(module_name):
+    '''Run on_register_schemas() of the module, return what it registered.'''
+    global _registered
+    _registered = []
+    try:
         util.run_python_file_method(module_name, 'on_register_schemas', False)
-
+        return _registered
+    finally:
+        _registered = None
+
+def replay_schemas(module_name, registered):
+    '''Register again what record_schemas() returned, without importing the
+    module. Schema types are validator functions of the module, those are
+    registered as placeholders importing the module on first use.'''
+    for what, *args in registered:
+        if what == 'types':
+            for type_name in args[0]:
+                if type_name not in SCHEMA_TYPES:
+                    SCHEMA_TYPES[type_name] = lazy_schema_type(module_name, type_name)
+            _compiled_schemas.clear()
+        elif what == 'resource':
+            register_resource_schema(*args)
+        elif what == 'config':
+            register_config_schema(*args)
+
+def lazy_schema_type(module_name, type_name):
+    def validate_lazily(val):
+        if SCHEMA_TYPES.get(type_name) is validate_lazily:
+            # on_register_schemas() of the module registers the actual ones,
+            # which can't be combined with any placeholder left:
+            for name, validate in list(SCHEMA_TYPES.items()):
+                if getattr(validate, 'lazy_module_name', None) == module_name:
+                    del SCHEMA_TYPES[name]
+            util.run_python_file_method(module_name, 'on_register_schemas', False)
+        return SCHEMA_TYPES[type_name](val)
+    validate_lazily.lazy_module_name = module_name
+    return validate_lazily
 
 _RESOURCE_TYPES = ['ip_address',]
 
@@ -406,7 +558,11 @@ def register_schema_types(schema_type_attr):
        For instance: register_resource_schema_attributes({ 'fruit': lambda val: val in ('banana', 'apple') })
     """
     global SCHEMA_TYPES
+    if _registered is not None:
+        _registered.append(('types', list(schema_type_attr.keys())))
     combine(SCHEMA_TYPES, schema_type_attr)
+    # compiled schemas may lack the validators of new types:
+    _compiled_schemas.clear()
 
 def register_resource_schema(obj_class_str, obj_attr_dict):
     """Register schema attributes for a resource type.
@@ -414,6 +570,8 @@ def register_resource_schema(obj_class_str, obj_attr_dict):
     """
     global _RESOURCES_SCHEMA
     global _RESOURCE_TYPES
+    if _registered is not None:
+        _registered.append(('resource', obj_class_str, dict(obj_attr_dict)))
     tmpdict = {}
     for key, val in obj_attr_dict.items():
         new_key = '%s[].%s' % (obj_class_str, key)
@@ -427,6 +585,8 @@ def register_config_schema(obj_class_str, obj_attr_dict):
        For instance: register_resource_schema_attributes('bsc', {'net.codec_list[]': schema.CODEC})
     """
     global _CONFIG_SCHEMA, _ALL_SCHEMA
+    if _registered is not None:
+        _registered.append(('config', obj_class_str, dict(obj_attr_dict)))
     tmpdict = {}
     for key, val in obj_attr_dict.items():
         new_key = '%s.%s' % (obj_class_str, key)
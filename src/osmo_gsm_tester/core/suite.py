@@ -163,6 +163,16 @@ class SuiteRun(log.Origin):
         # short summary of labels
         self.log('RESERVED RESOURCES for ' + self.suite_name() + ':\n' + self.reserved_resources.summary_str())
 
+    def try_reserve_resources(self):
+        'Reserve resources only if available right now, return whether they were'
+        if self.reserved_resources:
+            raise RuntimeError('Attempt to reserve resources twice for a SuiteRun')
+        self.reserved_resources = self.resources_pool.try_reserve(self, self.resource_requirements(), self.resource_modifiers())
+        if not self.reserved_resources:
+            return False
+        self.log('RESERVED RESOURCES for ' + self.suite_name() + ':\n' + self.reserved_resources.summary_str())
+        return True
+
     def get_reserved_resource(self, resource_class_str, specifics):
         return self.reserved_resources.get(resource_class_str, specifics=specifics)
 
@@ -222,6 +232,21 @@ class SuiteRun(log.Origin):
                 errors += 1
         return (passed, skipped, failed, errors)
 
+    def get_results(self):
+        '''Return the outcome of run_tests() as plain data, for set_results()
+        on the same SuiteRun in another process.'''
+        return dict(start_timestamp=self.start_timestamp,
+                    duration=self.duration,
+                    status=self.status,
+                    tests=[t.get_results() for t in self.tests])
+
+    def set_results(self, results):
+        self.start_timestamp = results['start_timestamp']
+        self.duration = results['duration']
+        self.status = results['status']
+        for t, test_results in zip(self.tests, results['tests']):
+            t.set_results(test_results)
+
     def free_resources(self):
         if self.reserved_resources is None:
             return
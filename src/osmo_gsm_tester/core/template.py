@@ -19,13 +19,22 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-from mako.lookup import TemplateLookup, Template
+import hashlib
 
 from . import log
-from .util import dict2obj
+from .util import dict2obj, get_tempdir, thaw, LazyModule
+
+mako_lookup = LazyModule('mako.lookup')
+
+# Directory to keep compiled templates in, to share them among all tests and
+# trials using the same one. If None, compiled templates are kept in a
+# temporary directory, shared by the tests of this process only.
+cache_dir = None
 
 _lookup = None
 _logger = log.Origin(log.C_CNF, 'no templates dir set')
+# {template text: compiled template} for render_strbuf_inline()
+_inline_templates = {}
 
 def default_templates_dir():
     return os.path.join(os.path.dirname(os.path.dirname(__file__)), 'templates')
@@ -41,9 +50,26 @@ def set_templates_dir(*templates_dirs):
         if not os.path.isdir(d):
             raise RuntimeError('templates dir is not a dir: %r'
                                % os.path.abspath(d))
-    _lookup = TemplateLookup(directories=templates_dirs)
+    _lookup = mako_lookup.TemplateLookup(directories=templates_dirs,
+                    modulename_callable=lambda filename, uri: compiled_template_path(filename, uri, templates_dirs))
     _logger = log.Origin(log.C_CNF, 'Templates')
 
+def get_cache_dir():
+    if cache_dir is not None:
+        return cache_dir
+    return os.path.join(get_tempdir(), 'templates')
+
+def compiled_template_path(filename, uri, templates_dirs):
+    '''Return the path to keep the compiled template of filename in. It
+    depends on the content of the file, and on the templates dirs used to
+    look it up, which includes the overlay dirs, so that a cached template
+    is only used for exactly the same template. mako compiles the template
+    there if the file doesn't exist yet.'''
+    h = hashlib.sha1(repr((uri, [os.path.abspath(d) for d in templates_dirs])).encode('utf-8'))
+    with open(filename, 'rb') as f:
+        h.update(f.read())
+    return os.path.join(get_cache_dir(), '%s.%s.py' % (os.path.basename(filename), h.hexdigest()))
+
 def render(name, values):
     '''feed values dict into template and return rendered result.
        ".tmpl" is added to the name to look it up in the templates dir.'''
@@ -55,12 +81,15 @@ def render(name, values):
     template = _lookup.get_template(tmpl_name)
     _logger.dbg('rendering', tmpl_name)
 
-    return template.render(**dict2obj(values))
+    return template.render(**dict2obj(thaw(values)))
 
 def render_strbuf_inline(strbuf, values):
     '''Receive a string containing template syntax, and generate output using
        passed values.'''
-    mytemplate = Template(strbuf)
-    return mytemplate.render(**dict2obj(values))
+    mytemplate = _inline_templates.get(strbuf)
+    if mytemplate is None:
+        mytemplate = mako_lookup.Template(strbuf)
+        _inline_templates[strbuf] = mytemplate
+    return mytemplate.render(**dict2obj(thaw(values)))
 
 # vim: expandtab tabstop=4 shiftwidth=4
@@ -48,6 +48,7 @@ class Test(log.Origin):
         self.duration = 0
         self.fail_type = None
         self.fail_message = None
+        self.fail_tb = None
         self.log_targets = []
         self._report_stdout = None
         self._kpis = None
@@ -161,11 +162,39 @@ class Test(log.Origin):
             return self._report_stdout
         # Otherwise vy default provide the entire test brief log:
         if len(self.log_targets) == 2 and self.log_targets[1].log_file_path() is not None:
-            with open(self.log_targets[1].log_file_path(), 'r') as myfile:
-                return myfile.read()
+            return self.log_targets[1].get_output()
         else:
             return 'test log file not available'
 
+    def get_results(self):
+        'Return the outcome of run() as plain data, see SuiteRun.get_results()'
+        return dict(status=self.status,
+                    start_timestamp=self.start_timestamp,
+                    duration=self.duration,
+                    fail_type=self.fail_type,
+                    fail_message=self.fail_message,
+                    fail_tb=self.fail_tb,
+                    kpis=self._kpis,
+                    report_stdout=self.report_stdout(),
+                    report_fragments=[dict(name=f.name, result=f.result, duration=f.duration, output=f.output)
+                                      for f in self.report_fragments])
+
+    def set_results(self, results):
+        self.status = results['status']
+        self.start_timestamp = results['start_timestamp']
+        self.duration = results['duration']
+        self.fail_type = results['fail_type']
+        self.fail_message = results['fail_message']
+        self.fail_tb = results['fail_tb']
+        self._kpis = results['kpis']
+        self._report_stdout = results['report_stdout']
+        self.report_fragments = []
+        for fragment_results in results['report_fragments']:
+            fragment = Test.ReportFragment(parent_test=self, name=fragment_results['name'],
+                                           output=fragment_results['output'])
+            fragment.result = fragment_results['result']
+            fragment.duration = fragment_results['duration']
+
     def log_file(self):
         for lt in self.log_targets:
             if isinstance(lt, log.FileLogTarget):
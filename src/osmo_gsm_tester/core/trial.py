@@ -18,7 +18,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import sys
 import time
+import pickle
+import signal
 import shutil
 import tarfile
 import pathlib
@@ -27,11 +30,15 @@ from . import log
 from . import util
 from . import report
 from . import suite
+from . import resource
+from . import remote
+from .event_loop import MainLoop
 
 FILE_MARK_TAKEN = 'taken'
 FILE_CHECKSUMS = 'checksums.md5'
 TIMESTAMP_FMT = '%Y-%m-%d_%H-%M-%S'
 FILE_LAST_RUN = 'last_run'
+FILE_SUITE_RESULTS = 'results.pickle'
 
 class Trial(log.Origin):
     UNKNOWN = 'UNKNOWN'
@@ -57,6 +64,7 @@ class Trial(log.Origin):
         self.dir = util.Dir(self.path)
         self.inst_dir = util.Dir(self.dir.child('inst'))
         self.bin_tars = {}
+        self.bin_tar_md5s = {}
         self.suites = []
         self.status = Trial.UNKNOWN
         self._run_dir = None
@@ -84,6 +92,7 @@ class Trial(log.Origin):
 
     def __exit__(self, *exc_info):
         '''log a report, then remove log file targets for this trial'''
+        remote.ssh_pool.close_all()
         self.log_report()
         for lt in self.log_targets:
             lt.remove()
@@ -141,6 +150,7 @@ class Trial(log.Origin):
                     li = self.bin_tars.get(label, [])
                     li.append(name)
                     self.bin_tars[label] = li
+                    self.bin_tar_md5s[file_path] = md5
 
     def has_bin_tar(self, bin_name, run_label):
         bin_tar_start = '%s.' % bin_name
@@ -156,6 +166,21 @@ class Trial(log.Origin):
             raise RuntimeError('Not a file or missing: %r' % bin_tar_path)
         return bin_tar_path
 
+    def get_bin_tar_md5(self, bin_name, run_label=None):
+        '''Return (path, md5) of the binary tarball bin_name is installed from,
+        the md5 identifying the content of the inst tree returned by
+        get_inst().'''
+        if run_label is None:
+            run_label = ''
+        bin_tar = self.has_bin_tar(bin_name, run_label)
+        if not bin_tar:
+            raise RuntimeError('No such binary available: %r' % bin_name)
+        md5 = self.bin_tar_md5s.get(bin_tar)
+        if md5 is None:
+            md5 = util.md5_of_file(bin_tar)
+            self.bin_tar_md5s[bin_tar] = md5
+        return bin_tar, md5
+
     def get_inst(self, bin_name, run_label=None):
         if run_label is None:
             run_label = ''
@@ -189,21 +214,26 @@ class Trial(log.Origin):
         suite_run = suite.SuiteRun(self, suite_scenario_str, suite_def, scenarios)
         self.suites.append(suite_run)
 
-    def run_suites(self, names=None):
+    def run_suites(self, names=None, jobs=1):
+        '''Run all suites, with jobs > 1 up to that many at a time in worker
+        processes, see SuiteRunScheduler.'''
         self.status = Trial.UNKNOWN
         try:
-            for suite_run in self.suites:
-                try:
-                    suite_run.run_tests(names)
-                except BaseException as e:
-                    # when the program is aborted by a signal (like Ctrl-C), escalate to abort all.
-                    self.err('TRIAL RUN ABORTED: %s' % type(e).__name__)
-                    # log the traceback before the trial's logging is ended
-                    log.log_exn()
-                    raise
-                finally:
-                    if suite_run.status != suite.SuiteRun.PASS:
-                        self.status = Trial.FAIL
+            try:
+                if jobs > 1:
+                    SuiteRunScheduler(self, jobs).run(names)
+                else:
+                    for suite_run in self.suites:
+                        suite_run.run_tests(names)
+            except BaseException as e:
+                # when the program is aborted by a signal (like Ctrl-C), escalate to abort all.
+                self.err('TRIAL RUN ABORTED: %s' % type(e).__name__)
+                # log the traceback before the trial's logging is ended
+                log.log_exn()
+                raise
+            finally:
+                if any(suite_run.status != suite.SuiteRun.PASS for suite_run in self.suites):
+                    self.status = Trial.FAIL
             if self.status == Trial.UNKNOWN:
                 self.status = Trial.PASS
         finally:
@@ -231,4 +261,153 @@ class Trial(log.Origin):
         log.large_separator(self.name(), self.status)
         self.log(report.trial_to_text(self))
 
+class SuiteRunScheduler(log.Origin):
+    '''Run the SuiteRuns of a trial in up to max_jobs worker processes at a
+    time. A SuiteRun is started as soon as its resources can be reserved, so
+    that suites needing disjoint resources run in parallel. Suites are
+    started in order, but one that has to wait for its resources doesn't
+    hold back later ones whose resources are available.
+
+    Resources are reserved here and handed over to the worker, which frees
+    them when done. Resources a worker leaves behind when dying are freed
+    once it exited.
+
+    Each worker is a fork of this process, and so has its own MainLoop. It
+    logs to 'log' and 'log_brief' files in the SuiteRun's run dir instead of
+    the trial's, and passes the results back in a file next to them, so
+    that the trial's report covers all suites.'''
+
+    # How often to retry reserving resources for pending suites while
+    # waiting for workers, in case other osmo-gsm-tester instances freed some:
+    RESERVE_RETRY_SECS = 10
+
+    def __init__(self, trial, max_jobs):
+        super().__init__(log.C_TST, 'scheduler')
+        self.trial = trial
+        self.max_jobs = max_jobs
+        self.pending = []
+        self.running = {}
+
+    def run(self, names=None):
+        self.pending = list(self.trial.suites)
+        self.running = {}
+        try:
+            while self.pending or self.running:
+                self.start_reserved(names)
+                if not self.running:
+                    # Nothing can be reserved right now, all is taken by other
+                    # instances: let the first suite wait for its resources
+                    # like it would without scheduler.
+                    self.start_worker(self.pending.pop(0), names)
+                MainLoop.wait_no_raise(self.reap_workers, [], {},
+                                       timeout=SuiteRunScheduler.RESERVE_RETRY_SECS, timestep=1)
+        except BaseException:
+            self.stop_workers()
+            raise
+
+    def start_reserved(self, names):
+        for suite_run in list(self.pending):
+            if len(self.running) >= self.max_jobs:
+                return
+            try:
+                ready = suite_run.try_reserve_resources()
+            except Exception:
+                # can never be reserved, let the worker fail on it like
+                # SuiteRun.run_tests() does
+                ready = True
+            if ready:
+                self.pending.remove(suite_run)
+                self.start_worker(suite_run, names)
+
+    def start_worker(self, suite_run, names):
+        # created before forking, so that the worker logs and passes results
+        # in there:
+        results_path = suite_run.get_run_dir().child(FILE_SUITE_RESULTS)
+        # computed before forking, to be able to free what the worker reserved
+        origin_id = suite_run.origin_id()
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            self.run_worker(suite_run, names, results_path)
+            # not reached
+        if suite_run.reserved_resources:
+            # the worker frees them
+            suite_run.resources_pool.forget_freed(suite_run.reserved_resources.reserved_original)
+            suite_run.reserved_resources = None
+        suite_run.mark_start()
+        self.running[pid] = (suite_run, results_path, origin_id)
+        self.log('Started worker', suite_run=suite_run.name(), pid=pid, running=len(self.running))
+
+    def run_worker(self, suite_run, names, results_path):
+        exitcode = 1
+        try:
+            for lt in self.trial.log_targets or []:
+                lt.remove()
+            run_dir = suite_run.get_run_dir()
+            log.FileLogTarget(run_dir.new_child(log.FILE_LOG)) \
+              .set_all_levels(log.L_DBG) \
+              .style_change(trace=True)
+            log.FileLogTarget(run_dir.new_child(log.FILE_LOG_BRIEF)) \
+              .style_change(src=False, all_origins_on_levels=(log.L_ERR, log.L_TRACEBACK))
+            suite_run.run_tests(names)
+            tmp_path = results_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(suite_run.get_results(), f)
+            os.rename(tmp_path, results_path)
+            exitcode = 0
+        except BaseException:
+            log.log_exn()
+        finally:
+            # atexit handlers don't run on os._exit(), give back the blocks
+            # of MSISDNs etc. taken by this worker here
+            try:
+                resource.ResourcesPool.return_unused_persistent_values()
+            except Exception:
+                log.log_exn()
+            log.flush()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            # skip the parent's atexit handlers, like freeing its resources
+            os._exit(exitcode)
+
+    def reap_workers(self):
+        '''Collect results of exited workers, return whether any exited.'''
+        reaped = False
+        for pid in list(self.running.keys()):
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if not done:
+                continue
+            reaped = True
+            suite_run, results_path, origin_id = self.running.pop(pid)
+            self.collect_results(suite_run, results_path, os.waitstatus_to_exitcode(status))
+            freed = suite_run.resources_pool.free_reserved_by(origin_id)
+            if freed:
+                self.err('Freed %d resources left behind by worker' % freed, suite_run=suite_run.name(), pid=pid)
+        return reaped
+
+    def collect_results(self, suite_run, results_path, exitcode):
+        if os.path.isfile(results_path):
+            with open(results_path, 'rb') as f:
+                suite_run.set_results(pickle.load(f))
+            os.remove(results_path)
+        else:
+            suite_run.duration = time.time() - suite_run.start_timestamp
+            suite_run.status = suite.SuiteRun.FAIL
+        if exitcode != 0:
+            suite_run.status = suite.SuiteRun.FAIL
+            self.err('Worker failed', suite_run=suite_run.name(), exitcode=exitcode)
+        self.log('Finished worker', suite_run=suite_run.name(), status=suite_run.status, running=len(self.running))
+
+    def stop_workers(self):
+        for pid in self.running.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        # let them free their resources
+        for pid, (suite_run, results_path, origin_id) in list(self.running.items()):
+            os.waitpid(pid, 0)
+            suite_run.resources_pool.free_reserved_by(origin_id)
+            del self.running[pid]
+
 # vim: expandtab tabstop=4 shiftwidth=4
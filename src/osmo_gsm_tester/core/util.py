@@ -28,8 +28,6 @@ import atexit
 import threading
 import importlib.util
 import subprocess
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
 
 # This mirrors enum osmo_auth_algo in libosmocore/include/osmocom/crypt/auth.h
 # so that the index within the tuple matches the enum value.
@@ -182,6 +180,153 @@ def dict2obj(value):
         return DictProxy(value)
     return value
 
+def _read_only(self, *args, **kwargs):
+    raise TypeError('%s is read-only, modify a cow_view() of it instead' % type(self).__name__)
+
+class FrozenDict(dict):
+    '''A read-only dict in a config tree shared instead of copied, see
+    freeze(). To modify it, get a writable cow_view() of it.'''
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+    def __copy__(self):
+        return CowDict(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+class FrozenList(list):
+    '''A read-only list in a config tree shared instead of copied, see
+    freeze(). To modify it, get a writable cow_view() of it.'''
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+    def __copy__(self):
+        return CowList(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+class CowDict(dict):
+    '''A writable copy of a FrozenDict, sharing its frozen values. A frozen
+    value is replaced by a cow_view() of it once it is accessed, so that only
+    the parts of a config tree that are read or modified through it get
+    copied, one dict or list at a time.'''
+
+    def __getitem__(self, key):
+        val = dict.__getitem__(self, key)
+        if isinstance(val, (FrozenDict, FrozenList)):
+            val = cow_view(val)
+            dict.__setitem__(self, key, val)
+        return val
+
+    def __iter__(self):
+        # not inherited, so that dict(view) and {**view} use __getitem__
+        return dict.__iter__(self)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        return cow_view(dict.pop(self, key, *default))
+
+    def popitem(self):
+        key, val = dict.popitem(self)
+        return key, cow_view(val)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def copy(self):
+        return CowDict(dict.items(self))
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+class CowList(list):
+    '''A writable copy of a FrozenList, sharing its frozen elements like
+    CowDict does with its values.'''
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return CowList(list.__getitem__(self, idx))
+        val = list.__getitem__(self, idx)
+        if isinstance(val, (FrozenDict, FrozenList)):
+            val = cow_view(val)
+            list.__setitem__(self, idx, val)
+        return val
+
+    def __iter__(self):
+        i = 0
+        while i < len(self):
+            yield self[i]
+            i += 1
+
+    def __reversed__(self):
+        for i in range(len(self) - 1, -1, -1):
+            yield self[i]
+
+    def __add__(self, other):
+        return CowList(list.__add__(self, other))
+
+    def pop(self, idx=-1):
+        return cow_view(list.pop(self, idx))
+
+    def copy(self):
+        return CowList(list.__iter__(self))
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+def freeze(val):
+    '''Return val as a tree of FrozenDict and FrozenList, to be shared by
+    several users instead of deep-copying it for each of them. Parts of val
+    that are frozen already are shared as well, the rest is copied.'''
+    if isinstance(val, (FrozenDict, FrozenList)):
+        return val
+    if isinstance(val, dict):
+        return FrozenDict((key, freeze(v)) for key, v in dict.items(val))
+    if isinstance(val, list):
+        return FrozenList(freeze(v) for v in list.__iter__(val))
+    return val
+
+def cow_view(val):
+    '''Return a writable CowDict or CowList of a frozen val, copying only its
+    first level. Any other val is returned as it is.'''
+    if isinstance(val, FrozenDict):
+        return CowDict(val)
+    if isinstance(val, FrozenList):
+        return CowList(val)
+    return val
+
+def thaw(val):
+    '''Return a deep copy of val made of plain dicts and lists, also for
+    frozen trees and cow_view()s of them. Faster than copy.deepcopy() for the
+    few types in a config.'''
+    if isinstance(val, dict):
+        return dict((key, thaw(v)) for key, v in dict.items(val))
+    if isinstance(val, list):
+        return [thaw(v) for v in list.__iter__(val)]
+    return val
+
 
 class FileLock:
     def __init__(self, path, owner):
@@ -304,13 +449,15 @@ class Dir():
     def __repr__(self):
         return self.path
 
-class FileWatch(FileSystemEventHandler):
+class FileWatch:
+    '''Watch a file with watchdog. Implements the event handler interface of
+    watchdog's FileSystemEventHandler, so that watchdog is only imported
+    when a FileWatch is created.'''
     def __init__(self, origin, watch_path, event_func):
-        FileSystemEventHandler.__init__(self)
         self.origin = origin
         self.watch_path = watch_path
         self.event_func = event_func
-        self.observer = Observer()
+        self.observer = watchdog_observers.Observer()
         self.watch = None
         self.mutex = threading.Lock()
 
@@ -336,7 +483,10 @@ class FileWatch(FileSystemEventHandler):
         self.stop()
         self.observer = None
 
-    # Override from FileSystemEventHandler
+    # As FileSystemEventHandler does
+    def dispatch(self, event):
+        self.on_any_event(event)
+
     def on_any_event(self, event):
         if event.is_directory:
             return None
@@ -408,6 +558,46 @@ def get_tempdir(remove_on_exit=True):
     return _tempdir
 
 
+class LazyModule:
+    '''Stands in for a module that is only imported once one of its
+    attributes is used, for dependencies that are expensive to import and
+    not needed by all users of a module:
+
+      GLib = LazyModule('gi.repository.GLib')
+      def f():
+          GLib.idle_add(...) # imports gi.repository.GLib on first call
+    '''
+
+    def __init__(self, module_name):
+        self._module_name = module_name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            parent, dot, name = self._module_name.rpartition('.')
+            if parent:
+                # like "from parent import name", which also works for
+                # modules only available as attribute of their parent:
+                self._module = getattr(__import__(parent, fromlist=[name]), name)
+            else:
+                self._module = importlib.import_module(name)
+        return self._module
+
+    def __getattr__(self, attr):
+        if attr.startswith('__') or attr.startswith('_module'):
+            # copy, pickle & co. probing for special methods, or not
+            # initialized yet; don't import for those
+            raise AttributeError(attr)
+        val = getattr(self._load(), attr)
+        # found directly next time:
+        setattr(self, attr, val)
+        return val
+
+    def __repr__(self):
+        return '<lazy module %r%s>' % (self._module_name, '' if self._module is None else ' (loaded)')
+
+watchdog_observers = LazyModule('watchdog.observers')
+
 if hasattr(importlib.util, 'module_from_spec'):
     def run_python_file(module_name, path):
         spec = importlib.util.spec_from_file_location(module_name, path)
@@ -469,12 +659,20 @@ def list_validate_same_elem_type(li):
     '''
     if len(li) == 0:
         return None
-    t = type(li[0])
+    t = elem_type(li[0])
     for elem in li:
-        if type(elem) != t:
+        if elem_type(elem) != t:
             raise ValueError('List contains elements of different types: %r vs %r' % (t, type(elem)))
     return t
 
+def elem_type(elem):
+    'type(elem), except dict and list for the FrozenDict, CowDict etc. in config trees'
+    if isinstance(elem, (FrozenDict, CowDict)):
+        return dict
+    if isinstance(elem, (FrozenList, CowList)):
+        return list
+    return type(elem)
+
 def empty_instance_type(t):
     if t == dict:
         return {}
@@ -208,11 +208,7 @@ class AbisIpFind(log.Origin):
     def get_line_by_ip(self, ipaddr):
         """Get latest line (more up to date) from abisip-find based on ip address."""
         token = "IP_Address='%s'" % ipaddr
-        myline = None
-        for line in (self.proc.get_stdout() or '').splitlines():
-            if token in line:
-                myline = line
-        return myline
+        return self.proc.get_last_line_stdout(token)
 
     def get_unitid_by_ip(self, ipaddr):
             line = self.get_line_by_ip(ipaddr)
@@ -297,8 +297,8 @@ class OsmoTrx(Trx, metaclass=ABCMeta):
         rem_host.recreate_remote_dir(remote_prefix_dir)
         if have_inst:
             self.remote_inst = util.Dir(remote_prefix_dir.child(os.path.basename(str(self.inst))))
-            rem_host.create_remote_dir(self.remote_inst)
-            rem_host.scp('scp-inst-to-remote', str(self.inst), remote_prefix_dir)
+            bin_tar, md5 = self.testenv.suite().trial().get_bin_tar_md5('osmo-trx')
+            rem_host.stage_inst(bin_tar, md5, self.remote_inst)
         rem_host.create_remote_dir(remote_run_dir)
         rem_host.scp('scp-cfg-to-remote', self.config_file, remote_config_file)
 
@@ -336,7 +336,7 @@ class OsmoTrx(Trx, metaclass=ABCMeta):
     def trx_ready(self):
         if not self.proc_trx or not self.proc_trx.is_running:
             return False
-        return '-- Transceiver active with' in (self.proc_trx.get_stdout() or '')
+        return self.proc_trx.get_counter_stdout('-- Transceiver active with') > 0
 
 class OsmoTrxUHD(OsmoTrx):
     BIN_TRX = 'osmo-trx-uhd'
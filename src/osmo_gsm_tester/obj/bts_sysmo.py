@@ -88,7 +88,7 @@ class SysmoBts(bts_osmo.OsmoBts):
     def ready_for_pcu(self):
         if not self.proc_bts or not self.proc_bts.is_running:
             return False
-        return 'Started listening on PCU socket' in (self.proc_bts.get_stdout() or '')
+        return self.proc_bts.get_counter_stdout('Started listening on PCU socket') > 0
 
     def start(self, keepalive=False):
         if self.bsc is None:
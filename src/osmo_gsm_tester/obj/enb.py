@@ -386,6 +386,9 @@ class eNodeB(log.Origin, metaclass=ABCMeta):
     def addr(self):
         return self._run_node.run_addr()
 
+    def run_node(self):
+        return self._run_node
+
     @abstractmethod
     def get_counter(self, counter_name):
         pass
@@ -263,8 +263,12 @@ class AmarisoftENB(enb.eNodeB):
         self.gen_conf_file(self.config_drb_nr_file, AmarisoftENB.CFGFILE_DRB_NR, values)
 
         if not self._run_node.is_local():
-            self.rem_host.recreate_remote_dir(self.remote_inst)
-            self.rem_host.scp('scp-inst-to-remote', str(self.inst), remote_prefix_dir)
+            if os.getenv('AMARISOFT_PATH_ENB', None) is None:
+                bin_tar, md5 = self.testenv.suite().trial().get_bin_tar_md5('amarisoftenb', self._run_node.run_label())
+                self.rem_host.stage_inst(bin_tar, md5, self.remote_inst)
+            else:
+                self.rem_host.recreate_remote_dir(self.remote_inst)
+                self.rem_host.scp('scp-inst-to-remote', str(self.inst), remote_prefix_dir)
             self.rem_host.recreate_remote_dir(remote_run_dir)
             self.rem_host.scp('scp-cfg-to-remote', self.config_file, self.remote_config_file)
             self.rem_host.scp('scp-cfg-sib1-to-remote', self.config_sib1_file, self.remote_config_sib1_file)
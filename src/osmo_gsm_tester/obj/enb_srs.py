@@ -97,7 +97,6 @@ class srsENB(enb.eNodeB, srslte_common):
         self.enable_malloc_interceptor = False
         self.metrics_file = None
         self.have_metrics_file = False
-        self.stop_sleep_time = 6 # We require at most 5s to stop
         self.testenv = testenv
         self._additional_args = []
         if not rf_type_valid(conf.get('rf_dev_type', None)):
@@ -110,40 +109,32 @@ class srsENB(enb.eNodeB, srslte_common):
             return
 
         # Make sure we give the UE time to tear down
-        self.sleep_after_stop()
+        self.wait_stopped()
 
         # Execute the post run tasks.
         if not self.postrun_tasks():
             self.log('Could not execute the post run tasks')
 
-        # copy back files (may not exist, for instance if there was an early error of process):
-        self.scp_back_metrics(raiseException=False)
-
-        # copy back files (may not exist, for instance if there was an early error of process):
-        try:
-            self.rem_host.scpfrom('scp-back-log', self.remote_log_file, self.log_file)
-        except Exception as e:
-            self.log(repr(e))
+        # copy back files in one go (may not exist, for instance if there was
+        # an early error of process):
+        files = [(self.remote_log_file, self.log_file)]
         if self.enable_pcap:
-            try:
-                self.rem_host.scpfrom('scp-back-pcap', self.remote_pcap_file, self.pcap_file)
-            except Exception as e:
-                self.log(repr(e))
-            try:
-                self.rem_host.scpfrom('scp-back-s1-pcap', self.remote_s1ap_pcap_file, self.s1ap_pcap_file)
-            except Exception as e:
-                self.log(repr(e))
+            files.append((self.remote_pcap_file, self.pcap_file))
+            files.append((self.remote_s1ap_pcap_file, self.s1ap_pcap_file))
         if self.enable_tracing:
-            try:
-                self.rem_host.scpfrom('scp-back-tracing', self.remote_tracing_file, self.tracing_file)
-            except Exception as e:
-                self.log(repr(e))
-
+            files.append((self.remote_tracing_file, self.tracing_file))
         if self.enable_malloc_interceptor:
-            try:
-                self.rem_host.scpfrom('scp-back-interceptor', self.remote_interceptor_file, self.interceptor_file)
-            except Exception as e:
-                self.log(repr(e))
+            files.append((self.remote_interceptor_file, self.interceptor_file))
+        if not self.have_metrics_file:
+            # file is not properly flushed until the process has stopped.
+            if self.running():
+                self.stop()
+            files.append((self.remote_metrics_file, self.metrics_file))
+            self.have_metrics_file = True
+        try:
+            self.rem_host.fetch_files('fetch-back-files', files)
+        except Exception as e:
+            self.log(repr(e))
 
         # Collect KPIs for each TC
         self.testenv.test().set_kpis(self.get_kpi_tree())
@@ -420,8 +411,8 @@ class srsENB(enb.eNodeB, srslte_common):
         self.gen_conf_file(self.config_drb_file, srsENB.CFGFILE_DRB, values)
 
         if not self._run_node.is_local():
-            self.rem_host.recreate_remote_dir(self.remote_inst)
-            self.rem_host.scp('scp-inst-to-remote', str(self.inst), remote_prefix_dir)
+            bin_tar, md5 = self.testenv.suite().trial().get_bin_tar_md5('srslte', self._run_node.run_label())
+            self.rem_host.stage_inst(bin_tar, md5, self.remote_inst)
             self.rem_host.recreate_remote_dir(self.remote_run_dir)
             self.rem_host.scp('scp-cfg-to-remote', self.config_file, self.remote_config_file)
             self.rem_host.scp('scp-cfg-sib-to-remote', self.config_sib_file, self.remote_config_sib_file)
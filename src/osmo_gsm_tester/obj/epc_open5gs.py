@@ -18,6 +18,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import re
 import pprint
 import copy
 
@@ -207,11 +208,7 @@ class Open5gsEPC(epc.EPC):
         # Match against sample mmed line: "eNB-S1 accepted[172.18.50.101]:50867"
         if not self.mme or not self.mme.running():
             return False
-        stdout_lines = (self.mme.process.get_stdout() or '').splitlines()
-        for l in stdout_lines:
-            if 'eNB' in l and 'accepted' in l and enb.addr() in l:
-                return True
-        return False
+        return self.mme.process.get_counter_stdout(re.compile('eNB.*accepted.*' + re.escape(enb.addr()))) > 0
 
     def running(self):
         return self.pcrf and self.upf and self.smf and self.hss and \
@@ -18,6 +18,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import re
 import pprint
 
 from ..core import log, util, config, template, process, remote
@@ -65,15 +66,13 @@ class srsEPC(epc.EPC, srslte_common):
         if self._run_node.is_local():
             return
         # copy back files (may not exist, for instance if there was an early error of process):
+        files = [(self.remote_log_file, self.log_file)]
+        if self.enable_pcap:
+            files.append((self.remote_pcap_file, self.pcap_file))
         try:
-            self.rem_host.scpfrom('scp-back-log', self.remote_log_file, self.log_file)
+            self.rem_host.fetch_files('fetch-back-files', files)
         except Exception as e:
             self.log(repr(e))
-        if self.enable_pcap:
-            try:
-                self.rem_host.scpfrom('scp-back-pcap', self.remote_pcap_file, self.pcap_file)
-            except Exception as e:
-                self.log(repr(e))
 
     def start(self):
         self.log('Starting srsepc')
@@ -207,11 +206,8 @@ class srsEPC(epc.EPC, srslte_common):
 
     def enb_is_connected(self, enb):
         # Match against sample line: "S1 Setup Request - eNB Name: srsenb01, eNB id: 0x19"
-        stdout_lines = (self.process.get_stdout() or '').splitlines()
-        for l in stdout_lines:
-            if l.startswith('S1 Setup Request') and l.endswith('eNB id: %s' % hex(enb.id()).lower()):
-                return True
-        return False
+        regex = re.compile('^S1 Setup Request.*eNB id: %s$' % hex(enb.id()).lower())
+        return self.process.get_counter_stdout(regex) > 0
 
     def running(self):
         return not self.process.terminated()
@@ -321,7 +321,7 @@ class AmarisoftUE(MS):
     def is_registered(self, mcc_mnc=None):
         # lteue doesn't call the ifup script until after it becomes attached, so
         # simply look for our ifup script output at the end of it:
-        return 'netns %s configured' % (self.netns()) in (self.process.get_stdout() or '')
+        return self.process.get_counter_stdout('netns %s configured' % (self.netns())) > 0
 
     def is_rrc_connected(self):
         return self.is_registered()
@@ -100,6 +100,7 @@ class srsUE(MS, srslte_common):
         self.process = None
         self.rem_host = None
         self.remote_inst = None
+        self.inst_cache = None
         self.remote_run_dir = None
         self.remote_config_file = None
         self.remote_log_file = None
@@ -123,19 +124,23 @@ class srsUE(MS, srslte_common):
             return
 
         # Make sure we give the UE time to tear down
-        self.sleep_after_stop()
+        self.wait_stopped()
 
-        # copy back files (may not exist, for instance if there was an early error of process):
-        self.scp_back_metrics(raiseException=False)
+        # copy back files in one go (may not exist, for instance if there was
+        # an early error of process):
+        files = [(self.remote_log_file, self.log_file)]
+        if self.enable_pcap:
+            files.append((self.remote_pcap_file, self.pcap_file))
+        if not self.have_metrics_file:
+            # file is not properly flushed until the process has stopped.
+            if self.running():
+                self.stop()
+            files.append((self.remote_metrics_file, self.metrics_file))
+            self.have_metrics_file = True
         try:
-            self.rem_host.scpfrom('scp-back-log', self.remote_log_file, self.log_file)
+            self.rem_host.fetch_files('fetch-back-files', files)
         except Exception as e:
             self.log(repr(e))
-        if self.enable_pcap:
-            try:
-                self.rem_host.scpfrom('scp-back-pcap', self.remote_pcap_file, self.pcap_file)
-            except Exception as e:
-                self.log(repr(e))
 
         # Collect KPIs for each TC
         self.testenv.test().set_kpis(self.get_kpi_tree())
@@ -236,17 +241,19 @@ class srsUE(MS, srslte_common):
         self.process.stdin_write('t\n')
 
     def start_remotely(self):
-        remote_lib = self.remote_inst.child('lib')
-        remote_binary = self.remote_inst.child('bin', srsUE.BINFILE)
+        # Patch the binary in the inst cache entry (where remote_inst points
+        # to), where RPATH and capabilities persist across tests and trials:
+        remote_lib = self.inst_cache.entry.child('lib')
+        remote_binary = self.inst_cache.entry.child('bin', srsUE.BINFILE)
         # setting capabilities will later disable use of LD_LIBRARY_PATH from ELF loader -> modify RPATH instead.
         self.log('Setting RPATH for srsue')
         # srsue binary needs patchelf >= 0.9+52 to avoid failing during patch. OS#4389, patchelf-GH#192.
-        self.rem_host.change_elf_rpath(remote_binary, remote_lib)
+        self.inst_cache.apply_once('rpath-srsue', self.rem_host.change_elf_rpath, remote_binary, remote_lib)
 
         # srsue requires CAP_SYS_ADMIN to jump to net network namespace: netns(CLONE_NEWNET):
         # srsue requires CAP_NET_ADMIN to create tunnel devices: ioctl(TUNSETIFF):
         self.log('Applying CAP_SYS_ADMIN+CAP_NET_ADMIN capability to srsue')
-        self.rem_host.setcap_netsys_admin(remote_binary)
+        self.inst_cache.apply_once('setcap-netsys-srsue', self.rem_host.setcap_netsys_admin, remote_binary)
 
         self.log('Creating netns %s' % self.netns())
         self.rem_host.create_netns(self.netns())
@@ -401,31 +408,32 @@ class srsUE(MS, srslte_common):
             f.write(r)
 
         if not self._run_node.is_local():
-            self.rem_host.recreate_remote_dir(self.remote_inst)
-            self.rem_host.scp('scp-inst-to-remote', str(self.inst), remote_prefix_dir)
+            bin_tar, md5 = self.testenv.suite().trial().get_bin_tar_md5('srslte', self._run_node.run_label())
+            self.inst_cache = self.rem_host.stage_inst(bin_tar, md5, self.remote_inst)
             self.rem_host.recreate_remote_dir(self.remote_run_dir)
             self.rem_host.scp('scp-cfg-to-remote', self.config_file, self.remote_config_file)
 
     def is_rrc_connected(self):
         ''' Check whether UE is RRC connected using console message '''
-        pos_connected = (self.process.get_stdout() or '').rfind('RRC Connected')
-        pos_released = (self.process.get_stdout() or '').rfind('RRC IDLE')
-        return pos_connected > pos_released
+        connected = self.process.output_watch('stdout', 'RRC Connected')
+        released = self.process.output_watch('stdout', 'RRC IDLE')
+        if connected is None or connected.last_line_nr is None:
+            return False
+        return released.last_line_nr is None or connected.last_line_nr > released.last_line_nr
 
     def is_registered(self, mcc_mnc=None):
         ''' Checks if UE is EMM registered '''
-        return 'Network attach successful.' in (self.process.get_stdout() or '')
+        return self.process.get_counter_stdout('Network attach successful.') > 0
 
     def get_assigned_addr(self, ipv6=False):
         if ipv6:
             raise log.Error('IPv6 not implemented!')
         else:
-            stdout_lines = (self.process.get_stdout() or '').splitlines()
-            for line in reversed(stdout_lines):
-                if line.find('Network attach successful. IP: ') != -1:
-                    ipv4_addr = re.findall( r'[0-9]+(?:\.[0-9]+){3}', line)
-                    return ipv4_addr[0]
-            return None
+            line = self.process.get_last_line_stdout('Network attach successful. IP: ')
+            if line is None:
+                return None
+            ipv4_addr = re.findall( r'[0-9]+(?:\.[0-9]+){3}', line)
+            return ipv4_addr[0]
 
     def running(self):
         return not self.process.terminated()
@@ -17,31 +17,76 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import time
+
 from ..core import log
+from ..core import process as process_module
 from ..core.event_loop import MainLoop
 
+# Last line printed by srsLTE applications on stdout, once logs and metrics
+# files have been flushed and closed:
+EXIT_LINE = '---  exiting  ---'
+
 class srslte_common(): # don't inherit from log.Origin here but instead use .name() from whoever inherits from us
 
     def __init__(self):
         self.log_file = None
         self.process = None
         self.metrics_file = None
-        self.stop_sleep_time = 6 # We require at most 5s to stop
+        self.stop_timeout = 6 # We require at most 5s to stop
+        self._stop_started = None
+        self._stop_latency = None
+        self._stop_reason = None
         self.log_kpi = None
         self.stdout_kpi = None
         self.csv_kpi = None
 
-    def sleep_after_stop(self):
-        # Only sleep once
-        if self.stop_sleep_time > 0:
-            MainLoop.sleep(self.stop_sleep_time)
-            self.stop_sleep_time = 0
+    def exit_line_seen(self):
+        watch = self.process.output_watch('stdout', EXIT_LINE)
+        return watch is not None and watch.count > 0
+
+    def exited_cleanly(self):
+        '''Whether the application is known to be gone with all of its output
+        files flushed: it printed its exit line, or it exited on its own. A local
+        process which was terminated is gone as well, but a terminated remote
+        (ssh) process only means the remote application was told to go away.'''
+        if self.exit_line_seen():
+            return True
+        if not self.process.terminated():
+            return False
+        return not self.process.killed or not isinstance(self.process, process_module.RemoteProcess)
+
+    def wait_stopped(self):
+        '''Wait until the application stopped, at most until stop_timeout
+        seconds after it was asked to stop. Only waits once.'''
+        if self._stop_latency is not None or self.process is None:
+            return
+        if self._stop_started is None:
+            # stopped from outside, e.g. by testenv.stop_processes()
+            self._stop_started = time.time()
+        remaining = self._stop_started + self.stop_timeout - time.time()
+        if remaining > 0:
+            MainLoop.wait_no_raise(self.exited_cleanly, [], {}, timeout=remaining, timestep=1)
+        self._stop_latency = time.time() - self._stop_started
+        if self.exited_cleanly():
+            self._stop_reason = 'exit-line' if self.exit_line_seen() else 'exit'
+        else:
+            self._stop_reason = 'forced'
+        self.dbg('Stopped', latency='%.2fs' % self._stop_latency, reason=self._stop_reason)
 
     def stop(self):
-        # Send q+Enter to stdin to self-terminate application
+        self._stop_started = time.time()
+        # Send q+Enter to stdin to self-terminate application, and only
+        # terminate it if it doesn't manage on its own in time
         self.process.stdin_write('q\n')
-        self.testenv.stop_process(self.process)
-        self.sleep_after_stop()
+        self.testenv.stop_process(self.process, grace_timeout=self.stop_timeout,
+                                  grace_condition=self.exited_cleanly)
+        self.wait_stopped()
+
+    def get_stop_kpis(self):
+        if self._stop_latency is None:
+            return {}
+        return {'stop_latency': round(self._stop_latency, 3), 'stop_reason': self._stop_reason}
 
     def get_kpis(self):
         ''' Merge all KPI and return as flat dict '''
@@ -59,6 +104,7 @@ class srslte_common(): # don't inherit from log.Origin here but instead use .nam
         kpi_tree["log_" + self.name()] = self.log_kpi
         kpi_tree["csv_" + self.name()] = self.csv_kpi
         kpi_tree["stdout_" + self.name()] = self.stdout_kpi
+        kpi_tree["stop_" + self.name()] = self.get_stop_kpis()
         return kpi_tree
 
     def extract_kpis(self):
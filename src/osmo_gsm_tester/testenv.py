@@ -22,6 +22,7 @@
 # from osmo_gsm_tester.testenv import *
 
 import sys
+import concurrent.futures
 
 from .core import util
 from .core import process
@@ -49,6 +50,139 @@ print = None
 class Timeout(Exception):
     pass
 
+class ObjectsCleanup(log_module.Origin):
+    '''Run cleanup() of a list of objects (given in cleanup order) with
+    objects on distinct remote run nodes being cleaned up concurrently, on a
+    bounded pool of worker threads. Objects without a remote run node are
+    cleaned up on the calling thread, which keeps serving the event loop, and
+    act as barriers: all objects before them in cleanup order are done before
+    they are cleaned up, and no object after them is started before. E.g. an
+    iperf3 client running in the netns of a UE is still stopped before the UE.
+    Within each run of consecutive remote objects, objects with the same run
+    node are cleaned up sequentially in the given order.
+
+    An object may provide cleanup_after(), returning the objects that must
+    be cleaned up before itself. Such objects are moved before it in the
+    cleanup order and, if remote, cleaned up in the same sequence, so the
+    dependency is always honoured.'''
+
+    MAX_WORKERS = 8
+    TIMEOUT = 600
+
+    def __init__(self, objects):
+        super().__init__(log_module.C_TST, 'cleanup')
+        self.objects = self._sort_deps_first(objects)
+        self.steps = self._build_steps()
+
+    @staticmethod
+    def _group_key(obj):
+        if not hasattr(obj, 'run_node'):
+            return None
+        run_node = obj.run_node()
+        if run_node is None:
+            return None
+        if not run_node.is_local():
+            return ('ssh', run_node.ssh_addr())
+        if run_node.adb_serial_id():
+            return ('adb', run_node.adb_serial_id())
+        return None
+
+    def _build_steps(self):
+        '''Split the objects into a list of steps run one after the other:
+        a local object is a step of its own, consecutive remote objects form
+        one step made of the list of their run node groups.'''
+        steps = []
+        remote_objs = []
+        for obj in self.objects:
+            if self._group_key(obj) is not None:
+                remote_objs.append(obj)
+                continue
+            if remote_objs:
+                steps.append(self._build_groups(remote_objs))
+                remote_objs = []
+            steps.append([[obj]])
+        if remote_objs:
+            steps.append(self._build_groups(remote_objs))
+        return steps
+
+    def _build_groups(self, objs):
+        # union-find over group keys, merging groups of dependent objects:
+        group_of = {}
+        parent = {}
+        def find(key):
+            while parent.setdefault(key, key) != key:
+                key = parent[key]
+            return key
+        for obj in objs:
+            group_of[id(obj)] = find(self._group_key(obj))
+        for obj in objs:
+            if not hasattr(obj, 'cleanup_after'):
+                continue
+            for dep in obj.cleanup_after():
+                if id(dep) not in group_of:
+                    continue
+                a = find(group_of[id(obj)])
+                b = find(group_of[id(dep)])
+                if a != b:
+                    parent[a] = b
+        groups = {}
+        for obj in objs:
+            groups.setdefault(find(group_of[id(obj)]), []).append(obj)
+        return list(groups.values())
+
+    @staticmethod
+    def _sort_deps_first(objs):
+        result = []
+        visiting = set()
+        members = set([id(o) for o in objs])
+        def visit(obj):
+            if id(obj) in visiting:
+                return # done, or dependency cycle: keep the given order
+            visiting.add(id(obj))
+            if hasattr(obj, 'cleanup_after'):
+                for dep in obj.cleanup_after():
+                    if id(dep) in members:
+                        visit(dep)
+            result.append(obj)
+        for obj in objs:
+            visit(obj)
+        return result
+
+    @staticmethod
+    def _cleanup_group(objs):
+        for obj in objs:
+            try:
+                obj.cleanup()
+            except Exception:
+                log_module.log_exn()
+
+    def _cleanup_parallel(self, groups):
+        self.dbg('Cleaning up %d run nodes in parallel' % len(groups))
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=min(len(groups), ObjectsCleanup.MAX_WORKERS))
+        futures = [pool.submit(self._cleanup_group, objs) for objs in groups]
+        try:
+            for future in futures:
+                future.add_done_callback(lambda f: MainLoop.wakeup())
+            try:
+                if not MainLoop.wait_no_raise(lambda: all([f.done() for f in futures]), [], {},
+                                              timeout=ObjectsCleanup.TIMEOUT, timestep=1):
+                    self.err('Timeout waiting for parallel cleanup to finish, waiting for running cleanups to return')
+            except Exception:
+                log_module.log_exn()
+        finally:
+            # Never leave workers behind still touching the objects: drop
+            # the groups not started yet and join the running ones.
+            for future in futures:
+                future.cancel()
+            pool.shutdown(wait=True)
+
+    def run(self):
+        for groups in self.steps:
+            if len(groups) == 1:
+                self._cleanup_group(groups[0])
+            else:
+                self._cleanup_parallel(groups)
+
 class TestEnv(log_module.Origin):
     def __init__(self, suite_run, test):
         super().__init__(log_module.C_TST, test.name())
@@ -57,7 +191,6 @@ class TestEnv(log_module.Origin):
         self._processes = []
         self.test_import_modules_to_clean_up = []
         self.objects_to_clean_up = None
-        MainLoop.register_poll_func(self.poll)
         if self._test.timeout is not None: # aimed at firing once
             MainLoop.register_poll_func(self._timeout_expired, timestep=self._test.timeout)
 
@@ -73,6 +206,10 @@ class TestEnv(log_module.Origin):
         will be marked as FAIL and end immediatelly. If respwan=True, then suite
         will respawn() the process instead.'''
         self._processes.insert(0, (process, respawn))
+        process.add_exit_handler(self._process_exited)
+        if process.terminated(poll_first=False):
+            # exited before we could attach to it
+            MainLoop.defer(self._process_exited, process)
 
     def stop_processes(self):
         if len(self._processes) == 0:
@@ -80,29 +217,45 @@ class TestEnv(log_module.Origin):
         strategy = process_module.ParallelTerminationStrategy()
         while self._processes:
             proc, _ = self._processes.pop()
+            proc.remove_exit_handler(self._process_exited)
             strategy.add_process(proc)
         strategy.terminate_all()
 
-    def stop_process(self, process):
-        'Remove process from monitored list and stop it'
+    def stop_process(self, process, grace_timeout=0, grace_condition=None):
+        '''Remove process from monitored list and stop it. If grace_timeout is
+        given, the process is first given that many seconds to exit on its own
+        (or until grace_condition() returns True), e.g. after having been asked
+        to quit.'''
         for proc_respawn in self._processes:
             proc, respawn = proc_respawn
             if proc == process:
                 self._processes.remove(proc_respawn)
+                proc.remove_exit_handler(self._process_exited)
+                if grace_timeout > 0:
+                    condition = grace_condition or proc.terminated
+                    MainLoop.wait_no_raise(lambda: proc.terminated() or condition(), [], {},
+                                           timeout=grace_timeout, timestep=1)
                 proc.terminate()
 
     def register_for_cleanup(self, *obj):
+        '''Objects are cleaned up in reverse order of registration, objects on
+        distinct remote run nodes concurrently (see ObjectsCleanup).'''
         assert all([hasattr(o, 'cleanup') for o in obj])
         self.objects_to_clean_up = self.objects_to_clean_up or []
         self.objects_to_clean_up.extend(obj)
 
     def objects_cleanup(self):
-        while self.objects_to_clean_up:
-            obj = self.objects_to_clean_up.pop()
-            try:
-                obj.cleanup()
-            except Exception:
-                log_module.log_exn()
+        if not self.objects_to_clean_up:
+            return
+        objs = list(reversed(self.objects_to_clean_up))
+        self.objects_to_clean_up = None
+        ObjectsCleanup(objs).run()
+        try:
+            # their processes are gone, so are their ZMQ ports:
+            self.suite_run.resource_pool().release_ports_leased_by(
+                [obj for obj in objs if isinstance(obj, log_module.Origin)])
+        except Exception:
+            log_module.log_exn()
 
     def test_import_modules_register_for_cleanup(self, mod):
         '''
@@ -130,16 +283,26 @@ class TestEnv(log_module.Origin):
         MainLoop.unregister_poll_func(self._timeout_expired)
         raise log_module.Error('Test Timeout triggered: %d seconds elapsed' % self._test.elapsed_time())
 
+    def _check_process(self, proc, respawn):
+        if respawn == True:
+            proc.respawn()
+        else:
+            proc.log_stdout_tail()
+            proc.log_stderr_tail()
+            log_module.ctx(proc)
+            raise log_module.Error('Process ended prematurely: %s' % proc.name())
+
+    def _process_exited(self, process):
+        # Called by the event loop right after a remembered process died
+        for proc, respawn in self._processes:
+            if proc == process and proc.terminated():
+                self._check_process(proc, respawn)
+                return
+
     def poll(self):
         for proc, respawn in self._processes:
             if proc.terminated():
-                if respawn == True:
-                    proc.respawn()
-                else:
-                    proc.log_stdout_tail()
-                    proc.log_stderr_tail()
-                    log_module.ctx(proc)
-                    raise log_module.Error('Process ended prematurely: %s' % proc.name())
+                self._check_process(proc, respawn)
 
     def stop(self):
         # if sys.exit() called from signal handler (e.g. SIGINT), SystemExit
@@ -148,7 +311,6 @@ class TestEnv(log_module.Origin):
         self.stop_processes()
         self.objects_cleanup()
         self.suite_run.reserved_resources.put_all()
-        MainLoop.unregister_poll_func(self.poll)
         MainLoop.unregister_poll_func(self._timeout_expired)
         self.test_import_modules_cleanup()
         self.set_overlay_template_dir(None)
@@ -337,6 +499,12 @@ class TestEnv(log_module.Origin):
         self.log('using MSISDN', msisdn)
         return msisdn
 
+    def msisdns(self, count):
+        'Return a list of count MSISDNs, cheaper than calling msisdn() as often'
+        msisdns = self.suite_run.resource_pool().next_msisdns(self, count)
+        self.log('using MSISDNs', msisdns)
+        return msisdns
+
     def lac(self):
         lac = self.suite_run.resource_pool().next_lac(self)
         self.log('using LAC', lac)